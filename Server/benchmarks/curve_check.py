@@ -0,0 +1,73 @@
+# batched curve optimizer against the per-curve one
+#
+# reoptimize_curve.MVC_magnitudes_batch must return the magnitudes MVC_magnitudes returns for
+# every curve. For every model in Data/ at its loaded pose, all its curves are solved both ways
+# and compared by their magnitudes and their energy ( CurveBatch.energies, the f of MVC_magnitudes ):
+#     python benchmarks/curve_check.py [--models cube truck ...] [--tolerance 0.01]
+# a curve fails when its magnitudes differ by more than --tolerance relative to their norm,
+# or when the batched energy is higher than the per-curve energy by more than the tolerance.
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+import reoptimize_curve
+import sketch_modify
+
+data_dir = os.path.join( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ), 'Data' )
+
+
+def compare_model( state ):
+    '''
+    Return:
+        for every curve of state: ( curve index, relative magnitude difference,
+        batched energy, per-curve energy )
+    '''
+    indices, curves = sketch_modify.curves_to_optimize( state, range( len( state['points'] ) ) )
+    # the solvers print their progress
+    with contextlib.redirect_stdout( io.StringIO() ):
+        batched, counts = reoptimize_curve.MVC_magnitudes_batch( curves )
+        single = [ reoptimize_curve.MVC_magnitudes( points, tangents ) for points, tangents in curves ]
+
+    rows = []
+    for index, curve, b, s in zip( indices, curves, batched, single ):
+        b, s = np.asarray( b ), np.asarray( s )
+        energy = reoptimize_curve.CurveBatch( [ curve ] ).energies
+        rows.append( ( index, np.linalg.norm( b - s ) / np.linalg.norm( s ), energy( b )[0], energy( s )[0] ) )
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description = 'compare MVC_magnitudes_batch with MVC_magnitudes on the Data models' )
+    parser.add_argument( '--models', nargs = '*', help = 'parts of model file names, e.g. cube truck ( default all )' )
+    parser.add_argument( '--tolerance', type = float, default = 0.01 )
+    args = parser.parse_args()
+
+    failed = total = 0
+    worst = 0.
+    files = sorted( glob.glob( os.path.join( data_dir, '*.json' ) ) )
+    if args.models:
+        files = [ f for f in files if any( name in os.path.basename( f ) for name in args.models ) ]
+    for path in files:
+        with open( path ) as f:
+            state = json.load( f )
+        rows = compare_model( state )
+        bad = [ row for row in rows if row[1] > args.tolerance or row[2] > row[3] * ( 1 + args.tolerance ) ]
+        total += len( rows )
+        failed += len( bad )
+        worst = max( [ worst ] + [ row[1] for row in rows ] )
+        print( '%-28s %3d curves, %d differ' % ( os.path.basename( path ), len( rows ), len( bad ) ) )
+        for index, difference, batched_energy, energy in bad:
+            print( '    curve %3d   magnitudes %.1f%% apart   energy %.4g batched, %.4g per curve' % (
+                index, 100 * difference, batched_energy, energy ) )
+
+    print( '%d of %d curves differ, largest relative magnitude difference %.2e' % ( failed, total, worst ) )
+    sys.exit( 1 if failed else 0 )
@@ -0,0 +1,290 @@
+# websocket load test
+#
+# Opens N clients against a running edit_server, each of them a simulated headset:
+# `init {"progressive": true}`, then a session replayed in a loop, with the move-line's of a drag
+# sent at --drag-rate per second without waiting ( as the headset sends them every frame )
+# and every other command waiting for its reply. stroke-append's are sent at --drag-rate as well.
+#
+# Measured, per client and in total:
+#     round trip latency of every command, for a move-line until its final reply ( matched by the
+#         sequence of progressive mode ) and until its preview
+#     move-line's coalesced: sent, but no final reply because a newer pose replaced them
+#     throughput: replies per second
+#     message sizes, sent and received
+#     server queue depth: every --queue-interval seconds a client asks `queue-depth`, which the server
+#         answers right away with the messages waiting in this connection and all of them,
+#         and the solves waiting for the solver
+#
+# The session is benchmarks/replay.py's default script of the model the server loaded, with a longer
+# drag, or --session, a file of websocket text messages, one per line, e.g. recorded by the server
+# with edit_server.record_messages ( read with replay.read_script, without the commands of the connection setup ).
+#
+#     python edit_server.py Data/A1_truck_move.json
+#     python benchmarks/load_test.py --clients 4 --duration 30 [--output load.json]
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import websockets
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+import replay
+
+
+# the reply of every command which waits for one
+REPLIES = {
+    'detail-stroke': 'detail_stroke',
+    'stroke-end': 'detail_stroke',
+    'move-detail': 'move_detail',
+    'undo': 'undo',
+    'redo': 'redo',
+}
+
+percentiles = ( 50, 90, 99 )
+
+
+class Client:
+    '''
+    One simulated headset, see run.
+    '''
+
+    def __init__( self, url, messages, drag_rate = 30., queue_interval = 0.25, timeout = 30. ):
+        self.url = url
+        self.messages = messages
+        self.drag_rate = drag_rate
+        self.queue_interval = queue_interval
+        self.timeout = timeout
+
+        self.latencies = {}              # command -> seconds
+        self.sent_bytes = {}             # command -> sizes
+        self.received_bytes = {}         # reply name -> sizes
+        self.queue_depths = []
+        self.move_lines_sent = 0
+        self.move_lines_coalesced = 0
+        self.replies = 0
+        self.errors = []
+
+        self.sent = {}                   # sequence -> time of a move-line
+        self.previewed = set()
+        self.last_final = 0
+        self.waiting = None              # ( reply name, future ) of a command waiting for its reply
+        self.finals = asyncio.Event()
+
+    async def send( self, websocket, message ):
+        command = message.split( " ", 1 )[0]
+        self.sent_bytes.setdefault( command, [] ).append( len( message ) )
+        await websocket.send( message )
+
+    def record( self, command, seconds ):
+        self.latencies.setdefault( command, [] ).append( seconds )
+
+    async def read( self, websocket ):
+        async for message in websocket:
+            now = time.perf_counter()
+            if isinstance( message, bytes ):
+                continue
+            name, _, body = message.partition( " " )
+            self.received_bytes.setdefault( name, [] ).append( len( message ) )
+
+            if name == 'queue_depth':
+                self.queue_depths.append( json.loads( body ) )
+                continue
+            self.replies += 1
+
+            if name == 'move_line_progress':
+                # only the head of the body is needed
+                sequence = int( body[ body.index( ':' ) + 1 : body.index( ',' ) ] )
+                if sequence in self.sent and sequence not in self.previewed:
+                    self.previewed.add( sequence )
+                    self.record( 'move-line preview', now - self.sent[ sequence ] )
+            elif name == 'move_line':
+                sequence = int( body[ body.index( ':' ) + 1 : body.index( ',' ) ] )
+                if sequence in self.sent:
+                    self.record( 'move-line', now - self.sent[ sequence ] )
+                    # the poses in between were replaced by this one
+                    self.move_lines_coalesced += sum( 1 for s in self.sent if self.last_final < s < sequence )
+                    self.last_final = sequence
+                    self.finals.set()
+            elif self.waiting is not None and name == self.waiting[0] and not self.waiting[1].done():
+                self.waiting[1].set_result( now )
+
+    async def wait_for_drag( self ):
+        '''
+        until the final reply of the last move-line sent
+        '''
+        while self.last_final < self.move_lines_sent:
+            self.finals.clear()
+            await asyncio.wait_for( self.finals.wait(), self.timeout )
+
+    async def sample_queue( self, websocket ):
+        while True:
+            await asyncio.sleep( self.queue_interval )
+            await websocket.send( "queue-depth" )
+
+    async def run( self, deadline ):
+        async with websockets.connect( self.url, max_size = None ) as websocket:
+            start = time.perf_counter()
+            await self.send( websocket, 'init {"progressive": true}' )
+            init = await websocket.recv()
+            self.record( 'init', time.perf_counter() - start )
+            self.received_bytes.setdefault( 'init', [] ).append( len( init ) )
+
+            reader = asyncio.ensure_future( self.read( websocket ) )
+            sampler = asyncio.ensure_future( self.sample_queue( websocket ) )
+            try:
+                while time.perf_counter() < deadline:
+                    for message in self.messages:
+                        if time.perf_counter() >= deadline:
+                            break
+                        await self.step( websocket, message )
+                await self.wait_for_drag()
+            except ( asyncio.TimeoutError, websockets.ConnectionClosed ) as error:
+                self.errors.append( repr( error ) )
+            finally:
+                sampler.cancel()
+                reader.cancel()
+
+    async def step( self, websocket, message ):
+        command = message.split( " ", 1 )[0]
+
+        if command == 'move-line':
+            self.move_lines_sent += 1
+            self.sent[ self.move_lines_sent ] = time.perf_counter()
+            await self.send( websocket, message )
+            await asyncio.sleep( 1. / self.drag_rate )
+            return
+
+        # the drag is over, its last pose is waited for
+        await self.wait_for_drag()
+
+        if command == 'stroke-append' or command == 'stroke-begin':
+            await self.send( websocket, message )
+            await asyncio.sleep( 1. / self.drag_rate )
+            return
+
+        reply = REPLIES.get( command )
+        start = time.perf_counter()
+        if reply is None:
+            await self.send( websocket, message )
+            return
+        self.waiting = ( reply, asyncio.get_event_loop().create_future() )
+        await self.send( websocket, message )
+        end = await asyncio.wait_for( self.waiting[1], self.timeout )
+        self.waiting = None
+        self.record( command, end - start )
+
+
+def drag_script( state, drag_poses = 30, seed = 0 ):
+    '''
+    replay.default_script with a longer drag
+    '''
+    state = dict( state )
+    state.setdefault( 'strokes', [] )
+    state.setdefault( 'stroke_points', [] )
+    return replay.default_script( state, drag_poses = drag_poses, seed = seed )
+
+
+def _stats( values, scale = 1. ):
+    values = scale * np.asarray( values, dtype = float )
+    s = { 'count': len( values ), 'mean': float( values.mean() ), 'max': float( values.max() ) }
+    for p in percentiles:
+        s[ 'p%d' % p ] = float( np.percentile( values, p ) )
+    return s
+
+
+def summarize( clients, seconds ):
+    merge = lambda attribute: { key: sum( ( getattr( client, attribute ).get( key, [] ) for client in clients ), [] )
+                                for key in set().union( *( getattr( client, attribute ) for client in clients ) ) }
+    depths = [ depth for client in clients for depth in client.queue_depths ]
+    summary = {
+        'clients': len( clients ),
+        'seconds': seconds,
+        'latency_ms': { command: _stats( values, 1000 ) for command, values in merge( 'latencies' ).items() },
+        'sent_bytes': { command: _stats( sizes ) for command, sizes in merge( 'sent_bytes' ).items() },
+        'received_bytes': { name: _stats( sizes ) for name, sizes in merge( 'received_bytes' ).items() },
+        'replies_per_second': sum( client.replies for client in clients ) / seconds,
+        'move_lines_sent': sum( client.move_lines_sent for client in clients ),
+        'move_lines_coalesced': sum( client.move_lines_coalesced for client in clients ),
+        'errors': [ error for client in clients for error in client.errors ],
+    }
+    if depths:
+        for key in ( 'pending', 'pending_total', 'waiting_solves' ):
+            summary[ 'queue_' + key ] = _stats( [ depth[key] for depth in depths ] )
+    return summary
+
+
+def print_summary( summary ):
+    print( '%d clients, %.1f s, %.1f replies/s, %d move-lines sent, %d coalesced' % (
+        summary['clients'], summary['seconds'], summary['replies_per_second'],
+        summary['move_lines_sent'], summary['move_lines_coalesced'] ) )
+    for command, s in sorted( summary['latency_ms'].items() ):
+        print( '    %-18s n %5d   p50 %8.1f   p90 %8.1f   p99 %8.1f   max %8.1f ms' % (
+            command, s['count'], s['p50'], s['p90'], s['p99'], s['max'] ) )
+    for name, s in sorted( summary['received_bytes'].items() ):
+        print( '    %-18s received %10.0f bytes mean, %10.0f max' % ( name, s['mean'], s['max'] ) )
+    for key in ( 'pending', 'pending_total', 'waiting_solves' ):
+        if 'queue_' + key in summary:
+            s = summary[ 'queue_' + key ]
+            print( '    queue %-14s mean %.2f   p90 %.0f   max %.0f' % ( key, s['mean'], s['p90'], s['max'] ) )
+    for error in summary['errors']:
+        print( '    error:', error )
+
+
+async def run( url, n_clients, duration, messages = None, drag_rate = 30., queue_interval = 0.25, stagger = 0.1 ):
+    '''
+    Given:
+        url: of the server, e.g. ws://127.0.0.1:8999
+        n_clients: simultaneous connections
+        duration: seconds of replay, the last drag is finished after it
+        messages: the session of every client, default drag_script of the server's model
+        drag_rate: move-line's ( and stroke-append's ) per second
+        queue_interval: seconds between two queue-depth's of a client
+        stagger: seconds between the starts of two clients
+    Return:
+        the summary, json serializable
+    '''
+    if messages is None:
+        async with websockets.connect( url, max_size = None ) as websocket:
+            await websocket.send( "init" )
+            state = json.loads( ( await websocket.recv() ).split( " ", 1 )[1] )
+        messages = drag_script( state )
+
+    clients = [ Client( url, messages, drag_rate, queue_interval ) for i in range( n_clients ) ]
+    start = time.perf_counter()
+
+    async def started( i, client ):
+        await asyncio.sleep( i * stagger )
+        await client.run( start + duration )
+
+    await asyncio.gather( *( started( i, client ) for i, client in enumerate( clients ) ) )
+    return summarize( clients, time.perf_counter() - start )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description = 'simulated headset clients against a running edit_server' )
+    parser.add_argument( '--url', default = 'ws://127.0.0.1:8999' )
+    parser.add_argument( '--clients', type = int, default = 4 )
+    parser.add_argument( '--duration', type = float, default = 30., help = 'seconds' )
+    parser.add_argument( '--session', help = 'a file of websocket text messages, one per line' )
+    parser.add_argument( '--drag-rate', type = float, default = 30., help = 'move-line messages per second' )
+    parser.add_argument( '--queue-interval', type = float, default = 0.25, help = 'seconds between queue-depth samples' )
+    parser.add_argument( '--output', help = 'json file for the results' )
+    args = parser.parse_args()
+
+    messages = None
+    if args.session:
+        messages = replay.read_script( args.session )
+
+    summary = asyncio.get_event_loop().run_until_complete(
+        run( args.url, args.clients, args.duration, messages, args.drag_rate, args.queue_interval ) )
+    print_summary( summary )
+    if args.output:
+        with open( args.output, 'w' ) as f:
+            json.dump( summary, f, indent = 1 )
+        print( 'Saved:', args.output )
@@ -0,0 +1,328 @@
+# replay benchmark
+#
+# Replays scripted websocket sessions on the models in Data/ without a websocket:
+# every text message goes through an edit_server.Session, as in the server, with its solves
+# on this thread, and its reply is serialized, so the latency is the server side of a message.
+#
+# For every model and command it reports latency percentiles, the IRLS outer and inner ( BFGS )
+# iterations of move-line, the batched curve BFGS iterations and the peak memory ( tracemalloc,
+# in a separate pass, the tracing slows everything down ), and writes them as json:
+#     python benchmarks/replay.py [--models cube truck ...] [--repeat 5] [--output results.json]
+# compare two results, e.g. of two commits:
+#     python benchmarks/replay.py --compare before.json after.json
+#
+# The default script of a model is a drag of one free line, a move-detail of a tick,
+# a detail-stroke, the same stroke streamed with stroke-begin / stroke-append / stroke-end,
+# and undo, undo, redo. --script replays a file of websocket text messages instead, one per line.
+
+import argparse
+import asyncio
+import contextlib
+import glob
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+import edit_server
+import fit_detail_stroke
+import history
+import reoptimize_curve
+import sketch_modify
+
+
+data_dir = os.path.join( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ), 'Data' )
+
+percentiles = ( 50, 90, 99 )
+
+
+def _xyz( p ):
+    return { 'x': float( p[0] ), 'y': float( p[1] ), 'z': float( p[2] ) }
+
+
+def default_script( state, drag_poses = 5, stroke_samples = 300, seed = 0 ):
+    '''
+    Given:
+        state: a model
+        drag_poses: move-line messages of the drag
+        stroke_samples: raw points of the stroke
+        seed: of the random choices
+    Return:
+        the websocket text messages of a short editing session on state
+    '''
+    rng = np.random.default_rng( seed )
+    positions = sketch_modify.all_points_positions( state['points'] )
+    size = np.linalg.norm( positions.max( axis = 0 ) - positions.min( axis = 0 ) )
+    messages = []
+
+    ## a drag: the end of a free line moves a little further every pose
+    free = [ i for i, line in enumerate( state['lines'] ) if line[-1] == 'free' ]
+    if free:
+        index = free[ rng.integers( len( free ) ) ]
+        start, end = positions[ state['lines'][index][0] ], positions[ state['lines'][index][1] ]
+        step = rng.normal( size = 3 )
+        step *= 0.01 * size / np.linalg.norm( step )
+        for k in range( 1, drag_poses + 1 ):
+            items = [ { 'index': index, 'start': _xyz( start ), 'end': _xyz( end + k * step ) } ]
+            messages.append( 'move-line ' + json.dumps( { 'Items': items } ) )
+
+    ## a tick slides along its line
+    ticks = [ i for i, point in enumerate( state['points'] ) if point[-1] == 'tick' ]
+    if ticks:
+        index = ticks[ rng.integers( len( ticks ) ) ]
+        t = state['points'][index][0]
+        t = t + 0.05 if t < 0.5 else t - 0.05
+        messages.append( 'move-detail ' + json.dumps( { 'Items': [ { 'index': index, 't': t } ] } ) )
+
+    ## a wavy stroke between two vertices, sent at once and streamed
+    vertices = [ i for i, point in enumerate( state['points'] ) if point[-1] == 'vertex' ]
+    a, b = rng.choice( vertices, 2, replace = False )
+    t = np.linspace( 0, 1, stroke_samples )[:, None]
+    wave = rng.normal( size = 3 )
+    wave *= 0.05 * size / np.linalg.norm( wave )
+    stroke = positions[a] + ( positions[b] - positions[a] ) * t + np.sin( 3 * np.pi * t ) * wave
+    points = [ _xyz( p ) for p in stroke ]
+    messages.append( 'detail-stroke ' + json.dumps( { 'scale': 1, 'points': points } ) )
+
+    messages.append( 'stroke-begin ' + json.dumps( { 'scale': 1 } ) )
+    for i in range( 0, len( points ), 10 ):
+        messages.append( 'stroke-append ' + json.dumps( { 'points': points[ i : i + 10 ] } ) )
+    messages.append( 'stroke-end' )
+
+    messages.extend( [ 'undo', 'undo', 'redo' ] )
+    return messages
+
+
+def handle( session, message, loop ):
+    '''
+    What edit_server's move_server does with message, with session an edit_server.Session
+    whose server runs the solves on this thread.
+    Return:
+        command, and a dictionary of measurements:
+            latency: seconds until the reply is serialized and sent, reply: seconds of that serialization
+            irls: the IRLSSolver stats of a move-line
+            curve_iterations: batched curve BFGS iterations
+    '''
+    curve_iterations = reoptimize_curve.bfgs_iterations
+    measurement = {}
+    session.reply_seconds = None
+    start = time.perf_counter()
+
+    if loop.run_until_complete( session.respond_now( message ) ):
+        command = message
+    else:
+        request = session.parse( message )
+        command = request['command']
+        loop.run_until_complete( session.handle( request ) )
+        if command == "move-line":
+            measurement['irls'] = dict( session.solver.stats )
+
+    measurement['latency'] = time.perf_counter() - start
+    if session.reply_seconds is not None:
+        measurement['reply'] = session.reply_seconds
+    measurement['curve_iterations'] = reoptimize_curve.bfgs_iterations - curve_iterations
+    return command, measurement
+
+
+def read_script( path ):
+    '''
+    Return:
+        the websocket text messages of a file, one per line, without edit_server.unrecorded_commands
+        ( a recording of an older server has them )
+    '''
+    with open( path ) as f:
+        messages = [ line.strip() for line in f if line.strip() ]
+    return [ message for message in messages if message.split( " ", 1 )[0] not in edit_server.unrecorded_commands ]
+
+
+def clear_caches():
+    '''
+    forgets the curve magnitudes and stroke fitting contexts of a previous replay
+    '''
+    reoptimize_curve.magnitude_cache.clear()
+    fit_detail_stroke._contexts.clear()
+
+
+def replay( state, messages, trace_memory = False ):
+    '''
+    Given:
+        state: a model, it is not modified
+        messages: websocket text messages
+        trace_memory: measure the tracemalloc peak of every message
+    Return:
+        ( command, measurement ) for every message, see handle
+    '''
+    clear_caches()
+    loop = asyncio.new_event_loop()
+    server = edit_server.Server( history.checkout( history.snapshot( state ) ) )
+
+    async def send( message ):
+        # the reply is serialized, nothing receives it
+        pass
+
+    session = edit_server.Session( server, send )
+    results = []
+    try:
+        # the solvers print their progress
+        with contextlib.redirect_stdout( io.StringIO() ):
+            for message in messages:
+                if trace_memory:
+                    tracemalloc.reset_peak()
+                    before = tracemalloc.get_traced_memory()[0]
+                command, measurement = handle( session, message, loop )
+                if trace_memory:
+                    measurement['peak_bytes'] = tracemalloc.get_traced_memory()[1] - before
+                results.append( ( command, measurement ) )
+    finally:
+        loop.close()
+    return results
+
+
+def summarize( runs, traced ):
+    '''
+    Given:
+        runs: the results of replay, for every repetition
+        traced: the results of the traced replay
+    Return:
+        dictionary command -> statistics
+    '''
+    commands = {}
+    for results in runs:
+        for command, measurement in results:
+            commands.setdefault( command, [] ).append( measurement )
+
+    summary = {}
+    for command, measurements in commands.items():
+        latency = 1000 * np.array( [ m['latency'] for m in measurements ] )
+        s = { 'count': len( measurements ), 'mean_ms': latency.mean(), 'max_ms': latency.max() }
+        for p in percentiles:
+            s[ 'p%d_ms' % p ] = np.percentile( latency, p )
+        if any( 'reply' in m for m in measurements ):
+            s['reply_mean_ms'] = 1000 * np.mean( [ m['reply'] for m in measurements if 'reply' in m ] )
+        s['curve_iterations_mean'] = np.mean( [ m['curve_iterations'] for m in measurements ] )
+        irls = [ m['irls'] for m in measurements if 'irls' in m ]
+        if irls:
+            for key in ( 'outer_iterations', 'inner_iterations', 'function_evaluations' ):
+                s[ 'irls_%s_mean' % key ] = np.mean( [ stats[key] for stats in irls ] )
+                s[ 'irls_%s_max' % key ] = int( max( stats[key] for stats in irls ) )
+            s['irls_converged'] = np.mean( [ stats['converged'] for stats in irls ] )
+        peaks = [ m['peak_bytes'] for c, m in traced if c == command ]
+        if peaks:
+            s['peak_bytes'] = int( max( peaks ) )
+        summary[ command ] = { key: float( value ) if isinstance( value, np.floating ) else value for key, value in s.items() }
+    return summary
+
+
+def git_commit():
+    try:
+        return subprocess.run( [ 'git', 'rev-parse', '--short', 'HEAD' ], capture_output = True, text = True,
+                               cwd = os.path.dirname( os.path.abspath( __file__ ) ) ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def model_files( names = None ):
+    '''
+    the Data/*.json files whose name contains one of names, all of them if names is empty
+    '''
+    files = sorted( glob.glob( os.path.join( data_dir, '*.json' ) ) )
+    if names:
+        files = [ f for f in files if any( name in os.path.basename( f ) for name in names ) ]
+    return files
+
+
+def run_benchmark( files, repeat = 3, script = None, seed = 0 ):
+    '''
+    Given:
+        files: model json files
+        repeat: timed replays of every script
+        script: websocket text messages for every model, default_script if None
+    Return:
+        the results, json serializable
+    '''
+    results = { 'commit': git_commit(), 'time': time.strftime( '%Y-%m-%d %H:%M:%S' ),
+                'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+                'repeat': repeat, 'models': {} }
+
+    # everything in this process, as with curve_workers = 0
+    reoptimize_curve.stop_pool()
+
+    for path in files:
+        name = os.path.splitext( os.path.basename( path ) )[0]
+        state = json.load( open( path ) )
+        state.setdefault( 'strokes', [] )
+        state.setdefault( 'stroke_points', [] )
+        messages = script if script is not None else default_script( state, seed = seed )
+
+        runs = [ replay( state, messages ) for i in range( repeat ) ]
+        tracemalloc.start()
+        try:
+            traced = replay( state, messages, trace_memory = True )
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        results['models'][ name ] = { 'messages': len( messages ), 'peak_bytes': peak, 'commands': summarize( runs, traced ) }
+        print_model( name, results['models'][ name ] )
+    return results
+
+
+def print_model( name, model ):
+    print( '%s ( %d messages, peak %.1f MB )' % ( name, model['messages'], model['peak_bytes'] / 2 ** 20 ) )
+    for command, s in model['commands'].items():
+        line = '    %-14s n %3d   p50 %8.2f   p90 %8.2f   p99 %8.2f   max %8.2f ms' % (
+            command, s['count'], s['p50_ms'], s['p90_ms'], s['p99_ms'], s['max_ms'] )
+        if 'irls_outer_iterations_mean' in s:
+            line += '   irls %.1f outer, %.1f bfgs' % ( s['irls_outer_iterations_mean'], s['irls_inner_iterations_mean'] )
+        if s['curve_iterations_mean']:
+            line += '   curves %.1f bfgs' % s['curve_iterations_mean']
+        print( line )
+
+
+def compare( before, after, key = 'p50_ms' ):
+    '''
+    prints after / before of key for every model and command in both results
+    '''
+    print( 'before %s, after %s, %s' % ( before.get( 'commit' ), after.get( 'commit' ), key ) )
+    for name, model in after['models'].items():
+        if name not in before['models']:
+            continue
+        for command, s in model['commands'].items():
+            old = before['models'][ name ]['commands'].get( command )
+            if old is None or key not in old or key not in s:
+                continue
+            ratio = s[key] / old[key] if old[key] else float( 'nan' )
+            print( '    %-24s %-14s %10.2f -> %10.2f   x%.2f' % ( name, command, old[key], s[key], ratio ) )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description = 'replay scripted sessions on the Data models' )
+    parser.add_argument( '--models', nargs = '*', help = 'parts of model file names, e.g. cube truck ( default all )' )
+    parser.add_argument( '--repeat', type = int, default = 3, help = 'timed replays per model' )
+    parser.add_argument( '--script', help = 'a file of websocket text messages, one per line, instead of the default script' )
+    parser.add_argument( '--seed', type = int, default = 0, help = 'of the default script' )
+    parser.add_argument( '--output', help = 'json file for the results' )
+    parser.add_argument( '--compare', nargs = 2, metavar = ( 'BEFORE', 'AFTER' ), help = 'compare two result files and exit' )
+    args = parser.parse_args()
+
+    if args.compare:
+        compare( *( json.load( open( path ) ) for path in args.compare ) )
+        sys.exit( 0 )
+
+    script = None
+    if args.script:
+        script = read_script( args.script )
+
+    results = run_benchmark( model_files( args.models ), repeat = args.repeat, script = script, seed = args.seed )
+    if args.output:
+        with open( args.output, 'w' ) as f:
+            json.dump( results, f, indent = 1 )
+        print( 'Saved:', args.output )
@@ -0,0 +1,186 @@
+# scaling benchmark
+#
+# Times the three stages of the server on synthetic scaffolds ( see synthetic_scaffold.py )
+# of growing size and plots latency and peak memory against the number of lines:
+#     move_line               one line of the first box moved, IRLS with edit_server's iteration limit
+#                             but without its time budget, which would hide the growth
+#     optimize_curves         all curves reoptimized, with an empty magnitude cache
+#     stroke_data_to_weights  one stroke across the first box, with no stroke fitting context cached
+# The memory is the tracemalloc peak of a separate run, the tracing slows everything down.
+# A stage whose run took longer than --max-seconds is not run at the larger sizes.
+#
+#     python benchmarks/scaling.py [--sizes 10 30 100 ...] [--output scaling.json] [--plot scaling.png]
+#
+# The slope of log latency over log lines between the two largest sizes is printed
+# for every stage, about the exponent of its complexity.
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+import edit_server
+import fit_detail_stroke
+import history
+import irls_solver
+import reoptimize_curve
+import sketch_modify
+
+import synthetic_scaffold
+
+
+default_sizes = ( 10, 30, 100, 300, 1000, 3000, 10000 )
+
+
+def move_line( state ):
+    v0, v1 = state['lines'][0][:2]
+    start, end = np.asarray( state['points'][v0][:3] ), np.asarray( state['points'][v1][:3] )
+    end = end + np.array( [ 0.05, 0.02, 0. ] )
+    xyz = lambda p: { 'x': p[0], 'y': p[1], 'z': p[2] }
+    input_data = { 'Items': [ { 'index': 0, 'start': xyz( start.tolist() ), 'end': xyz( end.tolist() ) } ] }
+    solver = irls_solver.IRLSSolver( max_iterations = edit_server.irls_max_iterations )
+    sketch_modify.move_line( input_data, state, solver )
+    return { 'irls_outer_iterations': solver.stats['outer_iterations'], 'irls_inner_iterations': solver.stats['inner_iterations'] }
+
+
+def optimize_curves( state ):
+    reoptimize_curve.magnitude_cache.clear()
+    iterations = reoptimize_curve.bfgs_iterations
+    sketch_modify.optimize_curves( state, list( range( len( state['points'] ) ) ) )
+    return { 'curve_iterations': reoptimize_curve.bfgs_iterations - iterations }
+
+
+def stroke_data_to_weights( state ):
+    fit_detail_stroke._contexts.clear()
+    fit_detail_stroke.stroke_data_to_weights( { 'scale': 1, 'points': synthetic_scaffold.stroke_points( state, 0 ) }, state )
+    return { 'control_points': len( state['strokes'][-1]['weights'] ) }
+
+
+STAGES = {
+    'move_line': move_line,
+    'optimize_curves': optimize_curves,
+    'stroke_data_to_weights': stroke_data_to_weights,
+}
+
+
+def measure( stage, state, trace_memory = False ):
+    '''
+    Given:
+        stage: a function of STAGES
+        state: it is not modified, the stage runs on a copy
+        trace_memory: measure the tracemalloc peak
+    Return:
+        seconds, peak bytes ( None without trace_memory ), the stage's own counts
+    '''
+    state = history.checkout( history.snapshot( state ) )
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        # the solvers print their progress
+        with contextlib.redirect_stdout( io.StringIO() ):
+            start = time.perf_counter()
+            counts = stage( state )
+            seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    return seconds, peak, counts
+
+
+def run_scaling( sizes = default_sizes, stages = None, max_seconds = 60., seed = 0 ):
+    '''
+    Return:
+        the results, json serializable: for every stage a list of
+        { 'lines', 'points', 'curves', 'seconds', 'peak_bytes', ... } by size
+    '''
+    stages = stages or list( STAGES )
+    results = { 'sizes': list( sizes ), 'max_seconds': max_seconds, 'stages': { name: [] for name in stages } }
+    stopped = set()
+
+    # everything in this process, as with curve_workers = 0
+    reoptimize_curve.stop_pool()
+
+    for size in sizes:
+        state = synthetic_scaffold.scaffold( size, seed = seed )
+        shape = { 'lines': len( state['lines'] ), 'points': len( state['points'] ), 'curves': len( state['curves'] ) }
+        for name in stages:
+            if name in stopped:
+                continue
+            seconds, _, counts = measure( STAGES[ name ], state )
+            peak = None
+            if seconds <= max_seconds:
+                peak = measure( STAGES[ name ], state, trace_memory = True )[1]
+            else:
+                stopped.add( name )
+            results['stages'][ name ].append( dict( shape, seconds = seconds, peak_bytes = peak, **counts ) )
+            print( '%-24s %6d lines   %10.3f s   %s' % ( name, shape['lines'], seconds,
+                   '-' if peak is None else '%.1f MB' % ( peak / 2 ** 20 ) ), flush = True )
+    return results
+
+
+def slopes( results ):
+    '''
+    d log seconds / d log lines between the two largest sizes of every stage
+    '''
+    slope = {}
+    for name, rows in results['stages'].items():
+        if len( rows ) >= 2:
+            a, b = rows[-2], rows[-1]
+            slope[ name ] = np.log( b['seconds'] / a['seconds'] ) / np.log( b['lines'] / a['lines'] )
+    return slope
+
+
+def plot( results, path ):
+    import matplotlib
+    matplotlib.use( 'Agg' )
+    import matplotlib.pyplot as plt
+
+    figure, ( latency, memory ) = plt.subplots( 1, 2, figsize = ( 12, 5 ) )
+    for name, rows in results['stages'].items():
+        lines = [ row['lines'] for row in rows ]
+        latency.loglog( lines, [ row['seconds'] for row in rows ], 'o-', label = name )
+        traced = [ row for row in rows if row['peak_bytes'] is not None ]
+        memory.loglog( [ row['lines'] for row in traced ], [ row['peak_bytes'] / 2 ** 20 for row in traced ], 'o-', label = name )
+
+    latency.set_xlabel( 'lines' )
+    latency.set_ylabel( 'seconds' )
+    latency.set_title( 'latency' )
+    memory.set_xlabel( 'lines' )
+    memory.set_ylabel( 'MB' )
+    memory.set_title( 'peak memory ( tracemalloc )' )
+    for axes in ( latency, memory ):
+        axes.grid( True, which = 'both', alpha = 0.3 )
+        axes.legend()
+    figure.tight_layout()
+    figure.savefig( path )
+    plt.close( figure )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description = 'latency and memory of the server stages against the scaffold size' )
+    parser.add_argument( '--sizes', type = int, nargs = '*', default = list( default_sizes ), help = 'numbers of lines' )
+    parser.add_argument( '--stages', nargs = '*', choices = list( STAGES ), help = 'default all' )
+    parser.add_argument( '--max-seconds', type = float, default = 60., help = 'larger sizes are skipped for a stage slower than this' )
+    parser.add_argument( '--seed', type = int, default = 0 )
+    parser.add_argument( '--output', default = 'scaling.json', help = 'json file for the results' )
+    parser.add_argument( '--plot', default = 'scaling.png', help = 'image file for the plots' )
+    args = parser.parse_args()
+
+    results = run_scaling( args.sizes, args.stages, args.max_seconds, args.seed )
+    for name, slope in slopes( results ).items():
+        print( '%-24s latency ~ lines^%.2f' % ( name, slope ) )
+
+    with open( args.output, 'w' ) as f:
+        json.dump( results, f, indent = 1 )
+    print( 'Saved:', args.output )
+    plot( results, args.plot )
+    print( 'Saved:', args.plot )
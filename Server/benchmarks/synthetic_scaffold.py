@@ -0,0 +1,127 @@
+# synthetic scaffolds of any size
+#
+# The models in Data/ have at most a few dozen lines. `scaffold` builds a state with the
+# same structure at a given number of lines, from a grid of boxes of random sizes:
+#
+#     every box: 8 vertices and its 12 edges as free lines,
+#                ticks at the middle of 3 edges, a constrained line between two of them,
+#                a curve of 2 key points and a curve of 3 key points, their tangents along box edges
+#     every `stroke_every` boxes: a detail stroke fitted with fit_detail_stroke ( optional )
+#
+# so a box has 11 points, 13 lines and 2 curves. The boxes differ in size, so the curves do not share
+# their shape ( reoptimize_curve.magnitude_cache would solve all of them once otherwise ).
+# state['box_vertices'] has the index of the first vertex of every box.
+#     python benchmarks/synthetic_scaffold.py lines [output.json] [--strokes k] [--seed s]
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+import fit_detail_stroke
+
+
+lines_per_box = 13
+
+# vertices of the unit box, and its edges
+_corners = np.array( [ [0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0],
+                       [0, 0, 1], [1, 0, 1], [1, 1, 1], [0, 1, 1] ], dtype = float )
+_edges = [ ( 0, 1 ), ( 1, 2 ), ( 2, 3 ), ( 3, 0 ),
+           ( 4, 5 ), ( 5, 6 ), ( 6, 7 ), ( 7, 4 ),
+           ( 0, 4 ), ( 1, 5 ), ( 2, 6 ), ( 3, 7 ) ]
+
+
+def _edge( a, b ):
+    return _edges.index( ( a, b ) )
+
+
+def scaffold( n_lines, strokes = 0, seed = 0, spacing = 1.5 ):
+    '''
+    Given:
+        n_lines: about the number of lines, rounded up to whole boxes
+        strokes: number of detail strokes, fitted on the finished scaffold
+        seed: of the box sizes and the strokes
+        spacing: distance between the box origins
+    Return:
+        a state, as loaded by edit_server
+    '''
+    rng = np.random.default_rng( seed )
+    n_boxes = max( 1, int( np.ceil( n_lines / lines_per_box ) ) )
+    side = int( np.ceil( n_boxes ** ( 1. / 3 ) ) )
+
+    state = { 'points': [], 'lines': [], 'curves': [], 'strokes': [], 'stroke_points': [], 'box_vertices': [] }
+    points, lines, curves = state['points'], state['lines'], state['curves']
+
+    for box in range( n_boxes ):
+        origin = spacing * np.array( [ box % side, ( box // side ) % side, box // ( side * side ) ], dtype = float )
+        size = rng.uniform( 0.5, 1.0, 3 )
+
+        v = len( points )
+        state['box_vertices'].append( v )
+        for corner in _corners:
+            points.append( ( origin + corner * size ).tolist() + [ 'vertex' ] )
+
+        l = len( lines )
+        for a, b in _edges:
+            lines.append( [ v + a, v + b, 'free' ] )
+
+        ## ticks in the middle of the front bottom, back bottom and front top edges
+        t = len( points )
+        for a, b in ( ( 0, 1 ), ( 3, 2 ), ( 4, 5 ) ):
+            points.append( [ 0.5, v + a, v + b, 'tick' ] )
+        lines.append( [ t, t + 1, 'constrained' ] )
+
+        ## an arc from the front bottom to the front top tick, bulging along y,
+        ## and one from a corner through the back bottom tick to the opposite corner
+        curves.append( { 'points': [ t, t + 2 ],
+                         'tangents': [ [ [ l + _edge( 1, 2 ), 1.0 ] ], [ [ l + _edge( 5, 6 ), -1.0 ] ] ],
+                         'magnitudes': [ size[2] / 3, size[2] / 3 ],
+                         'type': 'curve' } )
+        curves.append( { 'points': [ v + 0, t + 1, v + 6 ],
+                         'tangents': [ [ [ l + _edge( 3, 0 ), -1.0 ] ], [ [ l + _edge( 0, 1 ), 1.0 ] ], [ [ l + _edge( 2, 6 ), 1.0 ] ] ],
+                         'magnitudes': [ size[1] / 3, size[1] / 3, size[2] / 3, size[2] / 3 ],
+                         'type': 'curve' } )
+
+    for i in range( strokes ):
+        box = rng.integers( n_boxes )
+        fit_detail_stroke.stroke_data_to_weights( { 'scale': 1, 'points': stroke_points( state, box, rng ) }, state )
+
+    return state
+
+
+def stroke_points( state, box, rng = None, samples = 200 ):
+    '''
+    Given:
+        state: from scaffold
+        box: index of a box, see state['box_vertices']
+        rng: for the wave of the stroke
+    Return:
+        raw points of a wavy stroke across the front face of box, as in a detail-stroke message
+    '''
+    rng = rng or np.random.default_rng( 0 )
+    v = state['box_vertices'][ box ]
+    start = np.asarray( state['points'][ v + 0 ][:3] )
+    end = np.asarray( state['points'][ v + 5 ][:3] )
+    t = np.linspace( 0, 1, samples )[:, None]
+    wave = np.array( [ 0., -1., 0. ] ) * rng.uniform( 0.02, 0.1 )
+    stroke = start + ( end - start ) * t + np.sin( 2 * np.pi * t ) * wave
+    return [ { 'x': x, 'y': y, 'z': z } for x, y, z in stroke.tolist() ]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description = 'write a synthetic scaffold' )
+    parser.add_argument( 'lines', type = int, help = 'about the number of lines' )
+    parser.add_argument( 'output', nargs = '?', help = 'json file, default Data/synthetic_<lines>.json' )
+    parser.add_argument( '--strokes', type = int, default = 0 )
+    parser.add_argument( '--seed', type = int, default = 0 )
+    args = parser.parse_args()
+
+    state = scaffold( args.lines, strokes = args.strokes, seed = args.seed )
+    output = args.output or os.path.join( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ), 'Data', 'synthetic_%d.json' % args.lines )
+    with open( output, 'w' ) as f:
+        json.dump( state, f )
+    print( 'Saved:', output, len( state['points'] ), 'points', len( state['lines'] ), 'lines', len( state['curves'] ), 'curves' )
@@ -0,0 +1,81 @@
+# batched stroke weights against the single control point solvers
+#
+# fit_detail_stroke.l1_weights ( the weights of Q_to_P_W ) must return the weights q_to_P_weight returns
+# for every control point, with any backend of l1_backends. For every model in Data/ with enough free points,
+# random control points near the faces of its free points are solved both ways:
+#     python benchmarks/weights_check.py [--models cube truck ...] [--backend cvxopt] [--count 20] [--tolerance 0.001]
+# a control point fails when a weight differs by more than --tolerance.
+
+import argparse
+import glob
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+import fit_detail_stroke
+
+data_dir = os.path.join( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ), 'Data' )
+
+
+def control_points( free_points, count, rng ):
+    '''
+    count homogeneous points, each a random convex combination of 2 to 5 free points, moved by about 2 mm
+    '''
+    Q = []
+    for i in range( count ):
+        chosen = rng.choice( len( free_points ), size = min( len( free_points ), rng.integers( 2, 6 ) ), replace = False )
+        q = rng.dirichlet( np.ones( len( chosen ) ) ) @ free_points[ chosen ] + rng.normal( 0, 0.002, 3 )
+        Q.append( np.append( q, 1. ) )
+    return np.asarray( Q )
+
+
+def compare_model( state, backend, count, rng ):
+    '''
+    Return:
+        for every control point: largest weight difference, or None for a model with fewer than 4 free points
+    '''
+    free_points = np.asarray( fit_detail_stroke.extract_free_points_from_state( state ), dtype = float )
+    if len( free_points ) < 4:
+        return None
+    context = fit_detail_stroke.StrokeFittingContext( free_points )
+    Q = control_points( free_points, count, rng )
+
+    W, converged = fit_detail_stroke.l1_weights( Q, context.P, context = context )
+    single = np.asarray( [ fit_detail_stroke.q_to_P_weight( q, context.P.T, backend ) for q in Q ] )
+    return np.abs( W - single ).max( axis = 1 )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description = 'compare l1_weights with q_to_P_weight on the Data models' )
+    parser.add_argument( '--models', nargs = '*', help = 'parts of model file names, e.g. cube truck ( default all )' )
+    parser.add_argument( '--backend', default = 'cvxopt', help = 'of q_to_P_weight, a name in l1_backends.BACKENDS' )
+    parser.add_argument( '--count', type = int, default = 20, help = 'control points per model' )
+    parser.add_argument( '--tolerance', type = float, default = 0.001 )
+    parser.add_argument( '--seed', type = int, default = 0 )
+    args = parser.parse_args()
+
+    rng = np.random.default_rng( args.seed )
+    failed = total = 0
+    worst = 0.
+    files = sorted( glob.glob( os.path.join( data_dir, '*.json' ) ) )
+    if args.models:
+        files = [ f for f in files if any( name in os.path.basename( f ) for name in args.models ) ]
+    for path in files:
+        with open( path ) as f:
+            state = json.load( f )
+        differences = compare_model( state, args.backend, args.count, rng )
+        if differences is None:
+            continue
+        bad = differences > args.tolerance
+        total += len( differences )
+        failed += bad.sum()
+        worst = max( worst, differences.max() )
+        print( '%-28s %3d control points, %d differ, largest weight difference %.1e' % (
+            os.path.basename( path ), len( differences ), bad.sum(), differences.max() ) )
+
+    print( '%d of %d control points differ from %s, largest weight difference %.2e' % ( failed, total, args.backend, worst ) )
+    sys.exit( 1 if failed else 0 )
@@ -0,0 +1,258 @@
+# batched constraint energies for the line optimizer
+#
+# sketch_modify.optimize_line used to rebuild every line and loop in python
+# over every constraint pair for each energy evaluation.
+# Here the constraint pairs are stored as integer index arrays per constraint type
+# and all pair energies are computed at once over an (n_lines, 2, 3) endpoint array.
+# The gradients are closed form, so BFGS no longer needs finite differences.
+
+import numpy as np
+
+
+CONSTRAINT_TYPES = ( 'equal_length', 'parallel', 'perpendicular' )
+
+# scipy.optimize.minimize methods which use the Hessian-vector product
+HESSP_METHODS = ( 'trust-ncg', 'trust-krylov', 'Newton-CG' )
+
+
+def minimize_options( method, tolerance = 0.000001, maxiter = 1000 ):
+    '''
+    Return:
+        the options of scipy.optimize.minimize for method, with the tolerance under the name
+        the method knows: Newton-CG stops on the step ( xtol ), the others on the gradient ( gtol )
+    '''
+    options = { 'disp': False, 'maxiter': maxiter }
+    if method == 'Newton-CG':
+        options['xtol'] = tolerance
+    elif method not in ( 'Nelder-Mead', 'Powell', 'COBYLA', 'SLSQP', 'TNC' ):
+        options['gtol'] = tolerance
+    return options
+
+
+def pairs_to_arrays( pairs ):
+    '''
+    Given:
+        pairs: an iterable of (i, j) line index pairs
+    Return:
+        pairs as a sorted ( n_pairs, 2 ) integer array
+    '''
+    pairs = sorted( pairs )
+    if len( pairs ) == 0:
+        return np.zeros( ( 0, 2 ), dtype = int )
+    return np.asarray( pairs, dtype = int ).reshape( -1, 2 )
+
+
+def pair_values( lines, pairs ):
+    '''
+    Given:
+        lines: ( n_lines, 2, 3 ) array of line endpoints
+        pairs: dictionary constraint type -> ( n_pairs, 2 ) index array
+    Return:
+        dictionary constraint type -> ( n_pairs, ) array of the per-pair energies,
+        the same values as length_length_ratio2, line_line_parallel2 and line_line_perpendicular2
+    '''
+    vectors = lines[:, 1] - lines[:, 0]
+    lengths = np.sqrt( ( vectors ** 2 ).sum( 1 ) )
+
+    # lines without any constraint may be degenerate, they are never indexed below
+    with np.errstate( divide = 'ignore', invalid = 'ignore' ):
+        directions = vectors / lengths[:, None]
+
+    values = {}
+
+    I, J = pairs['equal_length'].T
+    values['equal_length'] = ( lengths[I] / lengths[J] - 1 ) ** 2
+
+    I, J = pairs['parallel'].T
+    values['parallel'] = ( 1 - np.abs( ( directions[I] * directions[J] ).sum( 1 ) ) ) ** 2
+
+    I, J = pairs['perpendicular'].T
+    values['perpendicular'] = ( ( directions[I] * directions[J] ).sum( 1 ) ) ** 2
+
+    return values
+
+
+def pair_gradients( lines, pairs, weights ):
+    '''
+    Given:
+        lines: ( n_lines, 2, 3 ) array of line endpoints
+        pairs: dictionary constraint type -> ( n_pairs, 2 ) index array
+        weights: dictionary constraint type -> ( n_pairs, ) array
+    Return:
+        the gradient of the weighted energy with respect to the line vectors ( end - start ),
+        an ( n_lines, 3 ) array
+
+    For a line vector v with length L and direction d = v / L:
+        dL/dv = d
+        d(d . e)/dv = ( e - (d . e) d ) / L
+    '''
+    vectors = lines[:, 1] - lines[:, 0]
+    lengths = np.sqrt( ( vectors ** 2 ).sum( 1 ) )
+
+    with np.errstate( divide = 'ignore', invalid = 'ignore' ):
+        directions = vectors / lengths[:, None]
+
+    grad = np.zeros( vectors.shape )
+
+    # ( L_i / L_j - 1 ) ** 2
+    I, J = pairs['equal_length'].T
+    ratio = lengths[I] / lengths[J]
+    dratio = 2 * weights['equal_length'] * ( ratio - 1 )
+    np.add.at( grad, I, ( dratio / lengths[J] )[:, None] * directions[I] )
+    np.add.at( grad, J, ( -dratio * ratio / lengths[J] )[:, None] * directions[J] )
+
+    # ( 1 - | d_i . d_j | ) ** 2 and ( d_i . d_j ) ** 2 only differ in dE/dc
+    for constraint_type in ( 'parallel', 'perpendicular' ):
+        I, J = pairs[constraint_type].T
+        c = ( directions[I] * directions[J] ).sum( 1 )
+        if constraint_type == 'parallel':
+            dc = -2 * weights[constraint_type] * ( 1 - np.abs( c ) ) * np.sign( c )
+        else:
+            dc = 2 * weights[constraint_type] * c
+        np.add.at( grad, I, ( dc / lengths[I] )[:, None] * ( directions[J] - c[:, None] * directions[I] ) )
+        np.add.at( grad, J, ( dc / lengths[J] )[:, None] * ( directions[I] - c[:, None] * directions[J] ) )
+
+    return grad
+
+
+class ConstraintEnergy:
+    '''
+    The weighted constraint energy of optimize_line as a function of the packed vertex vector X.
+
+    Points not in live_vertex_indices keep their positions from `points`.
+    Like unpack, when a point appears several times in live_vertex_indices
+    the last occurrence in X wins, the earlier copies get a zero gradient.
+    A live tick point moves freely in X, ticks which are not live keep their
+    lerped positions, so every line endpoint is either a slot of X or a constant.
+    '''
+
+    def __init__( self, points, linesData, live_vertex_indices, constraints, weights = None ):
+        '''
+        Given:
+            points: point positions, one ( x, y, z ) per point
+            linesData: state['lines']
+            live_vertex_indices: the point indices packed into X
+            constraints: dictionary constraint type -> set of (i, j) line pairs
+            weights: dictionary constraint type -> { (i, j): weight }, or None for all ones
+        '''
+
+        self.base_points = np.array( points, dtype = float ).reshape( -1, 3 )
+        self.line_ends = np.asarray( [ line[:2] for line in linesData ], dtype = int ).reshape( -1, 2 )
+
+        self.live_vertex_indices = list( live_vertex_indices )
+
+        # the last slot of X for every live point
+        last_slot = {}
+        for slot, point_index in enumerate( live_vertex_indices ):
+            last_slot[ point_index ] = slot
+        self.live_rows = np.asarray( list( last_slot.keys() ), dtype = int )
+        self.live_slots = np.asarray( list( last_slot.values() ), dtype = int )
+        self.n_slots = len( live_vertex_indices )
+
+        self.pairs = {}
+        for constraint_type in CONSTRAINT_TYPES:
+            self.pairs[constraint_type] = pairs_to_arrays( constraints.get( constraint_type, () ) )
+
+        self.set_weights( weights )
+
+    def set_weights( self, weights = None ):
+        '''
+        Given:
+            weights: dictionary constraint type -> { (i, j): weight }, or None for all ones
+        '''
+        self.weights = {}
+        for constraint_type in CONSTRAINT_TYPES:
+            pairs = self.pairs[constraint_type]
+            if weights is None:
+                self.weights[constraint_type] = np.ones( len( pairs ) )
+            else:
+                w = weights[constraint_type]
+                self.weights[constraint_type] = np.asarray( [ w[ ( i, j ) ] for i, j in pairs.tolist() ], dtype = float )
+
+    def pack( self ):
+        '''
+        X of the initial points, like sketch_modify.pack
+        '''
+        return self.base_points[ self.live_vertex_indices ].ravel()
+
+    def unpack( self, X, points ):
+        '''
+        put X back into the list of point positions, like sketch_modify.unpack
+        '''
+        for slot, point_index in enumerate( self.live_vertex_indices ):
+            points[point_index] = X[slot*3 : (slot+1)*3].tolist()
+        return points
+
+    def positions( self, X ):
+        '''
+        all point positions as an ( n_points, 3 ) array with the live points taken from X
+        '''
+        P = self.base_points.copy()
+        P[ self.live_rows ] = np.asarray( X, dtype = float ).reshape( -1, 3 )[ self.live_slots ]
+        return P
+
+    def lines( self, X ):
+        '''
+        all line endpoints as an ( n_lines, 2, 3 ) array
+        '''
+        return self.positions( X )[ self.line_ends ]
+
+    def pair_values( self, X ):
+        '''
+        dictionary constraint type -> unweighted per-pair energies
+        '''
+        return pair_values( self.lines( X ), self.pairs )
+
+    def energy( self, X ):
+        '''
+        the weighted sum of all constraint energies
+        '''
+        values = self.pair_values( X )
+        e = 0.
+        for constraint_type in CONSTRAINT_TYPES:
+            e += np.dot( self.weights[constraint_type], values[constraint_type] )
+        return e
+
+    __call__ = energy
+
+    def gradient( self, X ):
+        '''
+        the gradient of energy with respect to X
+        '''
+        return self.value_and_gradient( X )[1]
+
+    def value_and_gradient( self, X ):
+        '''
+        energy and its gradient with respect to X, for minimize( ..., jac = True )
+        '''
+        lines = self.lines( X )
+        values = pair_values( lines, self.pairs )
+        e = 0.
+        for constraint_type in CONSTRAINT_TYPES:
+            e += np.dot( self.weights[constraint_type], values[constraint_type] )
+
+        line_grad = pair_gradients( lines, self.pairs, self.weights )
+
+        # the line vector is end - start
+        point_grad = np.zeros( self.base_points.shape )
+        np.add.at( point_grad, self.line_ends[:, 1], line_grad )
+        np.add.at( point_grad, self.line_ends[:, 0], -line_grad )
+
+        grad = np.zeros( ( self.n_slots, 3 ) )
+        grad[ self.live_slots ] = point_grad[ self.live_rows ]
+
+        return e, grad.ravel()
+
+    def hessp( self, X, p, h = 1e-6 ):
+        '''
+        Hessian of energy at X times the vector p,
+        a central difference of the analytic gradient along p.
+        For minimize( ..., method = 'trust-ncg' ) or 'Newton-CG'.
+        '''
+        p = np.asarray( p, dtype = float )
+        p_norm = np.linalg.norm( p )
+        if p_norm == 0:
+            return np.zeros( len( p ) )
+
+        step = h * max( 1., np.linalg.norm( X ) ) / p_norm
+        return ( self.gradient( X + step * p ) - self.gradient( X - step * p ) ) / ( 2 * step )
@@ -0,0 +1,144 @@
+# spatial/angular index for constraint detection
+#
+# calculate_constraints and find_new_constraints compared every free line with every other free line.
+# Here line directions are bucketed on a grid over the unit sphere and line lengths are sorted in log space,
+# so the parallel, perpendicular and equal length candidates of a line are found without a scan over all lines.
+# The candidates are a superset, the callers still test them against the thresholds.
+
+import numpy as np
+
+
+class ConstraintIndex:
+    '''
+    Index of line directions and lengths.
+
+    Directions are unit vectors bucketed into cubic cells of the grid over [-1, 1]^3.
+    Parallel candidates of d are in the cells around d and around -d ( antipodal symmetry ),
+    perpendicular candidates are in the cells close to the great circle orthogonal to d.
+    Lengths are kept sorted by log length, equal length candidates are a window of that order.
+    '''
+
+    def __init__( self, lines, line_indices, thresholds ):
+        '''
+        Given:
+            lines: line endpoints [ [p0, p1], ... ] for all lines
+            line_indices: the lines to index, e.g. the free lines
+            thresholds: sketch_modify.thresholds
+        '''
+
+        # the largest |cos| of a parallel pair is 1 - sqrt( threshold ), as a chord between unit vectors
+        parallel_cos = 1 - np.sqrt( thresholds['line_line_parallel2'] )
+        self.parallel_chord = np.sqrt( 2 - 2 * parallel_cos ) * ( 1 + 1e-6 ) + 1e-12
+        self.perpendicular_cos = np.sqrt( thresholds['line_line_perpendicular2'] ) * ( 1 + 1e-6 ) + 1e-12
+        ratio = np.sqrt( thresholds['line_length_ratio2'] )
+        self.log_length_window = max( -np.log( 1 - ratio ), np.log( 1 + ratio ) ) * ( 1 + 1e-6 ) + 1e-12
+
+        # a cell is as large as the parallel chord, so all parallel candidates are in the 27 cells around
+        self.cell_size = self.parallel_chord
+        self.cell_radius = self.cell_size * np.sqrt( 3 ) / 2
+
+        n_lines = len( lines )
+        self.directions = np.zeros( ( n_lines, 3 ) )
+        self.lengths = np.zeros( n_lines )
+        self.indexed = np.zeros( n_lines, dtype = bool )
+
+        self.line_cell = {}
+        self.cells = {}
+        self._cell_keys = None
+        self._length_order = None
+
+        self.update( lines, line_indices )
+
+    def cell_of( self, direction ):
+        return tuple( np.floor( np.asarray( direction ) / self.cell_size ).astype( int ).tolist() )
+
+    def update( self, lines, line_indices ):
+        '''
+        (re)index only the given lines, e.g. the lines which moved
+        '''
+        line_indices = list( line_indices )
+        if len( line_indices ) == 0:
+            return
+
+        ends = np.asarray( [ lines[i] for i in line_indices ], dtype = float ).reshape( -1, 2, 3 )
+        # the same direction as dir( end, start ) in sketch_modify
+        vectors = ends[:, 0] - ends[:, 1]
+        lengths = np.sqrt( ( vectors ** 2 ).sum( 1 ) )
+        with np.errstate( divide = 'ignore', invalid = 'ignore' ):
+            directions = vectors / lengths[:, None]
+
+        self.directions[ line_indices ] = directions
+        self.lengths[ line_indices ] = lengths
+        self.indexed[ line_indices ] = True
+
+        for i, direction in zip( line_indices, directions ):
+            old_cell = self.line_cell.get( i )
+            # a degenerate line has no direction and can not be parallel or perpendicular
+            cell = self.cell_of( direction ) if np.all( np.isfinite( direction ) ) else None
+            if old_cell == cell:
+                continue
+            if old_cell is not None:
+                self.cells[old_cell].discard( i )
+                if len( self.cells[old_cell] ) == 0:
+                    del self.cells[old_cell]
+                    self._cell_keys = None
+            if cell is not None:
+                if cell not in self.cells:
+                    self.cells[cell] = set()
+                    self._cell_keys = None
+                self.cells[cell].add( i )
+            self.line_cell[i] = cell
+
+        self._length_order = None
+
+    def _cells_around( self, direction ):
+        result = set()
+        cx, cy, cz = self.cell_of( direction )
+        for dx in ( -1, 0, 1 ):
+            for dy in ( -1, 0, 1 ):
+                for dz in ( -1, 0, 1 ):
+                    result |= self.cells.get( ( cx + dx, cy + dy, cz + dz ), set() )
+        return result
+
+    def parallel_candidates( self, direction ):
+        '''
+        indexed lines which may be parallel to the unit vector `direction`
+        '''
+        direction = np.asarray( direction )
+        return self._cells_around( direction ) | self._cells_around( -direction )
+
+    def perpendicular_candidates( self, direction ):
+        '''
+        indexed lines which may be perpendicular to the unit vector `direction`
+        '''
+        if self._cell_keys is None:
+            self._cell_keys = list( self.cells.keys() )
+            self._cell_centers = ( np.asarray( self._cell_keys, dtype = float ).reshape( -1, 3 ) + 0.5 ) * self.cell_size
+
+        # every direction in a cell is within cell_radius of the cell center
+        near = np.abs( self._cell_centers @ np.asarray( direction ) ) < self.perpendicular_cos + self.cell_radius
+
+        result = set()
+        for k in np.flatnonzero( near ):
+            result |= self.cells[ self._cell_keys[k] ]
+        return result
+
+    def equal_length_candidates( self, length ):
+        '''
+        indexed lines whose length may be equal to `length`
+        '''
+        if self._length_order is None:
+            indexed = np.flatnonzero( self.indexed )
+            with np.errstate( divide = 'ignore' ):
+                log_lengths = np.log( self.lengths[ indexed ] )
+            order = np.argsort( log_lengths )
+            self._length_order = indexed[ order ]
+            self._sorted_log_lengths = log_lengths[ order ]
+
+        if not length > 0:
+            return set()
+
+        log_length = np.log( length )
+        lo = np.searchsorted( self._sorted_log_lengths, log_length - self.log_length_window, side = 'left' )
+        hi = np.searchsorted( self._sorted_log_lengths, log_length + self.log_length_window, side = 'right' )
+        return set( self._length_order[ lo:hi ].tolist() )
@@ -6,25 +6,56 @@ import sys
 
 import pathlib
 import os
+import concurrent.futures
+import collections
+import time
 from datetime import datetime
 from time import strftime
 
+import numpy as np
+
 import sketch_modify
-from copy import deepcopy
+import reoptimize_curve
 
 import fit_detail_stroke
+import irls_solver
+import state_delta
+import wire_format
+import history
+import session_log
+import tracing
+
+# IRLS limits for one move-line, so a drag in VR keeps a fixed latency
+irls_max_iterations = 50
+irls_time_budget = 0.5 # seconds
+
+# progress frames per second of a move-line in progressive mode, see move_server
+progress_rate = 10
+
+# processes for reoptimizing curves, None for one per core, 0 to reoptimize in the server process
+curve_workers = None
+
+# memory kept for undo/redo, the oldest versions are dropped beyond it ( the session log keeps everything )
+history_max_bytes = 1024 ** 3
 
-def export( state_sequence, basename ):
+# write the text messages of every connection to a file next to its session log, one per line,
+# a recorded session for benchmarks/replay.py --script and benchmarks/load_test.py --session
+record_messages = False
+# commands which are not recorded: the connection's own setup and monitoring, not editing
+unrecorded_commands = ( 'init', 'ack', 'resync', 'queue-depth', 'stats' )
+
+# serve the tracing metrics in the Prometheus text format at http://127.0.0.1:metrics_port/metrics, None for no endpoint
+metrics_port = None
+
+def output_path( basename, extension = ".json" ):
     '''
     Given:
-        state_sequence: All history states.
         basename: filename
+        extension: e.g. ".json" or ".jsonl"
 
-    Saves the given sequence of states to the file `~/Desktop/VR_MoveScaffold_output/filename.json`
+    Return:
+        the path `~/Desktop/VR_MoveScaffold_output/filename.extension`, creating the folder if needed
     '''
-    
-    ## 1. Create the output location if not exist
-    ## 2. Save the state_sequence to file 
 
     # https://stackoverflow.com/questions/34275782/how-to-get-desktop-location
     desktop = pathlib.Path.home() / 'Desktop'
@@ -34,10 +65,19 @@ def export( state_sequence, basename ):
     if not output_dir.exists():
         output_dir.mkdir()
 
-    # save json file
-    json_file = os.path.join( output_dir, basename + ".json")
-    with open(json_file, "w") as f:
-        json.dump( state_sequence, f )
+    return os.path.join( output_dir, basename + extension )
+
+def close_log( log, json_file ):
+    '''
+    Given:
+        log: the SessionLog of a connection
+        json_file: path
+
+    Closes the log and saves all its history states to json_file, as one json list
+    '''
+    with tracing.span( 'export' ):
+        log.close()
+        session_log.compact( log.path, json_file )
 
     print( "Saved:", json_file )
 
@@ -55,12 +95,386 @@ def get_ip():
     return IP
 
 
-def run( load_file  ):
+class Server:
+    '''
+    What the connections of one server share: the state, and the thread its solves run on.
+    '''
+
+    def __init__( self, state, solver_pool = None ):
+        '''
+        Given:
+            state: the model, with 'strokes' and 'stroke_points'
+            solver_pool: executor of the solves, None to run them on the event loop's thread ( benchmarks/replay.py )
+        '''
+        self.state = state
+
+        # move-line, move-detail and detail-stroke run on solver_pool, so the event loop
+        # keeps serving the other connections ( and the websocket pings ) during a solve.
+        # A thread rather than a process: the warm start of the IRLS solver stays in memory
+        # and the state only needs a copy, not pickling. numpy and scipy release the GIL
+        # in their heavy parts.
+        self.solver_pool = solver_pool
+        # one solve at a time over all connections, in the order the messages arrived
+        self.solver_lock = asyncio.Lock()
+
+        self.connections = 0
+        # the messages waiting in every connection, and the solves waiting for solver_lock, see `queue-depth`
+        self.queues = {}
+        self.waiting_solves = 0
+
+    async def run_in_solver( self, function, *args ):
+        if self.solver_pool is None:
+            return function( *args )
+        return await asyncio.get_event_loop().run_in_executor( self.solver_pool, function, *args )
+
+
+class Session:
+    '''
+    One connection: its undo history, session log, IRLS solver and reply modes,
+    and what every message does to the server's state, see handle.
+    edit_server's move_server drives one per websocket, benchmarks/replay.py one per replay.
+    '''
+
+    def __init__( self, server, send, log = None ):
+        '''
+        Given:
+            server: the Server
+            send: coroutine function sending a message ( text or binary ) to the client
+            log: the session_log.SessionLog of the connection, or None
+        '''
+        self.server = server
+        self.send = send
+
+        # undo/redo and all history states, sharing the unchanged parts between versions
+        self.history = history.History( server.state, max_bytes = history_max_bytes )
+
+        # every saved state goes to an append-only log, see session_log.py
+        self.log = log
+        if log is not None:
+            log.record( "init", self.history.current() )
+
+        # warm starts consecutive move-line solves of a drag
+        self.solver = irls_solver.IRLSSolver( max_iterations = irls_max_iterations, time_budget = irls_time_budget )
+
+        # `init {"delta": true}` switches this connection to delta replies, see state_delta.py
+        self.delta_mode = False
+        self.tracker = state_delta.DeltaTracker()
+
+        # `init {"binary": true}` switches this connection to binary replies, see wire_format.py
+        self.binary_mode = False
+
+        # `init {"progressive": true, "progress_rate": frames per second}` streams a move-line:
+        #     move_line_progress {"sequence": s, "stage": "preview", "points": [ [index, row], ... ]}
+        #         right away, the moved rows of state['points'] before the optimization ( the curves are not updated )
+        #     move_line_progress {"sequence": s, "stage": "iterate", "points": ...}
+        #         IRLS iterates, at most progress_rate per second
+        #     move_line with "sequence": s added to the reply
+        #         the final state
+        # s increases with every move-line received, the client drops frames older than the latest it has shown.
+        # In binary mode the progress frames have arrays 'indices' and 'points' ( the first 3 entries of the rows )
+        # and the sequence and stage in the metadata.
+        self.progressive_mode = False
+        self.frame_rate = progress_rate
+        self.sequence = 0
+
+        # a detail stroke sent while it is drawn, instead of one detail-stroke:
+        #     stroke-begin {"scale": s}
+        #     stroke-append {"points": [ {x, y, z}, ... ]}     the new raw points, any number of times
+        #     stroke-end {"points": [ ... ]}                    the last points ( optional ), replies detail_stroke
+        #                                                       ( the unchanged state without a stroke in progress )
+        # the stroke is refitted as it grows, see fit_detail_stroke.StreamingStroke
+        self.stroke = None
+
+        # Drag coalescing:
+        # messages are received as they come and wait in `pending` while a solve runs.
+        # A move-line replaces a move-line of the same drag which is still waiting,
+        # and cancels a running one ( at the next IRLS outer iteration ) when nothing else is waiting,
+        # so the next reply is for the latest pose, see enqueue.
+        self.pending = collections.deque()
+        self.pending_changed = asyncio.Event()
+        self.running_drag = None
+
+        # the drag whose last pose is the current undo entry, its next pose amends it.
+        # `drag-end` ( optional ) makes the next move a new undo entry even for the same lines.
+        self.undo_drag = None
+
+        # seconds the last reply took to serialize
+        self.reply_seconds = None
+
+    @property
+    def state( self ):
+        return self.server.state
+
+    @state.setter
+    def state( self, state ):
+        self.server.state = state
+
+    async def reply( self, name, tags = None ):
+        tags = tags or {}
+        state = self.state
+        start = time.perf_counter()
+        with tracing.span( 'reply.serialize' ):
+            if self.binary_mode:
+                arrays, metadata = wire_format.encode_state( state )
+                metadata.update( tags )
+                message = wire_format.encode_message( name, arrays, metadata )
+            elif self.delta_mode:
+                message = name + " " + json.dumps( dict( self.tracker.delta( state ), **tags ) )
+            elif tags:
+                message = name + " " + json.dumps( dict( tags, state = state ) )
+            else:
+                message = name + " " + json.dumps( state )
+        self.reply_seconds = time.perf_counter() - start
+        tracing.observe( 'reply.bytes', len( message ) )
+        with tracing.span( 'reply.send' ):
+            await self.send( message )
+
+    def progress_frame( self, request, stage, rows ):
+        tags = { 'sequence': request['sequence'], 'stage': stage }
+        if self.binary_mode:
+            indices = sorted( rows )
+            arrays = { 'indices': np.asarray( indices, dtype = np.int32 ),
+                       'points': np.asarray( [ rows[i][:3] for i in indices ], dtype = np.float64 ).reshape( -1, 3 ) }
+            return wire_format.encode_message( "move_line_progress", arrays, tags )
+        return "move_line_progress " + json.dumps( dict( tags, points = [ [ i, row ] for i, row in sorted( rows.items() ) ] ) )
+
+    def progress_sender( self, request ):
+        '''
+        the `progress` of sketch_modify.move_line for request, it runs on the solver thread
+        '''
+        loop = asyncio.get_event_loop()
+        # the preview was just sent
+        last_frame = [ time.perf_counter() ]
+
+        def progress( stage, rows ):
+            now = time.perf_counter()
+            if now - last_frame[0] < 1. / self.frame_rate:
+                return
+            last_frame[0] = now
+            asyncio.run_coroutine_threadsafe( self.send( self.progress_frame( request, stage, rows ) ), loop )
+
+        return progress
+
+    async def solve( self, function, input_data ):
+        '''
+        Runs function( input_data, state ) on the server's solver thread.
+        It works on a copy of the state, which replaces the state when it is done,
+        so replies to other connections never see a half updated state.
+        Return:
+            False if the solve was cancelled, the state is unchanged then
+        '''
+        server = self.server
+        server.waiting_solves += 1
+        waiting = time.perf_counter()
+        async with server.solver_lock:
+            server.waiting_solves -= 1
+            tracing.record( 'solver.wait', time.perf_counter() - waiting )
+            working_state = history.checkout( self.state )
+            try:
+                await server.run_in_solver( function, input_data, working_state )
+            except irls_solver.Cancelled:
+                return False
+            self.state = working_state
+            return True
+
+    def save_state_for_undo( self, command, amend = False ):
+        self.history.save( self.state, amend = amend )
+        if self.log is not None:
+            self.log.record( command, self.history.current(), amend = amend )
+
+    def undo( self ):
+        previous_state = self.history.undo()
+        if previous_state is not None:
+            self.state = previous_state
+            if self.log is not None:
+                self.log.record_undo( self.history.undo_stack[-1] )
+
+    def redo( self ):
+        next_state = self.history.redo()
+        if next_state is not None:
+            self.state = next_state
+            if self.log is not None:
+                self.log.record_redo( self.history.undo_stack[-1] )
+
+    async def respond_now( self, message ):
+        '''
+        Answers the messages which do not wait behind the others:
+            queue-depth    the messages waiting in this connection and all of them, and the solves waiting
+            stats          tracing.stats()
+        Return:
+            True if message was one of them
+        '''
+        server = self.server
+        if message == "queue-depth":
+            await self.send( "queue_depth " + json.dumps( {
+                'pending': len( self.pending ),
+                'pending_total': sum( len( queue ) for queue in server.queues.values() ),
+                'waiting_solves': server.waiting_solves,
+                'connections': len( server.queues ) } ) )
+            return True
+        if message == "stats":
+            await self.send( "stats " + json.dumps( tracing.stats() ) )
+            return True
+        return False
+
+    def parse( self, message ):
+        '''
+        Given:
+            message: text "command parameters" or a binary frame
+        Return:
+            dictionary with the command, its parameters ( text ), input_data ( parsed ) and the time it was received
+        '''
+        received = time.perf_counter()
+        if wire_format.is_binary( message ):
+            command, arrays, metadata = wire_format.decode_message( message )
+            request = { 'command': command, 'parameters': None,
+                        'input_data': wire_format.decode_input( command, arrays, metadata ) }
+        else:
+            parsed = message.split( " ", 1 )
+            command = parsed[0]
+            parameters = None if len( parsed ) == 1 else parsed[1]
+            request = { 'command': command, 'parameters': parameters, 'input_data': None }
+            if command in ( "detail-stroke", "move-line", "move-detail" ):
+                request['input_data'] = json.loads( parameters )
+            elif command in ( "stroke-begin", "stroke-append", "stroke-end" ):
+                request['input_data'] = {} if parameters is None else json.loads( parameters )
+        request['received'] = received
+
+        # the lines a move-line drags, consecutive moves of the same lines are one drag
+        if command == "move-line":
+            request['drag'] = tuple( sorted( item['index'] for item in request['input_data']['Items'] ) )
+            self.sequence += 1
+            request['sequence'] = self.sequence
+        return request
+
+    def enqueue( self, request ):
+        '''
+        adds request to pending, coalescing the poses of a drag
+        '''
+        pending = self.pending
+        if request['command'] == "move-line":
+            if len( pending ) and pending[-1]['command'] == "move-line" and pending[-1]['drag'] == request['drag']:
+                pending.pop()
+            if len( pending ) == 0 and self.running_drag == request['drag']:
+                self.solver.cancel()
+        pending.append( request )
+        self.pending_changed.set()
+
+    async def handle( self, request ):
+        command = request['command']
+        parameters = request['parameters']
+        input_data = request['input_data']
+
+        if command not in ( "init", "ack", "resync", "move-line" ):
+            self.undo_drag = None
+
+        if command == "init":
+            options = {} if parameters is None else json.loads( parameters )
+            self.delta_mode = bool( options.get( 'delta', False ) )
+            self.binary_mode = bool( options.get( 'binary', False ) )
+            self.progressive_mode = bool( options.get( 'progressive', False ) )
+            self.frame_rate = float( options.get( 'progress_rate', progress_rate ) )
+            # progress frames are 1 / frame_rate seconds apart
+            if not self.frame_rate > 0:
+                print( 'init: progress_rate must be positive, not', options['progress_rate'], '- using', progress_rate )
+                self.frame_rate = progress_rate
+            if self.binary_mode:
+                await self.send( wire_format.encode_message( "init", *wire_format.encode_state( self.state ) ) )
+            elif self.delta_mode:
+                await self.send( "init " + json.dumps( self.tracker.full( self.state ) ) )
+            else:
+                await self.send( "init " + json.dumps( self.state )  )
+        elif command == "ack":
+            # the client applied this version, later deltas are relative to it
+            self.tracker.ack( int( parameters ) )
+        elif command == "resync":
+            await self.send( "resync " + json.dumps( self.tracker.full( self.state ) ) )
+        elif command == "detail-stroke":
+            await self.solve( fit_detail_stroke.stroke_data_to_weights, input_data )
+            self.save_state_for_undo( command )
+            await self.reply( "detail_stroke" )
+        elif command in ( "stroke-begin", "stroke-append" ):
+            if command == "stroke-begin" or self.stroke is None:
+                context = await self.server.run_in_solver( fit_detail_stroke.fitting_context, self.state )
+                self.stroke = fit_detail_stroke.StreamingStroke( context, input_data.get( 'scale' ) )
+            if len( input_data.get( 'points', [] ) ):
+                self.stroke.append( input_data['points'] )
+            # the refit only reads the stroke, it runs on the solver thread between the solves
+            # and is skipped while more points are waiting
+            if not any( waiting is not None and waiting['command'] == "stroke-append" for waiting in self.pending ):
+                await self.server.run_in_solver( self.stroke.refit )
+        elif command == "stroke-end":
+            if self.stroke is None:
+                # nothing was drawn ( or the stroke ended before ), the client still waits for its reply
+                await self.reply( "detail_stroke" )
+                return
+            finished, self.stroke = self.stroke, None
+            await self.solve( finished.finish, input_data )
+            self.save_state_for_undo( command )
+            await self.reply( "detail_stroke" )
+        elif command == "move-line":
+#           import time
+#           start = time.time()
+            self.solver.clear_cancel()
+            self.running_drag = request['drag']
+            solver = self.solver
+            try:
+                progress = None
+                if self.progressive_mode:
+                    # the preview goes out before the solve waits for the solver thread
+                    await self.send( self.progress_frame( request, 'preview', sketch_modify.move_line_preview( input_data, self.state ) ) )
+                    progress = self.progress_sender( request )
+                solved = await self.solve( lambda input_data, state: sketch_modify.move_line(input_data, state, solver, progress), input_data )
+            finally:
+                self.running_drag = None
+#           end = time.time()
+#           print('elapsed', end  - start )
+            if not solved:
+                # superseded by a newer pose, which is waiting in pending
+                print('move-line cancelled')
+                return
+            self.save_state_for_undo( command, amend = self.undo_drag == request['drag'] )
+            self.undo_drag = request['drag']
+            print('move-line ')
+            # print(state)
+            await self.reply( "move_line", { 'sequence': request['sequence'] } if self.progressive_mode else None )
+        elif command == "move-detail":
+            # print('parameters', parameters)
+            # print('input_data', input_data)
+            print('move-detail ')
+            await self.solve( sketch_modify.move_detail, input_data )
+            self.save_state_for_undo( command )
+            await self.reply( "move_detail" )
+        elif command == "undo":
+            self.undo()
+            self.solver.reset()
+            await self.reply( "undo" )
+        elif command == "redo":
+            self.redo()
+            self.solver.reset()
+            await self.reply( "redo" )
+
+
+def run( load_file, basename = None ):
+    '''
+    Given:
+        load_file: the json model to serve
+        basename: suffix of the output file names, default the time the server starts
+    '''
 
     ## 1. load file contents, when init received -> send to front end
     ## 2. whenever move-line, send the data to optimize and send back 
     ## 3. auto saves, with the 
 
+    # create with the name when load the server
+    if basename is None:
+        now = datetime.today()
+        basename = now.strftime("_%Y_%m_%d_%H_%M_%S") + ( "_%d_%s" % ( now.microsecond / 1000, strftime( "%Z" ) ) )
+
+    # start the curve workers before anything else, see reoptimize_curve.start_pool
+    if curve_workers != 0:
+        reoptimize_curve.start_pool( curve_workers )
+
     state = json.load(open(load_file)) # dict
     print(state.keys())
 
@@ -70,102 +484,74 @@ def run( load_file  ):
         state['stroke_points'] = []
     print(state.keys())
 
+    server = Server( state, concurrent.futures.ThreadPoolExecutor( max_workers = 1 ) )
 
     async def move_server(websocket, path):
-        
-        undo_buffer = [ deepcopy( state ) ]
-        redo_buffer = []
-        
-        # I can even have all undo and redo history in here
-        all_history_states = [ deepcopy( state ) ]
-
-
-        def save_state_for_undo():
-            all_history_states.append( deepcopy(state) )
-            undo_buffer.append( deepcopy( state ) )
-            del redo_buffer[:]
-
-        def undo():
-            # https://stackoverflow.com/questions/1281184/why-cant-i-set-a-global-variable-in-python
-            nonlocal state
-            if len(undo_buffer) > 1:
-                # pop last saved state
-                redo_buffer.append( undo_buffer.pop() )
-                state = deepcopy( undo_buffer[-1] )
-                    
-        def redo():
-            nonlocal state
-            if len(redo_buffer) >= 1:
-                state = deepcopy( redo_buffer[-1] )
-                undo_buffer.append( redo_buffer.pop() )
-
-
-        async for message in websocket:
-            # print("server received: " + message)
-            
-            parsed = message.split( " ", 1 )
-            command = parsed[0]
-
-            parameters = None if len( parsed ) == 1 else parsed[1]
-                
-            if command == "init":
-                await websocket.send( "init " + json.dumps( state )  )
-            elif command == "detail-stroke":
-                input_data = json.loads( parameters )
-                fit_detail_stroke.stroke_data_to_weights( input_data, state )
-                save_state_for_undo()
-                await websocket.send("detail_stroke " + json.dumps( state )) 
-            elif command == "move-line":
-                input_data = json.loads( parameters )
-#               import time
-#               start = time.time()
-                sketch_modify.move_line(input_data, state)
-#               end = time.time()
-#               print('elapsed', end  - start )
-                save_state_for_undo()
-                print('move-line ')
-                # print(state)
-                await websocket.send("move_line " + json.dumps( state ) ) 
-            elif command == "move-detail":
-                input_data = json.loads( parameters )
-                # print('parameters', parameters)
-                # print('input_data', input_data)
-                print('move-detail ')
-                sketch_modify.move_detail( input_data, state )
-                save_state_for_undo()
-                await websocket.send("move_detail " + json.dumps( state ) )
-            elif command == "undo":
-                undo()
-                await websocket.send("undo " + json.dumps(state ) )
-            elif command == "redo":
-                redo()
-                await websocket.send("redo " + json.dumps( state ) )
-
-            export( all_history_states,  pathlib.Path(load_file).stem  + basename )
-
+        server.connections += 1
+        log_name = pathlib.Path(load_file).stem + basename + ( "" if server.connections == 1 else "_%d" % server.connections )
+        session = Session( server, websocket.send, session_log.SessionLog( output_path( log_name, ".jsonl" ) ) )
+        server.queues[ log_name ] = session.pending
+
+        recording = open( output_path( log_name + "_messages", ".txt" ), 'a' ) if record_messages else None
+
+        async def receive():
+            try:
+                async for message in websocket:
+                    if recording is not None and not wire_format.is_binary( message ) \
+                       and message.split( " ", 1 )[0] not in unrecorded_commands:
+                        recording.write( message.replace( "\n", " " ) + "\n" )
+                    # answered right away, not after the waiting messages
+                    if await session.respond_now( message ):
+                        continue
+                    session.enqueue( session.parse( message ) )
+            finally:
+                session.pending.append( None )
+                session.pending_changed.set()
+
+        receiver = asyncio.ensure_future( receive() )
+        try:
+            while True:
+                if len( session.pending ) == 0:
+                    session.pending_changed.clear()
+                    await session.pending_changed.wait()
+                    continue
+                request = session.pending.popleft()
+                if request is None:
+                    break
+                await session.handle( request )
+                # from the receipt, the time waiting behind other messages included
+                tracing.record( 'command.' + request['command'], time.perf_counter() - request['received'] )
+
+        finally:
+            receiver.cancel()
+            del server.queues[ log_name ]
+            if recording is not None:
+                recording.close()
+            # the log has everything, write the old single json layout once at the end
+            json_file = output_path( log_name )
+            await asyncio.get_event_loop().run_in_executor( None, close_log, session.log, json_file )
 
     start_server = websockets.serve(move_server, None, 8999)
 
 
     asyncio.get_event_loop().run_until_complete( start_server )
+    if metrics_port is not None:
+        asyncio.get_event_loop().run_until_complete( tracing.start_http_server( metrics_port ) )
+        print( 'Metrics at http://127.0.0.1:{}/metrics'.format( metrics_port ) )
     asyncio.get_event_loop().run_forever()
 
 
 
 
-url = get_ip()
-print('Serving at http://{}:8999'.format(url))
-
-# create with the name when load the server
-now = datetime.today()
-basename = now.strftime("_%Y_%m_%d_%H_%M_%S") + ( "_%d_%s" % ( now.microsecond / 1000, strftime( "%Z" ) ) )
-
-
+# the curve worker processes import this module, they must not start a server
+if __name__ == '__main__':
+    url = get_ip()
+    print('Serving at http://{}:8999'.format(url))
 
-load_file = 'Data/A1_cube_move.json'
-if len(sys.argv) == 2:
-    load_file = sys.argv[1]
-run( load_file )
+    load_file = 'Data/A1_cube_move.json'
+    if len(sys.argv) == 2:
+        load_file = sys.argv[1]
+    run( load_file )
 # # modify to load other files
 # jsonText = json.load(open('jsonFile02.json'))
 # print(type(jsonText))
@@ -1,16 +1,19 @@
+import collections
+
 import numpy as np
 from scipy import interpolate
 
 
-from l1regls import l1regls
-import cvxopt
+import l1_backends
+import tracing
 
 
 ## Helpers
-def resample( points, inc = 0.01 ):
+def resample( points, inc = 0.01, d = None ):
     '''
     Given: 
         points: [P0, P1, ..., Pn-1] raw points
+        d: the arc length at every point, computed here if None
     Returns:
         resampled points, 0.01 cm per point
     '''
@@ -19,10 +22,11 @@ def resample( points, inc = 0.01 ):
     n_points, dim = points.shape
 
     # Parametrization parameter s.
-    dp = np.diff(points, axis=0)                 # difference between points
-    dp = np.linalg.norm(dp, axis=1)              # distance between points
-    d = np.cumsum(dp)                            # cumsum along the segments
-    d = np.hstack([[0],d])                       # add distance from first point
+    if d is None:
+        dp = np.diff(points, axis=0)             # difference between points
+        dp = np.linalg.norm(dp, axis=1)          # distance between points
+        d = np.cumsum(dp)                        # cumsum along the segments
+        d = np.hstack([[0],d])                   # add distance from first point
     length = d[-1]                               # length of point sequence
     num = int(length/inc) +1                     # number of samples
     s = np.linspace(0,length,num)                # sample parameter and step
@@ -48,12 +52,23 @@ def extract_free_points_from_state( state ):
             points.append( [x, y, z])
     return points
 
-def q_to_P_weight( q , P ):
+# solver of the single control point problems, see l1_backends.py
+l1_backend = 'homotopy'
+
+# weights_ridge * || w ||^2 added to the weights problem ( see Batched weights ):
+# without it the optimum is a face for most scaffolds, and every solver returns another point of it
+weights_ridge = 0.001
+
+def q_to_P_weight( q , P, backend = None ):
     '''
     P : 4 * n
     q : 4 * 1
+    backend: a name in l1_backends.BACKENDS, default l1_backend
 
     return : n * 1 or n
+
+    The ridge term is sqrt( weights_ridge ) * diag( 1 / ds ) appended to A ( and 0 to b ),
+    so the backends solve the problem of l1_weights.
     '''
     q = np.asarray( q )
     q = q.reshape(-1, 1)
@@ -64,23 +79,156 @@ def q_to_P_weight( q , P ):
 
     ds = np.linalg.norm( q - P, ord = 1, axis = 0)
     ds = ds / ds.sum()
-    diagD = np.eye( P.shape[1] ) * 1 / ds
 
-    A = P @ diagD
+    # A = P @ diag( 1 / ds )
+    A = P / ds
+    A = np.vstack( ( 1000 * A, np.diag( np.sqrt( weights_ridge ) / ds ) ) )
+    b = np.concatenate( ( 1000 * q.ravel(), np.zeros( P.shape[1] ) ) )
 
-    A_mat = cvxopt.matrix( A )
-    b_mat = cvxopt.matrix( q )
+    w_arr = l1_backends.solve( A, b, backend or l1_backend )
 
-    W = l1regls( 1000 * A_mat , 1000 * b_mat)
-
-    w_arr = np.array( W )
     w_arr = w_arr.reshape( P.shape[1] )
     w_arr = w_arr / ds 
 
     return w_arr.squeeze() 
 
 
-def Q_to_P_W( Q, P ):
+## Batched weights
+#
+# q_to_P_weight solves, for one control point q,
+#     minimize || 1000 * P * diag( 1 / ds ) * x - 1000 * q ||^2 + || x ||_1 + weights_ridge * || x / ds ||^2,    w = x / ds
+# which in w is
+#     minimize 1e6 * || P w - q ||^2 + ds' * | w | + weights_ridge * || w ||^2
+# All control points of a stroke share P ( 4 * n ), only q and ds differ.
+# l1_weights solves all of them at once with the primal dual interior point method
+# cvxopt.solvers.coneqp uses, with w = w+ - w-, w+ >= 0, w- >= 0, which has the same central path.
+# The ridge is weights_ridge * ( || w+ ||^2 + || w- ||^2 ), the same at the optimum where one of them is 0,
+# and diagonal, so every Newton step reduces to one 4 * 4 system per control point,
+#     ( P * diag( w+ / ( s+ + 2 ridge w+ ) + w- / ( s- + 2 ridge w- ) ) * P' + I / 2e6 ) dy = rhs
+# and the columns move in lockstep until each one converged.
+#
+# Without the ridge the problem is degenerate for most scaffolds ( the optimum is a face, e.g. for
+# symmetric vertices ), and two solvers agree on the objective but not on the weights.
+# The ridge makes the optimum unique, close to the point of the face with the smallest weights.
+batched_weights = True
+weights_max_iterations = 50
+weights_tolerance = 1e-9
+
+def _max_step( v, dv ):
+    '''
+    largest step a per row, up to 1, such that v + a * dv >= 0
+    '''
+    ratio = np.full( v.shape, np.inf )
+    np.divide( -v, dv, out = ratio, where = dv < 0 )
+    return np.minimum( 1., ratio.min( axis = 1 ) )
+
+def l1_weights( Q, P, max_iterations = None, tolerance = None, context = None ):
+    '''
+    Given:
+        Q: m * 4 control points ( homogeneous )
+        P: n * 4 free points ( homogeneous )
+        max_iterations, tolerance: of the interior point method, default weights_max_iterations, weights_tolerance
+        context: StrokeFittingContext of P, whose precomputed matrices are used
+    Return:
+        W: m * n array, the weights of q_to_P_weight for every row of Q
+        converged: m booleans, False rows stopped at max_iterations
+    '''
+    if max_iterations is None: max_iterations = weights_max_iterations
+    if tolerance is None: tolerance = weights_tolerance
+
+    Q = np.asarray( Q, dtype = float )
+    P = np.asarray( P, dtype = float )
+    m, n = len( Q ), len( P )
+    scale = 2e6
+
+    ds = np.abs( Q[:, None, :] - P[None, :, :] ).sum( axis = 2 )
+    ds = ds / ds.sum( axis = 1, keepdims = True )
+
+    # a control point on a free point is that point, its weight there costs nothing
+    on_point = ds.min( axis = 1 ) == 0
+    if on_point.any():
+        W = np.zeros( ( m, n ) )
+        W[ on_point, ds[ on_point ].argmin( axis = 1 ) ] = 1.
+        converged = on_point.copy()
+        if not on_point.all():
+            W[ ~on_point ], converged[ ~on_point ] = l1_weights( Q[ ~on_point ], P, max_iterations, tolerance, context )
+        return W, converged
+
+    if context is None:
+        context = StrokeFittingContext( P[:, :3] )
+    B = context.B
+    P_outer = context.P_outer
+
+    ## variables [ w+, w- ], their multipliers [ s+, s- ] and y for P w + y / 2e6 = q
+    c = np.hstack( ( ds, ds ) )                      # m * 2n
+    ridge = 2 * weights_ridge
+    X = np.ones( ( m, 2 * n ) )
+    S = c + 1. / n
+    y = np.zeros( ( m, 4 ) )
+
+    converged = np.zeros( m, dtype = bool )
+    active = np.arange( m )
+    regularization = np.eye( 4 ) / scale
+    for iteration in range( max_iterations ):
+        Xa, Sa, ya = X[ active ], S[ active ], y[ active ]
+        r_dual = c[ active ] + ridge * Xa - ya @ B - Sa
+        r_primal = Xa @ B.T + ya / scale - Q[ active ]
+        gap = ( Xa * Sa ).sum( axis = 1 )
+        done = ( gap <= tolerance ) & ( np.abs( r_primal ).max( axis = 1 ) <= tolerance ) \
+               & ( np.abs( r_dual ).max( axis = 1 ) <= tolerance )
+        converged[ active[ done ] ] = True
+        if done.all():
+            break
+        # converged columns stay as they are
+        if done.any():
+            active = active[ ~done ]
+            Xa, Sa, ya, r_dual, r_primal, gap = Xa[ ~done ], Sa[ ~done ], ya[ ~done ], r_dual[ ~done ], r_primal[ ~done ], gap[ ~done ]
+
+        ## the 4 * 4 systems, equilibrated since w / s spans many orders of magnitude near the end
+        # the multipliers and the ridge, see dX below
+        D = Sa + ridge * Xa
+        XS = Xa / D
+        M = ( ( XS[:, :n] + XS[:, n:] ) @ P_outer ).reshape( -1, 4, 4 ) + regularization
+        e = 1. / np.sqrt( np.einsum( 'kii->ki', M ) )
+        e = e[:, :, None] * e[:, None, :]
+        try:
+            M_inv = np.linalg.inv( M * e ) * e
+        except np.linalg.LinAlgError:
+            # nearly all the weight on one free point ( a control point next to a vertex ) makes M rank one
+            M_inv = np.linalg.pinv( M * e ) * e
+
+        def newton( r_center ):
+            rhs = -r_primal - ( ( r_center - Xa * r_dual ) / D ) @ B.T
+            dy = np.matmul( M_inv, rhs[:, :, None] )[:, :, 0]
+            # two steps of iterative refinement
+            for refinement in range( 3 ):
+                # S dX + X dS = r_center with dS = r_dual - dy B + ridge dX
+                dX = ( r_center - Xa * ( r_dual - dy @ B ) ) / D
+                dS = r_dual - dy @ B + ridge * dX
+                if refinement == 2:
+                    break
+                rhs = -r_primal - dX @ B.T - dy / scale
+                dy += np.matmul( M_inv, rhs[:, :, None] )[:, :, 0]
+            return dX, dS, dy
+
+        ## Mehrotra predictor corrector
+        mu = gap / ( 2 * n )
+        dX, dS, dy = newton( -Xa * Sa )
+        a = np.minimum( _max_step( Xa, dX ), _max_step( Sa, dS ) )[:, None]
+        mu_affine = ( ( Xa + a * dX ) * ( Sa + a * dS ) ).sum( axis = 1 ) / ( 2 * n )
+        sigma_mu = ( ( mu_affine / mu ) ** 3 * mu )[:, None]
+        dX, dS, dy = newton( sigma_mu - Xa * Sa - dX * dS )
+
+        a = 0.99 * np.minimum( _max_step( Xa, dX ), _max_step( Sa, dS ) )[:, None]
+        X[ active ] = Xa + a * dX
+        S[ active ] = Sa + a * dS
+        y[ active ] = ya + a * dy
+
+    W = X[:, :n] - X[:, n:]
+    return W, converged
+
+
+def Q_to_P_W( Q, P, context = None ):
     '''
     P : n * 4 
     Q : m * 4
@@ -95,8 +243,23 @@ def Q_to_P_W( Q, P ):
     W : n * m
 
     P.T @ W = Q.T
+
+    context: StrokeFittingContext of P, for the batched weights
     '''
 
+    if batched_weights:
+        W, converged = l1_weights( Q, P, context = context )
+        # the rare column which did not converge is solved on its own, by the interior point method of cvxopt
+        for i in np.flatnonzero( ~converged ):
+            try:
+                W[i] = q_to_P_weight( Q[i], P.T, l1_backends.reference )
+            except ( ValueError, ArithmeticError ):
+                # cvxopt can fail as well on a control point a few microns from a free point
+                # ( the first control points of a short stroke which starts on a vertex ), it is that point
+                W[i] = 0.
+                W[ i, np.abs( Q[i] - P ).sum( axis = 1 ).argmin() ] = 1.
+        return W.tolist()
+
     P = P.T
 
     W = []
@@ -117,7 +280,24 @@ def extract_resampled_points( stroke_data ):
     '''
 
     scale = stroke_data['scale']
-    pts = stroke_data['points']
+
+    curve_points = stroke_points_array( stroke_data['points'] )
+
+    points = resample( curve_points )
+
+    return points
+
+
+def stroke_points_array( pts ):
+    '''
+    given:
+        pts: the points of a stroke message, [ {x, y, z}, ... ] or an array
+    return:
+        n * 3 array
+    '''
+    if isinstance( pts, np.ndarray ):
+        # a binary detail-stroke, see wire_format.py
+        return pts.reshape( -1, 3 ).astype( float )
 
     xi = [ pt['x'] for pt in pts]
     yi = [ pt['y'] for pt in pts]
@@ -129,9 +309,7 @@ def extract_resampled_points( stroke_data ):
     curve_points[:, 1] = yi
     curve_points[:, 2] = zi
 
-    points = resample( curve_points )
-
-    return points
+    return curve_points
 
 
 def fit_stroke_with_b_spline( points ):
@@ -178,27 +356,80 @@ def fit_stroke_with_b_spline( points ):
     return t, c, k, n
 
 
-def control_points_on_free_points_weights( free_points, control_points ):
+def control_points_on_free_points_weights( free_points, control_points, context = None ):
     '''
     given:
         free_points 
         control_points 
+        context: StrokeFittingContext of free_points, made here if None
     Return :
         W : weights
     '''
-    free_points = np.asarray( free_points )
-    ones = np.ones((len(free_points),1))
-    P = np.hstack( (free_points, ones) )
+    if context is None:
+        context = StrokeFittingContext( free_points )
 
 
     ones = np.ones((len(control_points),1))
     Q = np.hstack( (control_points, ones) )
 
-    w = Q_to_P_W( Q,  P )
+    w = Q_to_P_W( Q,  context.P, context )
 
     return w
 
 
+## Stroke fitting contexts
+#
+# everything about the free points which the weights of a stroke need, computed once per scaffold pose.
+# Strokes are drawn against an unchanged scaffold most of the time, so fitting_context keeps the
+# contexts of the last poses, keyed by the exact vertex positions: moving a vertex gives a new key,
+# anything else ( strokes, curves, undo to a pose seen before ) reuses the context.
+context_cache_size = 8
+_contexts = collections.OrderedDict()
+
+class StrokeFittingContext:
+    '''
+    free_points: n * 3
+    P: n * 4, the homogeneous free points
+    B: 4 * 2n, [ P', -P' ], the constraint matrix of l1_weights
+    P_outer: n * 16, the outer products p p' of the rows of P,
+             the 4 * 4 systems of l1_weights are P_outer weighted sums
+    '''
+
+    def __init__( self, free_points ):
+        self.free_points = np.asarray( free_points, dtype = float ).reshape( -1, 3 )
+        n = len( self.free_points )
+        self.P = np.hstack( ( self.free_points, np.ones( ( n, 1 ) ) ) )
+        self.B = np.hstack( ( self.P.T, -self.P.T ) )
+        self.P_outer = ( self.P[:, :, None] * self.P[:, None, :] ).reshape( n, 16 )
+        for array in ( self.free_points, self.P, self.B, self.P_outer ):
+            array.flags.writeable = False
+
+    def weights( self, control_points ):
+        '''
+        control_points_on_free_points_weights with this context
+        '''
+        return control_points_on_free_points_weights( self.free_points, control_points, self )
+
+def fitting_context( state ):
+    '''
+    Given:
+        state
+    Return:
+        the StrokeFittingContext of the free points of state, cached by their positions
+    '''
+    free_points = np.asarray( extract_free_points_from_state( state ), dtype = float ).reshape( -1, 3 )
+    key = free_points.tobytes()
+    context = _contexts.get( key )
+    if context is None:
+        context = StrokeFittingContext( free_points )
+        _contexts[ key ] = context
+        while len( _contexts ) > context_cache_size:
+            _contexts.popitem( last = False )
+    else:
+        _contexts.move_to_end( key )
+    return context
+
+
 def stroke_data_to_weights( stroke_data, state ):
     '''
     '''
@@ -211,18 +442,30 @@ def stroke_data_to_weights( stroke_data, state ):
 
 
     # to protect: in case the stroke is too short 
-    curve_points = extract_resampled_points( stroke_data )
+    with tracing.span( 'stroke.resample' ):
+        curve_points = extract_resampled_points( stroke_data )
     if len(curve_points) < 2:
         return 
 
     # to protect: in case the stroke is too short 
-    t, c, k, n = fit_stroke_with_b_spline( curve_points )
+    with tracing.span( 'stroke.fit' ):
+        t, c, k, n = fit_stroke_with_b_spline( curve_points )
     if c is None:
         return 
 
-    free_points = extract_free_points_from_state( state )
+    with tracing.span( 'stroke.weights' ):
+        context = fitting_context( state )
+
+        w = context.weights( c )
+    tracing.count( 'stroke.control_points', len( c ) )
 
-    w = control_points_on_free_points_weights( free_points, c )
+    add_stroke( state, curve_points, t, w, k, n )
+
+
+def add_stroke( state, curve_points, t, w, k, n ):
+    '''
+    appends a fitted stroke to state[ 'strokes' ] and its resampled points to state[ 'stroke_points' ]
+    '''
 
     # dictionary data for the stroke
     d = {}
@@ -236,4 +479,129 @@ def stroke_data_to_weights( stroke_data, state ):
     state['strokes'].append( d )
 
 
+## Streaming strokes
+#
+# edit_server receives a stroke while it is drawn, stroke-begin / stroke-append / stroke-end.
+# The arc length of the raw points is accumulated as they arrive, and between the appends the
+# stroke so far is fitted and its weights solved exactly as a detail-stroke of the same raw points,
+# when it has grown by `stream_refit_samples` samples and by `stream_refit_fraction` of the samples
+# of the last refit ( edit_server skips the refit while more appends are waiting ).
+# The smoothing spline moves all its control points when points are added, so nothing of a refit
+# carries over to the next one, and a refit costs about as much as fitting the whole stroke:
+# growing the refit interval with the stroke keeps all the refits of a stroke within a few times
+# the cost of its last one, where a refit per sample would be quadratic in the stroke length.
+# stroke-end reuses the last refit as it is when no points came after it and the scaffold has not
+# moved, and fits the stroke otherwise.
+# Either way the stroke is the detail-stroke's, knots, stroke points and weights.
+stream_refit_samples = 1
+stream_refit_fraction = 0.1
+
+def fit_stroke( curve_points, context ):
+    '''
+    Given:
+        curve_points: resampled stroke points
+        context: StrokeFittingContext of the free points
+    Return:
+        t, w, k, n for add_stroke, as stroke_data_to_weights fits them, or None for a stroke too short
+    '''
+    if len( curve_points ) < 2:
+        return None
+    t, c, k, n = fit_stroke_with_b_spline( curve_points )
+    if c is None:
+        return None
+    return t, context.weights( c ), k, n
+
+class StreamingStroke:
+    '''
+    A detail stroke which arrives in pieces.
+
+    context: StrokeFittingContext of the scaffold when the stroke began
+    scale: of stroke-begin, as in a detail-stroke
+    '''
 
+    def __init__( self, context, scale = None ):
+        self.context = context
+        self.scale = scale
+
+        self.chunks = []
+        self.arc_lengths = []
+        self.last_point = None
+        self.length = 0.
+        # raw points so far
+        self.count = 0
+
+        # samples of the last refit
+        self.refitted = 0
+        # the last refit: raw points it fitted, resampled points, and fit_stroke of them ( None for too short )
+        self.fitted = None
+
+    def append( self, points ):
+        '''
+        Given:
+            points: the new raw points, [ {x, y, z}, ... ] or an n * 3 array
+        '''
+        points = stroke_points_array( points )
+        if len( points ) == 0:
+            return
+
+        start = points[:1] if self.last_point is None else self.last_point
+        dp = np.linalg.norm( np.diff( np.vstack( ( start, points ) ), axis = 0 ), axis = 1 )
+        # continuing the sum from the length so far gives the same arc lengths as resample
+        d = np.cumsum( np.hstack( ( [ self.length ], dp ) ) )[1:]
+
+        self.chunks.append( points )
+        self.arc_lengths.append( d )
+        self.last_point = points[-1:]
+        self.length = d[-1]
+        self.count += len( points )
+
+    def resampled_points( self ):
+        '''
+        the raw points so far resampled, as extract_resampled_points does
+        '''
+        if not self.chunks:
+            return np.zeros( ( 0, 3 ) )
+        return resample( np.vstack( self.chunks ), d = np.concatenate( self.arc_lengths ) )
+
+    def refit( self ):
+        '''
+        Fits the stroke so far with its weights, if it has grown enough since the last refit.
+        It runs on the solver thread.
+        Return:
+            True if it refitted
+        '''
+        with tracing.span( 'stroke_stream.refit' ):
+            curve_points = self.resampled_points()
+            grown = len( curve_points ) - self.refitted
+            if len( curve_points ) < 2 or grown < max( stream_refit_samples, stream_refit_fraction * self.refitted ):
+                return False
+            self.refitted = len( curve_points )
+            self.fitted = ( self.count, curve_points, fit_stroke( curve_points, self.context ) )
+            return True
+
+    def finish( self, stroke_data, state ):
+        '''
+        Given:
+            stroke_data: of stroke-end, its optional 'points' are the last raw points
+            state
+        Adds the stroke to state like stroke_data_to_weights.
+        '''
+        if stroke_data and len( stroke_data.get( 'points', [] ) ):
+            self.append( stroke_data['points'] )
+
+        with tracing.span( 'stroke_stream.finish' ):
+            # the scaffold may have moved since stroke-begin
+            context = fitting_context( state )
+            if self.fitted is not None and self.fitted[0] == self.count and np.array_equal( context.P, self.context.P ):
+                count, curve_points, fitted = self.fitted
+            else:
+                curve_points = self.resampled_points()
+                fitted = fit_stroke( curve_points, context )
+
+        # to protect: in case the stroke is too short 
+        if fitted is None:
+            return
+
+        t, w, k, n = fitted
+        tracing.count( 'stroke.control_points', len( w ) )
+        add_stroke( state, curve_points, t, w, k, n )
@@ -0,0 +1,220 @@
+# undo/redo history with structural sharing
+#
+# edit_server used to keep two deepcopy's of the whole state for every action
+# and another one for every undo/redo.
+# Here every saved version is a snapshot which shares everything unchanged with the
+# previous snapshot: point rows, curves and strokes are stored once and referenced
+# by all the versions which contain them, so a new version costs the changed data
+# plus one reference per point, curve and stroke.
+#
+# The handlers modify a state in place ( point rows, curve magnitudes, appended strokes ),
+# so snapshots are immutable: point and line rows are tuples, curves are copied dicts,
+# strokes and stroke_points are tuples of the ( never modified ) stroke entries.
+# `checkout` turns a snapshot back into a state which can be modified.
+
+import sys
+
+
+def _row( row, previous_row ):
+    row = tuple( row )
+    if previous_row is not None and previous_row == row:
+        return previous_row
+    return row
+
+
+def _rows( rows, previous_rows ):
+    previous_rows = previous_rows or ()
+    return tuple( _row( row, previous_rows[i] if i < len( previous_rows ) else None ) for i, row in enumerate( rows ) )
+
+
+def _curves( curves, previous_curves ):
+    previous_curves = previous_curves or ()
+    result = []
+    for i, curve in enumerate( curves ):
+        previous_curve = previous_curves[i] if i < len( previous_curves ) else None
+        if previous_curve is not None and previous_curve == curve:
+            result.append( previous_curve )
+        else:
+            result.append( dict( curve ) )
+    return tuple( result )
+
+
+def _shared( items, previous_items ):
+    '''
+    strokes are only appended, share the entries of the previous snapshot
+    '''
+    previous_items = previous_items or ()
+    return tuple( previous_items[i] if i < len( previous_items ) and previous_items[i] is item else item
+                  for i, item in enumerate( items ) )
+
+
+def snapshot( state, previous = None ):
+    '''
+    Given:
+        state: the current state
+        previous: the previous snapshot, whose unchanged parts are shared
+    Return:
+        an immutable snapshot of state
+    '''
+    previous = previous or {}
+
+    result = {}
+    for key, value in state.items():
+        if key in ( 'points', 'lines' ):
+            result[key] = _rows( value, previous.get( key ) )
+        elif key == 'curves':
+            result[key] = _curves( value, previous.get( key ) )
+        elif key in ( 'strokes', 'stroke_points' ):
+            result[key] = _shared( value, previous.get( key ) )
+        else:
+            # e.g. input_data, which is replaced and never modified in place
+            result[key] = value
+    return result
+
+
+def checkout( snapshot ):
+    '''
+    a state from a snapshot ( or a copy of a state ), which the handlers may modify in place
+    '''
+    state = {}
+    for key, value in snapshot.items():
+        if key in ( 'points', 'lines' ):
+            state[key] = [ list( row ) for row in value ]
+        elif key == 'curves':
+            state[key] = [ dict( curve ) for curve in value ]
+        elif key in ( 'strokes', 'stroke_points' ):
+            state[key] = list( value )
+        else:
+            state[key] = value
+    return state
+
+
+def _deep_size( value ):
+    '''
+    approximate memory of value and everything it contains
+    '''
+    size = sys.getsizeof( value )
+    if isinstance( value, dict ):
+        size += sum( _deep_size( v ) for v in value.values() )
+    elif isinstance( value, ( list, tuple ) ):
+        size += sum( _deep_size( v ) for v in value )
+    return size
+
+
+def _new_size( version, previous ):
+    '''
+    approximate memory of the parts of version which are not shared with the previous version
+    '''
+    previous = previous or {}
+
+    size = sys.getsizeof( version )
+    for key, value in version.items():
+        previous_value = previous.get( key )
+        if value is previous_value:
+            continue
+        if isinstance( value, tuple ) and isinstance( previous_value, tuple ):
+            size += sys.getsizeof( value )
+            for i, item in enumerate( value ):
+                if i >= len( previous_value ) or item is not previous_value[i]:
+                    size += _deep_size( item )
+        else:
+            size += _deep_size( value )
+    return size
+
+
+class History:
+    '''
+    All saved versions of a session, with undo and redo.
+
+    `versions` is every saved version in order ( the history export ),
+    undo_stack and redo_stack hold positions in `versions`.
+    The memory of the retained versions is kept below max_bytes ( approximately ) by dropping the oldest versions,
+    the current version and the redo stack are always kept.
+    '''
+
+    def __init__( self, state, max_bytes = None ):
+        self.max_bytes = max_bytes
+
+        self.versions = []
+        self.sizes = []
+        self.first_version = 0
+
+        self.undo_stack = []
+        self.redo_stack = []
+
+        self.undo_stack.append( self._add( state ) )
+
+    def _add( self, state ):
+        previous = self.versions[-1] if len( self.versions ) else None
+        version = snapshot( state, previous )
+        self.sizes.append( _new_size( version, previous ) )
+        self.versions.append( version )
+        return self.first_version + len( self.versions ) - 1
+
+    def _get( self, position ):
+        return self.versions[ position - self.first_version ]
+
+    @property
+    def nbytes( self ):
+        return sum( self.sizes )
+
+    def save( self, state, amend = False ):
+        '''
+        save state as a new version, like save_state_for_undo
+        amend: replace the current version instead, e.g. for the next pose of a drag,
+               so one undo goes back to before the whole drag
+        '''
+        last = self.first_version + len( self.versions ) - 1
+        if amend and len( self.undo_stack ) > 1 and self.undo_stack[-1] == last:
+            self.undo_stack.pop()
+            self.versions.pop()
+            self.sizes.pop()
+        self.undo_stack.append( self._add( state ) )
+        del self.redo_stack[:]
+        self._trim()
+
+    def undo( self ):
+        '''
+        Return:
+            the state to go back to, or None if there is nothing to undo
+        '''
+        if len( self.undo_stack ) > 1:
+            self.redo_stack.append( self.undo_stack.pop() )
+            return checkout( self._get( self.undo_stack[-1] ) )
+        return None
+
+    def redo( self ):
+        '''
+        Return:
+            the state to go forward to, or None if there is nothing to redo
+        '''
+        if len( self.redo_stack ) >= 1:
+            self.undo_stack.append( self.redo_stack.pop() )
+            return checkout( self._get( self.undo_stack[-1] ) )
+        return None
+
+    def current( self ):
+        '''
+        snapshot of the current version
+        '''
+        return self._get( self.undo_stack[-1] )
+
+    def export_states( self ):
+        '''
+        all retained versions in order, for json.dump
+        '''
+        return list( self.versions )
+
+    def _trim( self ):
+        if self.max_bytes is None:
+            return
+
+        current = self.undo_stack[-1]
+        while self.nbytes > self.max_bytes and self.first_version < current:
+            self.versions.pop( 0 )
+            self.sizes.pop( 0 )
+            self.first_version += 1
+            # the next version now owns everything it shared with the dropped one
+            self.sizes[0] = _deep_size( self.versions[0] )
+
+        self.undo_stack = [ position for position in self.undo_stack if position >= self.first_version ]
@@ -0,0 +1,245 @@
+# warm-started IRLS driver for the line optimizer
+#
+# every outer IRLS iteration reweights the constraints and minimizes the weighted energy.
+# Instead of a fresh BFGS per outer iteration, the inverse Hessian estimate is carried
+# across reweighting steps, and across consecutive move-line messages which move the
+# same vertices ( one drag ), the previous solution is reused as the starting point.
+
+import threading
+import time
+
+import numpy as np
+import scipy.optimize
+
+import constraint_energy
+
+
+def bfgs( fun, x0, hess_inv0 = None, gtol = 1e-6, maxiter = 1000, deadline = None ):
+    '''
+    BFGS which can start from a given inverse Hessian estimate and stop at a deadline.
+    Given:
+        fun: X -> ( energy, gradient )
+        x0: initial X
+        hess_inv0: initial inverse Hessian estimate, identity if None
+        gtol: stop when the max norm of the gradient is below gtol
+        maxiter: maximum number of iterations
+        deadline: time.perf_counter() value to stop at, or None
+    Return:
+        scipy.optimize.OptimizeResult with x, fun, jac, hess_inv, nit, nfev, success, status, message
+    '''
+
+    cache = {}
+    def f_and_g( x ):
+        key = x.tobytes()
+        if key not in cache:
+            cache.clear()
+            cache[key] = fun( x )
+            f_and_g.nfev += 1
+        return cache[key]
+    f_and_g.nfev = 0
+
+    x = np.array( x0, dtype = float )
+    n = len( x )
+    I = np.eye( n )
+    H = I.copy() if hess_inv0 is None else np.array( hess_inv0, dtype = float )
+
+    f, g = f_and_g( x )
+    old_f = f + np.linalg.norm( g ) / 2
+
+    nit = 0
+    status, message = 0, 'Optimization terminated successfully.'
+
+    while np.abs( g ).max( initial = 0 ) > gtol:
+        if nit >= maxiter:
+            status, message = 1, 'Maximum number of iterations has been exceeded.'
+            break
+        if deadline is not None and time.perf_counter() > deadline:
+            status, message = 3, 'Time budget has been exceeded.'
+            break
+
+        p = -H @ g
+        alpha, _, _, new_f, old_f, new_g = scipy.optimize.line_search(
+            lambda x: f_and_g( x )[0], lambda x: f_and_g( x )[1], x, p, g, f, old_f, amax = 1e100 )
+
+        if alpha is None:
+            # a warm inverse Hessian can be stale, retry once from the identity
+            if not np.array_equal( H, I ):
+                H = I.copy()
+                continue
+            status, message = 2, 'Desired error not necessarily achieved due to precision loss.'
+            break
+
+        s = alpha * p
+        x = x + s
+        if new_g is None:
+            new_g = f_and_g( x )[1]
+        y = new_g - g
+        f, g = new_f, new_g
+        nit += 1
+
+        ys = np.dot( y, s )
+        rho = 1000. if ys == 0 else 1 / ys
+        A1 = I - rho * np.outer( s, y )
+        A2 = I - rho * np.outer( y, s )
+        H = A1 @ H @ A2 + rho * np.outer( s, s )
+
+    return scipy.optimize.OptimizeResult( x = x, fun = f, jac = g, hess_inv = H, nit = nit, nfev = f_and_g.nfev,
+                                          success = status == 0, status = status, message = message )
+
+
+class Cancelled( Exception ):
+    '''
+    raised by IRLSSolver.solve when `cancel` was called during the solve
+    '''
+    pass
+
+
+class IRLSSolver:
+    '''
+    Iteratively reweighted least squares for the line constraints.
+
+    Keep one solver per connection and pass it to sketch_modify.move_line,
+    consecutive solves with the same live vertices reuse the previous
+    solution and inverse Hessian. After every solve, `stats` has the convergence statistics.
+    '''
+
+    def __init__( self, max_iterations = 100, time_budget = None, epsilon = 1e-6, warm_start = True, method = 'BFGS' ):
+        '''
+        Given:
+            max_iterations: maximum number of outer (reweighting) iterations
+            time_budget: seconds for one solve, or None for no limit.
+                         When it runs out, the last iterate is returned.
+            epsilon: IRLS weight regularization and the L1 change which counts as converged
+            warm_start: reuse the previous solve of the same drag
+            method: 'BFGS' for the warm-started BFGS,
+                    otherwise a scipy.optimize.minimize method, which starts every outer iteration cold
+        '''
+        self.max_iterations = max_iterations
+        self.time_budget = time_budget
+        self.epsilon = epsilon
+        self.warm_start = warm_start
+        self.method = method
+
+        self.previous = None
+        self.stats = {}
+
+        self.cancelled = threading.Event()
+
+    def reset( self ):
+        '''
+        forget the previous solve, the next one starts cold
+        '''
+        self.previous = None
+
+    def cancel( self ):
+        '''
+        stop the running solve at its next outer iteration, it raises Cancelled.
+        Can be called from another thread, the flag stays set until `clear_cancel`.
+        '''
+        self.cancelled.set()
+
+    def clear_cancel( self ):
+        self.cancelled.clear()
+
+    def check_cancelled( self ):
+        '''
+        raise Cancelled if `cancel` was called
+        '''
+        if self.cancelled.is_set():
+            raise Cancelled()
+
+    def reweight( self, energy, X ):
+        '''
+        IRLS weights 1 / ( epsilon + pair energy ), normalized to sum to 1
+        '''
+        func_vals = energy.pair_values( X )
+
+        weights = {}
+        weights_sum = 0
+        for key in constraint_energy.CONSTRAINT_TYPES:
+            weights[key] = 1 / ( self.epsilon + func_vals[key] )
+            weights_sum += weights[key].sum()
+
+        for key in weights:
+            weights[key] /= weights_sum
+
+        return weights
+
+    def solve( self, constraints, points, linesData, live_vertex_indices, callback = None ):
+        '''
+        Given:
+            constraints: dictionary constraint type -> set of (i, j) line pairs
+            points: moved point positions, updated in place like sketch_modify.unpack
+            linesData: state['lines']
+            live_vertex_indices: the point indices to optimize
+            callback: called with the ( n_points, 3 ) positions of every outer iterate, or None
+        Return:
+            points with the optimized live vertices
+        '''
+        start = time.perf_counter()
+        deadline = None if self.time_budget is None else start + self.time_budget
+
+        energy = constraint_energy.ConstraintEnergy( points, linesData, live_vertex_indices, constraints )
+        x_input = energy.pack()
+
+        # the same drag moves the same vertices, its constraints may still change a little
+        key = tuple( live_vertex_indices )
+
+        x_previous_iteration = x_input
+        hess_inv = None
+        warm_started = False
+        if self.warm_start and self.previous is not None and self.previous['key'] == key:
+            # the previous solution, moved along with this drag
+            x_previous_iteration = self.previous['x'] + ( x_input - self.previous['x_input'] )
+            hess_inv = self.previous['hess_inv']
+            warm_started = True
+
+        stats = { 'outer_iterations': 0, 'inner_iterations': 0, 'function_evaluations': 0,
+                  'warm_started': warm_started, 'converged': False, 'stop_reason': 'max_iterations',
+                  'constraints': { k: len( v ) for k, v in energy.pairs.items() } }
+
+        x = x_previous_iteration
+        while self.max_iterations is None or stats['outer_iterations'] < self.max_iterations:
+
+            # a newer move of the same drag makes this solve useless
+            self.check_cancelled()
+
+            if deadline is not None and time.perf_counter() > deadline:
+                stats['stop_reason'] = 'time_budget'
+                break
+
+            energy.weights = self.reweight( energy, x_previous_iteration )
+
+            if self.method == 'BFGS':
+                result = bfgs( energy.value_and_gradient, x_previous_iteration, hess_inv, gtol = 1e-6, deadline = deadline )
+                hess_inv = result.hess_inv
+            else:
+                hessp = energy.hessp if self.method in constraint_energy.HESSP_METHODS else None
+                result = scipy.optimize.minimize( energy.value_and_gradient, x_previous_iteration, method = self.method,
+                                                  jac = True, hessp = hessp, tol = 0.000001,
+                                                  options = constraint_energy.minimize_options( self.method ) )
+
+            stats['outer_iterations'] += 1
+            stats['inner_iterations'] += result.nit
+            stats['function_evaluations'] += result.nfev
+
+            x = result.x
+            change = np.abs( x - x_previous_iteration ).sum()
+            stats['change'] = change
+            x_previous_iteration = x
+
+            if callback is not None:
+                callback( energy.positions( x ) )
+
+            if change < self.epsilon:
+                stats['converged'] = True
+                stats['stop_reason'] = 'converged'
+                break
+
+        stats['energy'] = energy.energy( x )
+        stats['elapsed'] = time.perf_counter() - start
+        self.stats = stats
+
+        self.previous = { 'key': key, 'x_input': x_input, 'x': x, 'hess_inv': hess_inv }
+
+        return energy.unpack( x, points )
@@ -0,0 +1,245 @@
+# l1 regularized least squares backends
+#
+#     minimize || A x - b ||_2^2 + || x ||_1
+#
+# fit_detail_stroke.q_to_P_weight solves one such problem for every control point of a stroke,
+# A is only 4 * n_free_points, so the time goes into the solver overhead, not the linear algebra.
+#
+# A backend is a function backend( A, b ) -> x of numpy arrays, or None when it cannot
+# certify its solution, registered in BACKENDS by name:
+#     'cvxopt':    a cone QP of cvxopt with the residual as variables, the reference
+#     'homotopy':  the lasso path from x = 0 down to the problem, in numpy
+# `solve` falls back to the reference when a backend returns None.
+# cvxopt is only imported when the reference is used.
+#
+# Cross check a backend against cvxopt on random problems:
+#     python l1_backends.py [backend]
+
+import sys
+import time
+
+import numpy as np
+
+
+reference = 'cvxopt'
+
+
+def objective( A, b, x ):
+    r = A @ x - b
+    return r @ r + np.abs( x ).sum()
+
+
+# tolerances of cvxopt_backend, tighter than the cvxopt defaults so that the weights
+# of fit_detail_stroke are resolved to about 1e-4
+cvxopt_options = { 'show_progress': False, 'abstol': 1e-9, 'reltol': 1e-9, 'feastol': 1e-9 }
+
+def cvxopt_backend( A, b ):
+    '''
+    the reference, cvxopt.solvers.coneqp on the variables [ x, u, r ]:
+        minimize r' r + 1' u    subject to    A x - r = b,  -u <= x <= u
+
+    l1regls.l1regls solves the same problem without r. Its objective is then || A x ||^2 - 2 b' A x,
+    about - b' b, and for the b of q_to_P_weight ( || b || ~ 1000 ) its tolerances relative
+    to that do not resolve the optimum.
+    '''
+    import cvxopt
+
+    A = np.asarray( A, dtype = float )
+    b = np.asarray( b, dtype = float ).ravel()
+    m, n = A.shape
+    I = np.eye( n )
+
+    P = np.zeros( ( 2 * n + m, 2 * n + m ) )
+    P[ 2*n:, 2*n: ] = 2 * np.eye( m )
+    q = np.concatenate( ( np.zeros( n ), np.ones( n ), np.zeros( m ) ) )
+    # x - u <= 0, -x - u <= 0
+    G = np.hstack( ( np.vstack( ( I, -I ) ), np.vstack( ( -I, -I ) ), np.zeros( ( 2 * n, m ) ) ) )
+    h = np.zeros( 2 * n )
+    A_eq = np.hstack( ( A, np.zeros( ( m, n ) ), -np.eye( m ) ) )
+
+    M = cvxopt.matrix
+    solution = cvxopt.solvers.coneqp( M( P ), M( q ), M( G ), M( h ), A = M( A_eq ), b = M( b ), kktsolver = 'ldl', options = cvxopt_options )
+    return np.array( solution['x'][:n] ).ravel()
+
+
+def homotopy_backend( A, b, max_steps = None, tolerance = 1e-9 ):
+    '''
+    Given:
+        A: m * n, b: m
+        max_steps: of the path, default 8 * ( n + 1 )
+        tolerance: relative, of the optimality check
+    Return:
+        x, or None if the path did not reach a certified solution
+
+    With lam = 1/2 the problem is the lasso 1/2 || A x - b ||^2 + lam || x ||_1.
+    Its solution is piecewise linear in lam: for a large lam it is 0, and every breakpoint
+    adds a variable ( its correlation with the residual reaches lam ) or removes one ( it reaches 0 ).
+    With m rows there are at most m variables, so the path is a few small solves.
+    When the columns of the support are dependent ( a degenerate problem ), x moves along the
+    null space of A_S, which changes neither A x nor || x ||_1, until a variable is 0.
+    '''
+    A = np.asarray( A, dtype = float )
+    b = np.asarray( b, dtype = float ).ravel()
+    m, n = A.shape
+    if max_steps is None: max_steps = 8 * ( n + 1 )
+    target = 0.5
+
+    x = np.zeros( n )
+    c = A.T @ b
+    j = np.argmax( np.abs( c ) )
+    lam = abs( c[j] )
+    if lam <= target:
+        return x
+    S, signs = [ j ], [ np.sign( c[j] ) ]
+
+    finished = False
+    dropped = None
+    for step in range( max_steps ):
+        A_S = A[:, S]
+        singular_values, basis = np.linalg.svd( A_S )[1:]
+
+        if len( S ) > m or singular_values[-1] <= 1e-12 * singular_values[0]:
+            # A_S is rank deficient, e.g. four coplanar free points
+            z = basis[-1]
+            # the variable which joined last starts with its own sign
+            if z[-1] == 0:
+                break
+            z *= signs[-1] * np.sign( z[-1] )
+            with np.errstate( divide = 'ignore', invalid = 'ignore' ):
+                t = -x[S] / z
+            t[-1] = np.inf
+            t[ ~( t > 0 ) ] = np.inf
+            k = np.argmin( t )
+            if not np.isfinite( t[k] ):
+                break
+            x[S] += t[k] * z
+            x[ S[k] ] = 0.
+            dropped = S[k]
+            del S[k], signs[k]
+            continue
+
+        ## direction of x_S while lam decreases, and of the correlations
+        d = np.linalg.solve( A_S.T @ A_S, np.asarray( signs ) )
+        # a variable which joined in a tie and would start with the wrong sign leaves again
+        wrong = [ i for i in range( len( S ) ) if x[ S[i] ] == 0 and d[i] * signs[i] < 0 ]
+        if wrong:
+            dropped = S[ wrong[0] ]
+            del S[ wrong[0] ], signs[ wrong[0] ]
+            continue
+        a = A.T @ ( A_S @ d )
+
+        ## the next breakpoint
+        gamma, event, k = lam - target, 'end', None
+        outside = np.ones( n, dtype = bool )
+        outside[S] = False
+        # a variable which just reached 0 would rejoin at once, by rounding, with the wrong sign
+        if dropped is not None:
+            outside[ dropped ] = False
+        dropped = None
+        with np.errstate( divide = 'ignore', invalid = 'ignore' ):
+            for g in ( ( lam - c ) / ( 1 - a ), ( lam + c ) / ( 1 + a ) ):
+                g[ ~outside | ~( g > 0 ) ] = np.inf
+                i = np.argmin( g )
+                if g[i] < gamma:
+                    gamma, event, k = g[i], 'join', i
+            g = -x[S] / d
+        g[ ~( g > 0 ) ] = np.inf
+        i = np.argmin( g )
+        if g[i] < gamma:
+            gamma, event, k = g[i], 'drop', i
+
+        x[S] += gamma * d
+        lam -= gamma
+        c = A.T @ ( b - A @ x )
+
+        if event == 'end':
+            finished = True
+            break
+        elif event == 'drop':
+            x[ S[k] ] = 0.
+            dropped = S[k]
+            del S[k], signs[k]
+        else:
+            S.append( k )
+            signs.append( np.sign( c[k] ) )
+
+    if not finished:
+        return None
+
+    ## optimality: |correlation| <= lam everywhere and = lam * sign on the support,
+    ## up to the rounding of A' ( b - A x )
+    rounding = 1e-13 * ( np.abs( A ).T @ ( np.abs( b ) + np.abs( A ) @ np.abs( x ) ) )
+    if np.any( np.abs( c ) > target * ( 1 + tolerance ) + rounding ):
+        return None
+    if any( np.sign( x[i] ) != sign for i, sign in zip( S, signs ) ):
+        return None
+    return x
+
+
+BACKENDS = {
+    'cvxopt': cvxopt_backend,
+    'homotopy': homotopy_backend,
+}
+
+
+def solve( A, b, backend = reference ):
+    '''
+    Given:
+        A: m * n, b: m, numpy arrays
+        backend: a name in BACKENDS
+    Return:
+        x minimizing || A x - b ||_2^2 + || x ||_1
+    '''
+    x = BACKENDS[ backend ]( A, b )
+    if x is None and backend != reference:
+        x = BACKENDS[ reference ]( A, b )
+    return x
+
+
+def cross_check( A, b, backend ):
+    '''
+    Return:
+        x of backend ( None if it could not certify it ), x of the reference,
+        relative objective difference ( negative: backend is better )
+    '''
+    x = BACKENDS[ backend ]( A, b )
+    x_reference = BACKENDS[ reference ]( A, b )
+    if x is None:
+        return None, x_reference, None
+    f = objective( A, b, x_reference )
+    return x, x_reference, ( objective( A, b, x ) - f ) / abs( f )
+
+
+if __name__ == '__main__':
+    backend = sys.argv[1] if len( sys.argv ) > 1 else 'homotopy'
+
+    import cvxopt
+    cvxopt.solvers.options['show_progress'] = False
+
+    ## problems like the ones of q_to_P_weight: random free points and a control point between them
+    rng = np.random.default_rng( 0 )
+    times = { backend: 0., reference: 0. }
+    worst, uncertified, count = -np.inf, 0, 200
+    for i in range( count ):
+        n = rng.integers( 8, 64 )
+        P = np.vstack( ( rng.uniform( -1, 1, ( 3, n ) ), np.ones( ( 1, n ) ) ) )
+        q = P @ rng.dirichlet( np.ones( n ) * 0.3 )
+        ds = np.linalg.norm( q[:, None] - P, ord = 1, axis = 0 )
+        ds = ds / ds.sum()
+        A, b = 1000 * P / ds, 1000 * q
+
+        for name in times:
+            start = time.perf_counter()
+            BACKENDS[ name ]( A, b )
+            times[ name ] += time.perf_counter() - start
+
+        x, x_reference, difference = cross_check( A, b, backend )
+        if x is None:
+            uncertified += 1
+        else:
+            worst = max( worst, difference )
+
+    print( '%d problems, %s uncertified ( solved by %s instead ): %d' % ( count, backend, reference, uncertified ) )
+    print( 'largest relative objective difference to %s: %.2e' % ( reference, worst ) )
+    for name, seconds in times.items():
+        print( '%s: %.2f ms per problem' % ( name, 1000 * seconds / count ) )
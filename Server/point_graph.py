@@ -0,0 +1,126 @@
+# array-backed point positions
+#
+# a tick point lerps between two other points, which may be ticks themselves.
+# node_i_position resolves that recursively for every point, recomputing shared ancestors.
+# PointGraph sorts the ticks by their dependency depth once, then all positions are
+# resolved with one vectorized lerp per depth.
+
+import numpy as np
+
+
+class PointGraph:
+    '''
+    The tick dependencies of state['points'].
+
+    Only the structure ( which points are ticks and between which points they lerp ) is compiled,
+    the vertex coordinates and the tick ratios r are read again by every `resolve`,
+    so one graph serves all states with the same points structure.
+    '''
+
+    def __init__( self, pointsData ):
+        n = len( pointsData )
+
+        self.n_points = n
+        self.is_tick = np.asarray( [ point[-1] == 'tick' for point in pointsData ], dtype = bool ).reshape( n )
+        self.parents = np.zeros( ( n, 2 ), dtype = int )
+        for i in np.flatnonzero( self.is_tick ):
+            self.parents[i] = pointsData[i][1:3]
+
+        # depth 0: vertices, depth d: ticks whose parents are at most at depth d - 1
+        depth = np.where( self.is_tick, -1, 0 )
+        for i in np.flatnonzero( self.is_tick ):
+            stack = [ i ]
+            visiting = set()
+            while stack:
+                j = stack[-1]
+                if depth[j] >= 0:
+                    stack.pop()
+                    continue
+                pending = [ k for k in self.parents[j] if depth[k] < 0 ]
+                if len( pending ) == 0:
+                    depth[j] = 1 + depth[ self.parents[j] ].max()
+                    visiting.discard( j )
+                    stack.pop()
+                else:
+                    if j in visiting:
+                        raise ValueError( 'tick point %d depends on itself' % j )
+                    visiting.add( j )
+                    stack.extend( pending )
+
+        self.depth = depth
+        self.levels = [ np.flatnonzero( depth == d ) for d in range( 1, depth.max( initial = 0 ) + 1 ) ]
+
+        self.children = [ [] for i in range( n ) ]
+        for i in np.flatnonzero( self.is_tick ):
+            for parent in set( self.parents[i].tolist() ):
+                self.children[parent].append( i )
+
+    def matches( self, pointsData ):
+        '''
+        if pointsData has the structure this graph was compiled from
+        '''
+        if len( pointsData ) != self.n_points:
+            return False
+        for i, point in enumerate( pointsData ):
+            if ( point[-1] == 'tick' ) != self.is_tick[i]:
+                return False
+            if self.is_tick[i] and ( point[1] != self.parents[i][0] or point[2] != self.parents[i][1] ):
+                return False
+        return True
+
+    def descendants( self, indices ):
+        '''
+        the given points and every tick which depends on them
+        '''
+        result = set()
+        stack = list( indices )
+        while stack:
+            i = stack.pop()
+            if i in result:
+                continue
+            result.add( i )
+            stack.extend( self.children[i] )
+        return result
+
+    def resolve( self, pointsData, positions = None, dirty = None ):
+        '''
+        Given:
+            pointsData: state['points']
+            positions: previously resolved ( n_points, 3 ) positions, needed with dirty
+            dirty: indices of the points whose data changed, or None to resolve everything
+        Return:
+            ( n_points, 3 ) array of point positions
+        '''
+        if dirty is None or positions is None:
+            # vertex rows are ( x, y, z ), tick rows are ( r, i0, i1 )
+            raw = np.asarray( [ point[:3] for point in pointsData ], dtype = float ).reshape( -1, 3 )
+            positions = raw
+            levels = self.levels
+        else:
+            positions = np.array( positions, dtype = float ).reshape( -1, 3 )
+            update = self.descendants( dirty )
+            raw = np.zeros( ( self.n_points, 3 ) )
+            for i in update:
+                raw[i] = pointsData[i][:3]
+            vertices = [ i for i in update if not self.is_tick[i] ]
+            positions[ vertices ] = raw[ vertices ]
+            levels = [ level[ np.isin( level, list( update ) ) ] for level in self.levels ]
+
+        for level in levels:
+            r = raw[ level, 0 ][:, None]
+            i0, i1 = self.parents[ level ].T
+            positions[ level ] = ( 1 - r ) * positions[ i0 ] + r * positions[ i1 ]
+
+        return positions
+
+
+_graph = None
+
+def point_graph( pointsData ):
+    '''
+    the PointGraph of pointsData, compiled again only when the points structure changes
+    '''
+    global _graph
+    if _graph is None or not _graph.matches( pointsData ):
+        _graph = PointGraph( pointsData )
+    return _graph
@@ -1,9 +1,16 @@
 # reoptimize curve : change the magnitudes of curve tangents
 # to minimize the curvature
 
+import collections
+import concurrent.futures
+import functools
+import os
+
 import numpy as np
 from scipy.optimize import minimize
 
+import tracing
+
 
 
 ## helper
@@ -14,6 +21,60 @@ M = np.asfarray([
     [ 1, 0, 0, 0 ]])
 
 ## Optimize Helpers
+def basis( ts ):
+    '''
+    Given:
+        ts: a sequence of t values
+    Returns:
+        the len(ts) by 4 matrix Ts @ M, so that basis( ts ) @ P is bezier_curve( ts, *P )
+    '''
+    ts = np.asarray( ts, dtype = float )
+    Ts = np.stack( [ ts**3, ts**2, ts, np.ones( len( ts ) ) ], axis = 1 )
+    return Ts @ M
+
+## Sampling
+#
+# a segment with key points d apart gets max( 2, int( d / resolution ) ) samples,
+# at t = i / n, and the last segment of a curve also the endpoint t = 1.
+# The basis tables of those ts are cached by sample count.
+# The adaptive mode caps the samples of a segment at adaptive_max_samples:
+# the curvature of one cubic varies slowly, so a few dozen samples resolve its variation
+# however long the segment is, see CurveBatch for how the energy is kept comparable.
+
+adaptive_max_samples = 32
+
+def segment_sample_count( d, resolution = 0.01, max_samples = None ):
+    '''
+    Given:
+        d: distance of the key points of a segment
+        resolution: sample spacing
+        max_samples: cap of the adaptive mode, or None
+    Returns:
+        the number of samples of the segment, without the endpoint of the last segment
+    '''
+    # max(2) because we always want to sample at least once in the middle
+    n = max( 2, int( d / resolution ) )
+    if max_samples is not None:
+        n = min( n, max( 2, max_samples ) )
+    return n
+
+@functools.lru_cache( maxsize = 4096 )
+def basis_table( n, endpoint ):
+    '''
+    Given:
+        n: number of samples of the segment
+        endpoint: if the segment is the last one, which also gets t = 1
+    Returns:
+        basis( ts ) for its ts, read-only as it is shared
+    '''
+    if endpoint:
+        ts = np.linspace( 0, 1, n + 1, endpoint = True )
+    else:
+        ts = np.linspace( 0, 1, n, endpoint = False )
+    table = basis( ts )
+    table.flags.writeable = False
+    return table
+
 def bezier_curve( ts, c0, c1, c2, c3 ):
     '''
     Given:
@@ -38,43 +99,46 @@ def bezier_curve( ts, c0, c1, c2, c3 ):
     Ts[:,3] = 1
     return Ts @ (M @ P)
 
-def evaluate(points, tangents, magnitudes, resolution = 0.01):
+def evaluate(points, tangents, magnitudes, resolution = 0.01, max_samples = None, out = None):
     '''
     Given:
         points  
         tangents
         magnitudes
+        resolution: sample spacing
+        max_samples: samples per segment cap ( the adaptive mode ), or None
+        out: an array to write the samples into, used if it has enough rows
     Return:
         spline points
     '''
     points = np.asarray(points)
     tangents = np.asarray(tangents)
     nPoints, dim = points.shape
-    
-    spline_points = np.empty((0,dim))
 
+    d = np.linalg.norm( points[1:] - points[:-1], axis = 1 )
+    counts = [ segment_sample_count( d[i], resolution, max_samples ) for i in range( nPoints - 1 ) ]
+    total = sum( counts ) + ( 1 if nPoints > 1 else 0 )
+
+    if out is None or len( out ) < total or out.shape[1] != dim:
+        out = np.empty( ( total, dim ) )
+    spline_points = out[:total]
+
+    P = np.empty( ( 4, dim ) )
     k = 0
+    offset = 0
     
     for i in range(nPoints - 1):
-        c0 = points[i]
-        c3 = points[i+1]
-        c1 = c0 + tangents[i] * magnitudes[k]
-        c2 = c3 - tangents[i+1] * magnitudes[k+1]
+        P[0] = points[i]
+        P[3] = points[i+1]
+        P[1] = P[0] + tangents[i] * magnitudes[k]
+        P[2] = P[3] - tangents[i+1] * magnitudes[k+1]
         
         k = k + 2
-        
-        d = np.linalg.norm(c3-c0)
-        
-        # max(2) because we always want to sample at least once in the middle
-        ts = np.linspace(0, 1, max( 2, int(d/resolution) ), endpoint= False)
+
         # add endpoint for the last segment
-        if i == nPoints - 2:
-            ## Add 1 for the second endpoint
-            ts = np.linspace(0, 1, max( 2, int(d/resolution) ) + 1, endpoint=True)
-        
-        curve_points = bezier_curve(ts, c0, c1, c2, c3)
-        spline_points = np.concatenate((spline_points, curve_points))
-        
+        table = basis_table( counts[i], i == nPoints - 2 )
+        np.dot( table, P, out = spline_points[ offset : offset + len( table ) ] )
+        offset += len( table )
 
     return spline_points
 
@@ -194,24 +258,11 @@ def MVC_magnitudes(points, tangents, X = None ):
     points = np.asarray( points )
     tangents = np.asarray( tangents )
     X = init_X(points)
-    
 
-
-    
-    def f(X):
-        evaluated_bezier_points = evaluate(points, tangents, X)
-        prop = property_along_curve( evaluated_bezier_points )
-        
-        ## unweighted
-        # E = sum( [loss( v ) for v in prop ])
-        # E = loss(prop).sum()
-        
-        ## weighted
-        E = ( loss(prop)*edge_weights( evaluated_bezier_points )[1:-1] ).sum()
-        
-        return E
+    ## the edge weighted loss of the property along the curve and its exact gradient, see CurveBatch.energies_and_gradient
+    f_and_gradient = CurveBatch( [ ( points, tangents ) ] ).value_and_gradient
     
-    result = minimize( f, X, method = 'BFGS', jac = None, tol = 0.0001, options = { 'disp': False, 'eps': 0.000001, 'gtol': 0.0001, 'maxiter': 1000 } )
+    result = minimize( f_and_gradient, X, method = 'BFGS', jac = True, tol = 0.0001, options = { 'disp': False, 'gtol': 0.0001, 'maxiter': 1000 } )
 
     # # also need to avoid cusp
     # # not sure whether this is a good way to do so
@@ -231,4 +282,730 @@ def MVC_magnitudes(points, tangents, X = None ):
     if np.linalg.norm( result.x) / np.linalg.norm(X) >= 10:
         return X.tolist()
 
-    return result.x.tolist()
\ No newline at end of file
+    return result.x.tolist()
+
+## Batched optimizer
+#
+# MVC_magnitudes samples and optimizes one curve at a time, with a python loop over the segments
+# in every evaluation. CurveBatch samples all the curves at once:
+# the number of samples of a segment only depends on the distance of its key points,
+# so the sample layout ( and the basis Ts @ M of every sample ) is fixed during the optimization,
+# and every sample is linear in the two magnitudes of its segment:
+#     sample = A + U * m0 + V * m1
+# The curves are independent, so the energy is block separable: one evaluation gives the energy of
+# every curve and, by the chain rule through the samples, the exact gradient of every curve.
+# batched_bfgs runs the BFGS of each curve on its own block.
+
+class CurveBatch:
+    '''
+    The sampled splines of several curves, as one array of samples.
+
+    X is the magnitudes of all curves concatenated, curve c is X[ offsets[c] : offsets[c+1] ]
+    and every segment has the two magnitudes X[2*s], X[2*s+1] ( s counted over all curves ).
+    '''
+
+    def __init__( self, curves, resolution = 0.01, max_samples = None ):
+        '''
+        Given:
+            curves: a sequence of ( points, tangents ) as for MVC_magnitudes
+            resolution: sample spacing, as for evaluate
+            max_samples: samples per segment cap ( the adaptive mode ), or None for the samples of evaluate.
+                         The energy terms of a capped segment with n instead of N samples are scaled by ( n / N )^2,
+                         a term is ~ ( d curvature / ds )^2 ds^3, so the segment keeps about its full resolution energy.
+        '''
+        self.n_curves = len( curves )
+
+        sizes = [ 2 * len( points ) - 2 for points, tangents in curves ]
+        self.offsets = np.zeros( self.n_curves + 1, dtype = int )
+        np.cumsum( sizes, out = self.offsets[1:] )
+        # the curve of every entry of X
+        self.curve_of_x = np.repeat( np.arange( self.n_curves ), sizes )
+
+        c0 = []
+        c3 = []
+        t0 = []
+        t3 = []
+        tables = []
+        segment_weights = []
+        curve_of_segment = []
+        for c, ( points, tangents ) in enumerate( curves ):
+            points = np.asarray( points, dtype = float )
+            tangents = np.asarray( tangents, dtype = float )
+            nPoints = len( points )
+            d = np.linalg.norm( points[1:] - points[:-1], axis = 1 )
+            for i in range( nPoints - 1 ):
+                # the same samples as evaluate
+                n = segment_sample_count( d[i], resolution, max_samples )
+                tables.append( basis_table( n, i == nPoints - 2 ) )
+                segment_weights.append( ( n / segment_sample_count( d[i], resolution ) ) ** 2 )
+            c0.append( points[:-1] )
+            c3.append( points[1:] )
+            t0.append( tangents[:-1] )
+            t3.append( tangents[1:] )
+            curve_of_segment.append( np.full( nPoints - 1, c ) )
+
+        dim = 3 if len( curves ) == 0 else np.asarray( curves[0][0] ).shape[1]
+        n_segments = len( tables )
+        counts = np.asarray( [ len( table ) for table in tables ], dtype = int )
+        self.segment_of_sample = np.repeat( np.arange( n_segments ), counts )
+
+        if n_segments:
+            B = np.concatenate( tables )
+            seg = self.segment_of_sample
+            c0, c3 = np.concatenate( c0 )[ seg ], np.concatenate( c3 )[ seg ]
+            t0, t3 = np.concatenate( t0 )[ seg ], np.concatenate( t3 )[ seg ]
+            curve_of_sample = np.concatenate( curve_of_segment )[ seg ]
+            # c1 = c0 + t0 * m0, c2 = c3 - t3 * m1
+            self.A = ( B[:,0] + B[:,1] )[:,None] * c0 + ( B[:,2] + B[:,3] )[:,None] * c3
+            self.U = B[:,1][:,None] * t0
+            self.V = -B[:,2][:,None] * t3
+        else:
+            curve_of_sample = np.zeros( 0, dtype = int )
+            self.A = self.U = self.V = np.zeros( ( 0, dim ) )
+
+        # preallocated samples, see `samples`
+        self._samples = np.empty( self.A.shape )
+        self._scratch = np.empty( self.A.shape )
+
+        # the energy term of the edge between samples g+1 and g+2 needs the curvature at both,
+        # so samples g .. g+3, which must be on the same curve
+        S = len( curve_of_sample )
+        g = np.arange( max( S - 3, 0 ) )
+        same = ( curve_of_sample[g] == curve_of_sample[g+3] )
+        self.term_index = g[ same ]
+        self.term_curve = curve_of_sample[g][ same ]
+        self.term_weight = np.asarray( segment_weights )[ self.segment_of_sample[ self.term_index + 1 ] ] if n_segments else np.zeros( 0 )
+
+    def samples( self, X ):
+        '''
+        ( n_samples, dim ) spline points of all the curves for the magnitudes X,
+        written into a buffer which the next call reuses
+        '''
+        X = np.asarray( X, dtype = float )
+        m0 = X[0::2][ self.segment_of_sample ]
+        m1 = X[1::2][ self.segment_of_sample ]
+        pts = np.multiply( self.U, m0[:,None], out = self._samples )
+        pts += self.A
+        pts += np.multiply( self.V, m1[:,None], out = self._scratch )
+        return pts
+
+    def energies( self, X ):
+        '''
+        the weighted variation of curvature energy of every curve, as the f of MVC_magnitudes
+        '''
+        return self.energies_and_gradient( X, gradient = False )
+
+    def energies_and_gradient( self, X, gradient = True ):
+        '''
+        Given:
+            X: magnitudes of all curves
+            gradient: also compute the gradient
+        Return:
+            the energy of every curve, and the exact gradient of their sum with respect to X
+            ( the curves are independent, so its block c is the gradient of the energy of curve c )
+        '''
+        pts = self.samples( X )
+
+        xy = pts[:-2] - pts[1:-1]
+        yz = pts[1:-1] - pts[2:]
+        zx = pts[2:] - pts[:-2]
+
+        a = ( xy**2 ).sum( 1 )
+        b = ( yz**2 ).sum( 1 )
+        c = ( zx**2 ).sum( 1 )
+
+        cross = np.cross( xy, zx )
+        area = ( cross ** 2 )
+        if pts.shape[1] == 3: area = area.sum(1)
+        # samples of two different curves may coincide, those terms are not used
+        with np.errstate( divide = 'ignore', invalid = 'ignore' ):
+            curvature = 2 * np.sqrt( area / ( a * b * c ) )
+        flat = area < 1e-20
+        curvature[ flat ] = 0.
+
+        # curvature[g] is at sample g+1
+        g = self.term_index
+        variation = curvature[g+1] - curvature[g]
+        edges = pts[g+1] - pts[g+2]
+        edge_lengths = np.sqrt( ( edges**2 ).sum( 1 ) )
+
+        w = self.term_weight
+        E = np.bincount( self.term_curve, w * loss( variation ) * edge_lengths, minlength = self.n_curves )
+        if not gradient:
+            return E
+
+        ## E = sum w ( curvature[g+1] - curvature[g] )^2 * | pts[g+1] - pts[g+2] |
+        d_curvature = np.zeros( len( curvature ) )
+        d_curvature[g+1] += 2 * w * variation * edge_lengths
+        d_curvature[g] -= 2 * w * variation * edge_lengths
+
+        d_pts = np.zeros( pts.shape )
+        with np.errstate( divide = 'ignore', invalid = 'ignore' ):
+            d_edges = ( w * loss( variation ) / edge_lengths )[:,None] * edges
+        d_pts[g+1] += d_edges
+        d_pts[g+2] -= d_edges
+
+        ## curvature = 2 sqrt( area / ( a b c ) ), area = | xy x zx |^2, so
+        ## d curvature = curvature / 2 * ( d area / area - da / a - db / b - dc / c )
+        ## with d area / d xy = 2 zx x cross, d area / d zx = 2 cross x xy
+        used = ( d_curvature != 0 ) & ~flat
+        k = ( d_curvature * curvature )[ used ][:,None]
+        xy, yz, zx, cross = xy[ used ], yz[ used ], zx[ used ], cross[ used ]
+        area, a, b, c = area[ used ][:,None], a[ used ][:,None], b[ used ][:,None], c[ used ][:,None]
+        d_xy = k * ( np.cross( zx, cross ) / area - xy / a )
+        d_yz = k * ( - yz / b )
+        d_zx = k * ( np.cross( cross, xy ) / area - zx / c )
+
+        # xy = p0 - p1, yz = p1 - p2, zx = p2 - p0 for the triple p0, p1, p2 = pts[i], pts[i+1], pts[i+2]
+        i = np.flatnonzero( used )
+        d_pts[i] += d_xy - d_zx
+        d_pts[i+1] += d_yz - d_xy
+        d_pts[i+2] += d_zx - d_yz
+
+        ## samples = A + U * m0 + V * m1
+        n_segments = len( X ) // 2
+        grad = np.zeros( len( X ) )
+        grad[0::2] = np.bincount( self.segment_of_sample, ( d_pts * self.U ).sum( 1 ), minlength = n_segments )
+        grad[1::2] = np.bincount( self.segment_of_sample, ( d_pts * self.V ).sum( 1 ), minlength = n_segments )
+
+        return E, grad
+
+    def energy( self, X ):
+        return self.energies( X ).sum()
+
+    def gradient( self, X ):
+        return self.energies_and_gradient( X )[1]
+
+    def value_and_gradient( self, X ):
+        '''
+        the total energy and its gradient, for minimize( ..., jac = True )
+        '''
+        E, grad = self.energies_and_gradient( X )
+        return E.sum(), grad
+
+
+def batched_bfgs( batch, X0, gtol = 0.0001, maxiter = 1000 ):
+    '''
+    scipy's BFGS ( minimize( ..., method = 'BFGS' ) as MVC_magnitudes calls it ) on every curve
+    of batch separately, in lockstep: every curve has its own inverse Hessian estimate, the same
+    initial step guess and the same line search ( LineSearch ), and each energy and gradient
+    evaluation of the batch serves all curves. A curve takes the steps its own minimize takes.
+    Given:
+        batch: a CurveBatch
+        X0: initial magnitudes of all curves
+        gtol: a curve is done when the max norm of its gradient is below gtol
+        maxiter: maximum number of iterations of a curve
+    Return:
+        X, number of iterations, and for every curve whether its line search failed
+        ( where scipy falls back to another line search, so that curve has to be solved alone )
+    '''
+    curve_of_x = batch.curve_of_x
+    blocks = [ slice( batch.offsets[c], batch.offsets[c+1] ) for c in range( batch.n_curves ) ]
+
+    X = np.array( X0, dtype = float )
+    E, G = batch.energies_and_gradient( X )
+    H = [ np.eye( b.stop - b.start ) for b in blocks ]
+    # the energy of the previous iteration, for the initial step guess; the first guess is a step of length about 1
+    E_old = np.asarray( [ E[c] + np.linalg.norm( G[ blocks[c] ] ) / 2 for c in range( batch.n_curves ) ] )
+
+    active = np.asarray( [ np.abs( G[b] ).max( initial = 0 ) > gtol for b in blocks ], dtype = bool )
+    failed = np.zeros( batch.n_curves, dtype = bool )
+    nit = 0
+    while active.any() and nit < maxiter:
+        P = np.zeros( len( X ) )
+        for c in np.flatnonzero( active ):
+            P[ blocks[c] ] = -H[c] @ G[ blocks[c] ]
+        slope = np.bincount( curve_of_x, G * P, minlength = batch.n_curves )
+
+        searches = {}
+        step = np.zeros( batch.n_curves )
+        for c in np.flatnonzero( active ):
+            step[c] = min( 1., 1.01 * 2 * ( E[c] - E_old[c] ) / slope[c] ) if slope[c] != 0 else 1.
+            if step[c] < 0: step[c] = 1.
+            searches[c] = LineSearch( E[c], slope[c], step[c] )
+            if searches[c].failed:
+                del searches[c]
+                failed[c] = True
+                active[c] = False
+
+        X_new, E_new, G_new = X.copy(), E.copy(), G.copy()
+        for trial in range( LineSearch.max_trials ):
+            if not searches: break
+            X_trial = X + step[ curve_of_x ] * P
+            E_trial, G_trial = batch.energies_and_gradient( X_trial )
+            slope_trial = np.bincount( curve_of_x, G_trial * P, minlength = batch.n_curves )
+            for c in list( searches ):
+                done, step[c] = searches[c].next_step( step[c], E_trial[c], slope_trial[c] )
+                if done is None: continue
+                del searches[c]
+                if done:
+                    X_new[ blocks[c] ] = X_trial[ blocks[c] ]
+                    G_new[ blocks[c] ] = G_trial[ blocks[c] ]
+                    E_new[c] = E_trial[c]
+                else:
+                    failed[c] = True
+                    active[c] = False
+        for c in searches:
+            failed[c] = True
+            active[c] = False
+        # the curves without a step stay where they are
+        step[ ~active ] = 0.
+
+        for c in np.flatnonzero( active ):
+            s = step[c] * P[ blocks[c] ]
+            y = G_new[ blocks[c] ] - G[ blocks[c] ]
+            if np.abs( G_new[ blocks[c] ] ).max( initial = 0 ) <= gtol or np.linalg.norm( s ) == 0:
+                active[c] = False
+                continue
+            if not np.isfinite( E_new[c] ):
+                failed[c] = True
+                active[c] = False
+                continue
+            ys = np.dot( y, s )
+            rho = 1000. if ys == 0 else 1 / ys
+            I = np.eye( len( s ) )
+            H[c] = ( I - rho * np.outer( s, y ) ) @ H[c] @ ( I - rho * np.outer( y, s ) ) + rho * np.outer( s, s )
+
+        E_old = np.where( step > 0, E, E_old )
+        X, E, G = X_new, E_new, G_new
+        nit += 1
+
+    return X, nit, failed
+
+
+class LineSearch:
+    '''
+    The line search of scipy's BFGS ( MINPACK's dcsrch, which scipy's line_search_wolfe1 calls ),
+    for a step with sufficient decrease ( c1 ) and the strong curvature condition ( c2 ),
+    by safeguarded cubic and quadratic interpolation.
+    It is driven from outside, so that batched_bfgs evaluates the trial steps of all the curves at once:
+        search = LineSearch( f0, g0, step )
+        done, step = search.next_step( step, f( step ), g( step ) )
+    until done is not None ( True: step is accepted, False: the search failed ).
+    '''
+    # evaluations, as scipy's 100 iterations of dcsrch including its start
+    max_trials = 99
+
+    def __init__( self, f0, g0, step, c1 = 0.0001, c2 = 0.9, xtol = 1e-14, step_min = 1e-100, step_max = 1e100 ):
+        '''
+        Given:
+            f0, g0: the function and its slope along the search direction at step 0, g0 < 0
+            step: the first trial step
+        '''
+        self.c1, self.c2, self.xtol = c1, c2, xtol
+        self.step_min, self.step_max = step_min, step_max
+        self.f0, self.g0 = f0, g0
+        self.failed = not ( step_min <= step <= step_max ) or not g0 < 0
+        if self.failed:
+            return
+
+        self.gtest = c1 * g0
+        self.bracketed = False
+        self.stage = 1
+        self.width = step_max - step_min
+        self.width1 = self.width / 0.5
+        # the best step so far, and the other end of the interval
+        self.stx, self.fx, self.gx = 0., f0, g0
+        self.sty, self.fy, self.gy = 0., f0, g0
+        self.lower = 0.
+        self.upper = step + 4.0 * step
+
+    def next_step( self, step, f, g ):
+        '''
+        Given:
+            step: the step just evaluated
+            f, g: the function and its slope there
+        Return:
+            done ( None to evaluate the returned step next ), step
+        '''
+        ftest = self.f0 + step * self.gtest
+        if self.stage == 1 and f <= ftest and g >= 0:
+            self.stage = 2
+
+        if f <= ftest and abs( g ) <= self.c2 * -self.g0:
+            return True, step
+        if ( self.bracketed and ( step <= self.lower or step >= self.upper ) ) \
+           or ( self.bracketed and self.upper - self.lower <= self.xtol * self.upper ) \
+           or ( step == self.step_max and f <= ftest and g <= self.gtest ) \
+           or ( step == self.step_min and ( f > ftest or g >= self.gtest ) ):
+            # rounding errors prevent progress, or the step hit a bound
+            return False, step
+
+        if self.stage == 1 and f <= self.fx and f > ftest:
+            # the modified function f - step * gtest, until a step with sufficient decrease and a positive slope
+            t = self.gtest
+            stx, fxm, gxm, sty, fym, gym, step, self.bracketed = _dcstep(
+                self.stx, self.fx - self.stx * t, self.gx - t, self.sty, self.fy - self.sty * t, self.gy - t,
+                step, f - step * t, g - t, self.bracketed, self.lower, self.upper )
+            self.stx, self.sty = stx, sty
+            self.fx, self.fy = fxm + stx * t, fym + sty * t
+            self.gx, self.gy = gxm + t, gym + t
+        else:
+            self.stx, self.fx, self.gx, self.sty, self.fy, self.gy, step, self.bracketed = _dcstep(
+                self.stx, self.fx, self.gx, self.sty, self.fy, self.gy,
+                step, f, g, self.bracketed, self.lower, self.upper )
+
+        if self.bracketed:
+            # bisect if the interval did not shrink enough
+            if abs( self.sty - self.stx ) >= 0.66 * self.width1:
+                step = self.stx + 0.5 * ( self.sty - self.stx )
+            self.width1 = self.width
+            self.width = abs( self.sty - self.stx )
+            self.lower, self.upper = min( self.stx, self.sty ), max( self.stx, self.sty )
+        else:
+            self.lower = step + 1.1 * ( step - self.stx )
+            self.upper = step + 4.0 * ( step - self.stx )
+
+        step = min( max( step, self.step_min ), self.step_max )
+        if self.bracketed and ( step <= self.lower or step >= self.upper or self.upper - self.lower <= self.xtol * self.upper ):
+            step = self.stx
+        if not np.isfinite( step ):
+            return False, step
+        return None, step
+
+
+def _dcstep( stx, fx, dx, sty, fy, dy, stp, fp, dp, bracketed, stpmin, stpmax ):
+    '''
+    MINPACK's dcstep: the next trial step of LineSearch and the updated interval
+    from the best step stx, the other end sty and the trial stp, with their values f and slopes d
+    '''
+    sgnd = np.sign( dp ) * np.sign( dx )
+    with np.errstate( invalid = 'ignore', over = 'ignore', divide = 'ignore' ):
+        if fp > fx:
+            # higher function value, the minimum is bracketed
+            theta = 3 * ( fx - fp ) / ( stp - stx ) + dx + dp
+            s = max( abs( theta ), abs( dx ), abs( dp ) )
+            gamma = s * np.sqrt( ( theta / s )**2 - ( dx / s ) * ( dp / s ) )
+            if stp < stx: gamma = -gamma
+            r = ( ( gamma - dx ) + theta ) / ( ( ( gamma - dx ) + gamma ) + dp )
+            stpc = stx + r * ( stp - stx )
+            stpq = stx + ( ( dx / ( ( fx - fp ) / ( stp - stx ) + dx ) ) / 2 ) * ( stp - stx )
+            stpf = stpc if abs( stpc - stx ) <= abs( stpq - stx ) else stpc + ( stpq - stpc ) / 2
+            bracketed = True
+        elif sgnd < 0:
+            # the slopes have opposite signs, the minimum is bracketed
+            theta = 3 * ( fx - fp ) / ( stp - stx ) + dx + dp
+            s = max( abs( theta ), abs( dx ), abs( dp ) )
+            gamma = s * np.sqrt( ( theta / s )**2 - ( dx / s ) * ( dp / s ) )
+            if stp > stx: gamma = -gamma
+            r = ( ( gamma - dp ) + theta ) / ( ( ( gamma - dp ) + gamma ) + dx )
+            stpc = stp + r * ( stx - stp )
+            stpq = stp + ( dp / ( dp - dx ) ) * ( stx - stp )
+            stpf = stpc if abs( stpc - stp ) > abs( stpq - stp ) else stpq
+            bracketed = True
+        elif abs( dp ) < abs( dx ):
+            # the slope decreases in magnitude
+            theta = 3 * ( fx - fp ) / ( stp - stx ) + dx + dp
+            s = max( abs( theta ), abs( dx ), abs( dp ) )
+            gamma = s * np.sqrt( max( 0, ( theta / s )**2 - ( dx / s ) * ( dp / s ) ) )
+            if stp > stx: gamma = -gamma
+            r = ( ( gamma - dp ) + theta ) / ( ( gamma + ( dx - dp ) ) + gamma )
+            if r < 0 and gamma != 0:
+                stpc = stp + r * ( stx - stp )
+            elif stp > stx:
+                stpc = stpmax
+            else:
+                stpc = stpmin
+            stpq = stp + ( dp / ( dp - dx ) ) * ( stx - stp )
+            if bracketed:
+                stpf = stpc if abs( stpc - stp ) < abs( stpq - stp ) else stpq
+                if stp > stx:
+                    stpf = min( stp + 0.66 * ( sty - stp ), stpf )
+                else:
+                    stpf = max( stp + 0.66 * ( sty - stp ), stpf )
+            else:
+                stpf = stpc if abs( stpc - stp ) > abs( stpq - stp ) else stpq
+                stpf = min( max( stpf, stpmin ), stpmax )
+        else:
+            # the slope does not decrease in magnitude
+            if bracketed:
+                theta = 3 * ( fp - fy ) / ( sty - stp ) + dy + dp
+                s = max( abs( theta ), abs( dy ), abs( dp ) )
+                gamma = s * np.sqrt( ( theta / s )**2 - ( dy / s ) * ( dp / s ) )
+                if stp > sty: gamma = -gamma
+                r = ( ( gamma - dp ) + theta ) / ( ( ( gamma - dp ) + gamma ) + dy )
+                stpf = stp + r * ( sty - stp )
+            elif stp > stx:
+                stpf = stpmax
+            else:
+                stpf = stpmin
+
+    if fp > fx:
+        sty, fy, dy = stp, fp, dp
+    else:
+        if sgnd < 0:
+            sty, fy, dy = stx, fx, dx
+        stx, fx, dx = stp, fp, dp
+    return stx, fx, dx, sty, fy, dy, stpf, bracketed
+
+
+# batched_bfgs iterations of MVC_magnitudes_parallel, in this process or its pool, read by benchmarks/replay.py
+bfgs_iterations = 0
+
+def MVC_magnitudes_batch( curves, max_samples = None ):
+    '''
+    Given:
+        curves: a sequence of ( points, tangents ), as for MVC_magnitudes
+        max_samples: samples per segment cap, e.g. adaptive_max_samples, or None to sample as MVC_magnitudes
+    Returns:
+        magnitudes: for every curve, the 2 * N - 2 magnitudes MVC_magnitudes returns for it
+        counts: { 'bfgs_iterations', 'batch_fallbacks' } of the solve, for the caller to trace
+                ( this may run in a pool worker, whose counters the server does not see )
+    '''
+    counts = { 'bfgs_iterations': 0, 'batch_fallbacks': 0 }
+    if len( curves ) == 0:
+        return [], counts
+
+    batch = CurveBatch( curves, max_samples = max_samples )
+    X = np.concatenate( [ init_X( np.asarray( points ) ) for points, tangents in curves ] )
+
+    x, nit, failed = batched_bfgs( batch, X )
+    counts['bfgs_iterations'] = nit
+    print( 'batched curve optimization', len( curves ), 'curves', nit, 'iterations' )
+
+    magnitudes = []
+    for c in range( batch.n_curves ):
+        X_curve = X[ batch.offsets[c] : batch.offsets[c+1] ]
+        x_curve = x[ batch.offsets[c] : batch.offsets[c+1] ]
+        # a curve whose line search failed ( scipy's BFGS goes on with another one ), with a magnitude
+        # of flipped sign ( a cusp ), or which failed the guard of MVC_magnitudes, is solved alone
+        if failed[c] or np.any( np.sign( x_curve ) != np.sign( X_curve ) ) \
+           or np.linalg.norm( x_curve ) / np.linalg.norm( X_curve ) >= 10:
+            print( 'batched curve', c, 'solved again alone' )
+            counts['batch_fallbacks'] += 1
+            magnitudes.append( MVC_magnitudes( *curves[c] ) )
+        else:
+            magnitudes.append( x_curve.tolist() )
+    return magnitudes, counts
+
+
+
+## Process pool
+#
+# the curves are independent, so MVC_magnitudes_parallel splits a batch over worker processes,
+# each solving its part with MVC_magnitudes_batch. The pool is started once ( start_pool, at server start ),
+# so the process startup and the numpy / scipy imports are not paid per message.
+
+# batches with fewer curves are solved in-process, sending them costs more than it saves
+parallel_min_curves = 6
+
+_pool = None
+_pool_workers = 0
+
+def _warm_up( i ):
+    return os.getpid()
+
+def start_pool( workers = None ):
+    '''
+    Given:
+        workers: number of processes, None for one per core
+    Returns:
+        the pool, started and warmed up, or None on a single core
+    '''
+    global _pool, _pool_workers
+    workers = workers or os.cpu_count() or 1
+    if _pool is None and workers > 1:
+        _pool_workers = workers
+        _pool = concurrent.futures.ProcessPoolExecutor( max_workers = _pool_workers )
+        # start every worker now
+        list( _pool.map( _warm_up, range( _pool_workers ) ) )
+    return _pool
+
+def stop_pool():
+    global _pool, _pool_workers
+    if _pool is not None:
+        _pool.shutdown()
+    _pool = None
+    _pool_workers = 0
+
+def _curve_cost( curve ):
+    '''
+    about the number of samples of a curve
+    '''
+    points = np.asarray( curve[0] )
+    return np.linalg.norm( points[1:] - points[:-1], axis = 1 ).sum() + len( points )
+
+def MVC_magnitudes_parallel( curves, max_samples = None ):
+    '''
+    MVC_magnitudes_batch over the workers of start_pool,
+    in-process if there is no pool or only a few curves
+    '''
+    if _pool is None or _pool_workers < 2 or len( curves ) < parallel_min_curves:
+        magnitudes, counts = MVC_magnitudes_batch( curves, max_samples )
+        _count( counts )
+        return magnitudes
+
+    # longest first into the least loaded part
+    parts = [ [] for i in range( min( _pool_workers, len( curves ) ) ) ]
+    loads = np.zeros( len( parts ) )
+    costs = [ _curve_cost( curve ) for curve in curves ]
+    for i in np.argsort( costs )[::-1]:
+        part = np.argmin( loads )
+        parts[part].append( i )
+        loads[part] += costs[i]
+
+    futures = [ _pool.submit( MVC_magnitudes_batch, [ curves[i] for i in part ], max_samples ) for part in parts ]
+
+    magnitudes = [ None ] * len( curves )
+    for part, future in zip( parts, futures ):
+        part_magnitudes, counts = future.result()
+        _count( counts )
+        for i, m in zip( part, part_magnitudes ):
+            magnitudes[i] = m
+    return magnitudes
+
+def _count( counts ):
+    '''
+    the counts of an MVC_magnitudes_batch, into bfgs_iterations and the curves.* counters
+    '''
+    global bfgs_iterations
+    bfgs_iterations += counts['bfgs_iterations']
+    for name, value in counts.items():
+        tracing.count( 'curves.' + name, value )
+
+
+## Memo cache
+#
+# the energy does not change under translation and rotation of a curve. It does change under scale:
+# the sample count of a segment follows its length, so a scaled curve has other optimal magnitudes
+# than the scaled ones. MagnitudeCache keys a curve by its key points and tangents in a canonical frame:
+# origin at the first key point, first axis along the chord, second axis from the first key point
+# or tangent which is not parallel to it ( Gram-Schmidt ), lengths kept.
+# A translated face, or a pose visited again, then finds the magnitudes solved before.
+
+def canonical_form( points, tangents, decimals = 6 ):
+    '''
+    Given:
+        points: the N key points of a curve
+        tangents: its N unit tangents
+        decimals: rounding of the canonical coordinates in the key
+    Returns:
+        key: a hashable key of the curve up to translation and rotation,
+             None for a curve of a single point
+    '''
+    points = np.asarray( points, dtype = float )
+    tangents = np.asarray( tangents, dtype = float )
+
+    P = points - points[0]
+    norms = np.linalg.norm( P, axis = 1 )
+    scale = np.linalg.norm( P[-1] )
+    # a closed curve has no chord, use its farthest key point instead
+    axis_point = P[-1] if scale > 1e-12 * max( 1., norms.max() ) else P[ np.argmax( norms ) ]
+    scale = np.linalg.norm( axis_point )
+    if scale < 1e-12:
+        return None
+    e1 = axis_point / scale
+
+    e2 = None
+    for v in np.concatenate( ( P[1:], tangents ) ):
+        w = v - np.dot( v, e1 ) * e1
+        if np.linalg.norm( w ) > 1e-6 * max( np.linalg.norm( v ), 1e-12 ):
+            e2 = w / np.linalg.norm( w )
+            break
+    if e2 is None:
+        # everything is on one line, any perpendicular axis does
+        w = np.eye( 3 )[ np.argmin( np.abs( e1 ) ) ]
+        w = w - np.dot( w, e1 ) * e1
+        e2 = w / np.linalg.norm( w )
+    R = np.stack( [ e1, e2, np.cross( e1, e2 ) ] )
+
+    canonical = np.concatenate( ( P @ R.T, tangents @ R.T ) )
+    # + 0. turns -0. into 0.
+    return ( len( points ), ) + tuple( ( np.round( canonical, decimals ) + 0. ).ravel().tolist() )
+
+
+class MagnitudeCache:
+    '''
+    LRU cache of optimized magnitudes, keyed by canonical_form.
+    '''
+
+    def __init__( self, maxsize = 1024, decimals = 6 ):
+        self.maxsize = maxsize
+        self.decimals = decimals
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key( self, points, tangents, max_samples = None ):
+        '''
+        Returns:
+            the cache key of the curve, see canonical_form
+        '''
+        key = canonical_form( points, tangents, self.decimals )
+        if key is None:
+            return None
+        return ( max_samples, ) + key
+
+    def get( self, key ):
+        '''
+        Returns:
+            the magnitudes for key, or None if it was not solved before
+        '''
+        if key is None or key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end( key )
+        return list( self.entries[key] )
+
+    def put( self, key, magnitudes ):
+        if key is None:
+            return
+        self.entries[key] = tuple( magnitudes )
+        self.entries.move_to_end( key )
+        while len( self.entries ) > self.maxsize:
+            self.entries.popitem( last = False )
+
+    def lookup( self, points, tangents, max_samples = None ):
+        return self.get( self.key( points, tangents, max_samples ) )
+
+    def store( self, points, tangents, magnitudes, max_samples = None ):
+        self.put( self.key( points, tangents, max_samples ), magnitudes )
+
+    def clear( self ):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats( self ):
+        lookups = self.hits + self.misses
+        return { 'hits': self.hits, 'misses': self.misses, 'size': len( self.entries ),
+                 'hit_rate': self.hits / lookups if lookups else 0. }
+
+
+# the cache of optimize_curves
+magnitude_cache = MagnitudeCache()
+
+
+def MVC_magnitudes_cached( curves, max_samples = None, cache = None ):
+    '''
+    MVC_magnitudes_batch for the curves which are not in the cache
+    Given:
+        curves: a sequence of ( points, tangents ), as for MVC_magnitudes
+        max_samples: as for MVC_magnitudes_batch
+        cache: a MagnitudeCache, magnitude_cache if None
+    Returns:
+        magnitudes: for every curve
+    '''
+    if cache is None:
+        cache = magnitude_cache
+
+    keys = [ cache.key( points, tangents, max_samples ) for points, tangents in curves ]
+    magnitudes = [ cache.get( key ) for key in keys ]
+
+    # curves of the same shape and size ( e.g. the wheels of the truck ) are solved once
+    missing = {}
+    for i, m in enumerate( magnitudes ):
+        if m is None:
+            missing.setdefault( keys[i] if keys[i] is not None else ( 'uncached', i ), [] ).append( i )
+    solve = [ indices[0] for indices in missing.values() ]
+
+    solved = MVC_magnitudes_parallel( [ curves[i] for i in solve ], max_samples )
+    for indices, m in zip( missing.values(), solved ):
+        cache.put( keys[ indices[0] ], m )
+        for i in indices:
+            magnitudes[i] = list( m )
+
+    tracing.count( 'curves.solved', len( solve ) )
+    tracing.count( 'curves.cached', len( curves ) - len( solve ) )
+    return magnitudes
@@ -0,0 +1,214 @@
+# append-only session log
+#
+# edit_server used to json.dump all history states to one file after every message,
+# so the writes grew with the length of the session and blocked the event loop.
+# A session log is a json lines file instead, one record per line:
+#
+#     { "type": "checkpoint", "version": v, "state": state }
+#     { "type": "delta", "version": v, "base": v - 1, "command": command, "delta": delta }
+#     { "type": "undo", "version": v }           v is the version the user is back at
+#     { "type": "redo", "version": v }
+#
+# a checkpoint or delta with "amend": true replaces version v ( the last one ) instead,
+# its delta is still against version v - 1. The poses of one drag amend each other.
+#
+# versions are the saved states in order, as in history.History,
+# deltas are state_delta.diff_states against the previous version
+# and every `checkpoint_interval` versions the whole state is written again.
+# The records are built and written by a background thread, which fsyncs
+# at most every `fsync_interval` seconds.
+#
+# `load_versions` rebuilds all versions and `compact` writes them in the old layout,
+# a json list of all history states:
+#     python session_log.py session.jsonl [output.json]
+
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+import state_delta
+
+
+class SessionLog:
+    '''
+    Writes the versions of one session to an append-only log.
+
+    `record` only queues the snapshot, the delta and the json are computed by the writer thread.
+    The snapshots must not be modified afterwards, which history.snapshot guarantees.
+    '''
+
+    def __init__( self, path, checkpoint_interval = 50, fsync_interval = 1.0 ):
+        '''
+        path: the .jsonl file, appended to if it exists
+        checkpoint_interval: versions between two full states
+        fsync_interval: seconds between two fsync's
+        '''
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+        self.fsync_interval = fsync_interval
+
+        self.version = -1
+        self.previous = None
+        self.base = None
+
+        self.queue = queue.Queue()
+        self.file = open( path, 'a' )
+        self.thread = threading.Thread( target = self._write_loop, name = 'session-log', daemon = True )
+        self.thread.start()
+
+    def record( self, command, snapshot, amend = False ):
+        '''
+        Given:
+            command: the websocket command which produced the version, e.g. 'move-line'
+            snapshot: the new version, from history.snapshot
+            amend: snapshot replaces the last version, as in history.History.save
+        '''
+        self.queue.put( ( 'amend' if amend else 'version', command, snapshot ) )
+
+    def record_undo( self, version ):
+        self.queue.put( ( 'undo', version, None ) )
+
+    def record_redo( self, version ):
+        self.queue.put( ( 'redo', version, None ) )
+
+    def close( self ):
+        '''
+        writes everything queued and closes the file
+        '''
+        self.queue.put( None )
+        self.thread.join()
+        self.file.close()
+
+    def _make_record( self, kind, argument, snapshot ):
+        if kind in ( 'undo', 'redo' ):
+            return { 'type': kind, 'version': argument }
+
+        amend = kind == 'amend' and self.previous is not None
+        if not amend:
+            self.version += 1
+            self.base = self.previous
+
+        if self.base is None or self.version % self.checkpoint_interval == 0:
+            record = { 'type': 'checkpoint', 'version': self.version, 'command': argument, 'state': snapshot }
+        else:
+            record = { 'type': 'delta', 'version': self.version, 'base': self.version - 1, 'command': argument,
+                       'delta': state_delta.diff_states( self.base, snapshot ) }
+        if amend:
+            record['amend'] = True
+        self.previous = snapshot
+        return record
+
+    def _write_loop( self ):
+        last_sync = time.time()
+        pending = False
+        done = False
+        while not done:
+            # wait for the next record, but not past the next fsync
+            timeout = None if not pending else max( 0., last_sync + self.fsync_interval - time.time() )
+            try:
+                items = [ self.queue.get( timeout = timeout ) ]
+            except queue.Empty:
+                items = []
+            # and write everything else which is queued in the same batch
+            while True:
+                try:
+                    items.append( self.queue.get_nowait() )
+                except queue.Empty:
+                    break
+
+            for item in items:
+                if item is None:
+                    done = True
+                    break
+                self.file.write( json.dumps( self._make_record( *item ) ) + '\n' )
+                pending = True
+
+            if pending and ( done or time.time() - last_sync >= self.fsync_interval ):
+                self.file.flush()
+                os.fsync( self.file.fileno() )
+                last_sync = time.time()
+                pending = False
+
+
+def read_records( path ):
+    '''
+    the records of a session log, a truncated last line ( e.g. after a crash ) is skipped
+    '''
+    with open( path ) as f:
+        for line in f:
+            try:
+                yield json.loads( line )
+            except ValueError:
+                break
+
+
+def load_versions( path ):
+    '''
+    Given:
+        path: a session log
+    Return:
+        all saved states in order, like history.History.export_states
+    '''
+    versions = []
+    for record in read_records( path ):
+        if record['type'] == 'checkpoint':
+            state = record['state']
+        elif record['type'] == 'delta':
+            state = state_delta.apply_delta( versions[ record['base'] ], record['delta'] )
+        else:
+            continue
+        if record.get( 'amend' ):
+            assert record['version'] == len( versions ) - 1
+            versions[-1] = state
+        else:
+            assert record['version'] == len( versions )
+            versions.append( state )
+    return versions
+
+
+def load_version( path, version ):
+    '''
+    Given:
+        path: a session log
+        version: index of a saved state
+    Return:
+        that state, without keeping the other versions in memory
+    '''
+    base, state, current = None, None, -1
+    for record in read_records( path ):
+        if record['type'] not in ( 'checkpoint', 'delta' ):
+            continue
+        if record['version'] > version:
+            break
+        if not record.get( 'amend' ):
+            base = state
+        if record['type'] == 'checkpoint':
+            state = record['state']
+        else:
+            state = state_delta.apply_delta( base, record['delta'] )
+        current = record['version']
+    if current != version:
+        raise IndexError( 'version %d is not in %s' % ( version, path ) )
+    return state
+
+
+def compact( path, output_path ):
+    '''
+    writes all saved states of the session log at path to output_path,
+    in the layout edit_server.export used to write
+    '''
+    with open( output_path, 'w' ) as f:
+        json.dump( load_versions( path ), f )
+
+
+if __name__ == '__main__':
+    if len( sys.argv ) not in ( 2, 3 ):
+        print( 'usage: python session_log.py session.jsonl [output.json]' )
+        sys.exit( 1 )
+    log_path = sys.argv[1]
+    output_path = sys.argv[2] if len( sys.argv ) == 3 else os.path.splitext( log_path )[0] + '.json'
+    compact( log_path, output_path )
+    print( 'Saved:', output_path )
@@ -6,7 +6,13 @@
 ### step 4: pass the state back to front end
 import numpy as np
 import reoptimize_curve
+import constraint_energy
+import irls_solver
+import constraint_index
+import point_graph
+import tracing
 import scipy
+import scipy.optimize
 
 
 # do not use scientific notion for Unity side
@@ -15,8 +21,11 @@ np.set_printoptions(suppress=True)
 
 ### lines and points generator
 def all_points_positions( points ):
-    
-    return [node_i_position(i, points) for i in range(len(points))]
+    '''
+    return ( n_points, 3 ) array of all point positions,
+    the same values as node_i_position for every point, see point_graph.py
+    '''
+    return point_graph.point_graph( points ).resolve( points )
 
 def node_i_position(index, points):
     '''
@@ -120,6 +129,9 @@ def project_point_on_line_as_t( point, line ):
     return t
 
 
+# cap the samples per curve segment in optimize_curves, see reoptimize_curve.adaptive_max_samples
+adaptive_curve_sampling = False
+
 # below thresholds chosen from experiments
 # parallel_angle : 6 degree (5~10 good)
 # perpendiuclar_angle : 5 degree 
@@ -148,37 +160,65 @@ def find_free_lines_indices( linesData ):
 
 
 
-def calculate_constraints( lines, free_lines ):
+def indexed_constraint_values( index, i, J, constraint_type ):
+    '''
+    the energies between line i and the lines J, from the directions and lengths in the index
+    '''
+    J = np.asarray( J, dtype = int )
+    if constraint_type == 'equal_length':
+        return ( index.lengths[i] / index.lengths[J] - 1 ) ** 2
+
+    dots = index.directions[J] @ index.directions[i]
+    if constraint_type == 'parallel':
+        return ( 1 - np.abs( dots ) ) ** 2
+    else:
+        return dots ** 2
+
+
+def close_lines( index, i, candidates, constraint_type ):
     '''
+    the candidates j whose constraint with line i is below the threshold, in increasing order
+    '''
+    J = sorted( candidates )
+    if len( J ) == 0:
+        return []
+
+    threshold_key = { 'equal_length': 'line_length_ratio2',
+                      'parallel': 'line_line_parallel2',
+                      'perpendicular': 'line_line_perpendicular2' }[ constraint_type ]
+
+    values = indexed_constraint_values( index, i, J, constraint_type )
+    return [ j for j, value in zip( J, values ) if value < thresholds[threshold_key] ]
+
+
+def calculate_constraints( lines, free_lines, index = None ):
+    '''
+    lines: all lines positions
+    free_lines: the free lines indices
+    index: a constraint_index.ConstraintIndex of the free lines, built if None
     '''
     constraints = {}
     constraints['equal_length'] = set()
     constraints['parallel'] = set()
     constraints['perpendicular'] = set()
 
-    # i and j : real line index
-    # index_i and index_j : index in the free_lines_indices
-    for index_i in range(len(free_lines)):
-        i = free_lines[index_i]
-        line0 = lines[ i ]
-        for index_j in range(index_i+1, len(free_lines)):
-            j = free_lines[index_j]
-            line1 = lines[ j ]
-
-
-            line0_length = point_point_distance(line0[0], line0[1])
-            line1_length = point_point_distance(line1[0], line1[1])
-
+    if index is None:
+        index = constraint_index.ConstraintIndex( lines, free_lines, thresholds )
 
+    # i and j : real line index
+    # only the pairs i < j in the free lines, the ratio of the lengths is length_i / length_j
+    free_set = set( free_lines )
+    for i in free_lines:
+        later = lambda candidates: [ j for j in candidates if j > i and j in free_set ]
 
-            if length_length_ratio2( line0_length, line1_length ) < thresholds['line_length_ratio2']:
-                constraints['equal_length'].add((i,j))
+        for j in close_lines( index, i, later( index.equal_length_candidates( index.lengths[i] ) ), 'equal_length' ):
+            constraints['equal_length'].add((i,j))
 
-            if line_line_parallel2(line0, line1) < thresholds['line_line_parallel2']:
-                constraints['parallel'].add((i,j))
+        for j in close_lines( index, i, later( index.parallel_candidates( index.directions[i] ) ), 'parallel' ):
+            constraints['parallel'].add((i,j))
 
-            if line_line_perpendicular2(line0, line1) < thresholds['line_line_perpendicular2']:
-                constraints['perpendicular'].add((i,j))
+        for j in close_lines( index, i, later( index.perpendicular_candidates( index.directions[i] ) ), 'perpendicular' ):
+            constraints['perpendicular'].add((i,j))
 
 
     return constraints
@@ -253,12 +293,13 @@ def find_updated_edges_indices( lines, moved_lines, free_lines , epsilon = 1e-3)
     return result
 
 
-def find_new_constraints(moved_lines, updated_edges_indices, changed_edges_indices, free_lines_indices):
+def find_new_constraints(moved_lines, updated_edges_indices, changed_edges_indices, free_lines_indices, index = None):
     '''
     moved_lines:
     updated_edges_indices: the updated edges indices
     changed_edges_indices: the actual selected and moved red edges
     free_lines_indices: the free lines set, only the lines both endpoints are vertex
+    index: a constraint_index.ConstraintIndex of the free lines in moved_lines, built if None
     '''
 
     c = {}
@@ -266,52 +307,36 @@ def find_new_constraints(moved_lines, updated_edges_indices, changed_edges_indic
     c['parallel'] = set()
     c['perpendicular'] = set()
 
-        
-    for i in updated_edges_indices:
-        line0 = moved_lines[i]          
-        for index_j in range(len(free_lines_indices)):
-            j = free_lines_indices[index_j]
-            line1 = moved_lines[j]
+    if index is None:
+        index = constraint_index.ConstraintIndex( moved_lines, free_lines_indices, thresholds )
 
-            if i != j:
-                pair = (i, j) if i < j else (j, i)
-                if line_line_parallel2(line0, line1) < thresholds['line_line_parallel2']:
-                    c['parallel'].add( pair )
+    # the changed edges are not necessarily free lines, index them too
+    index.update( moved_lines, [ i for i in changed_edges_indices if not index.indexed[i] ] )
 
-                if line_line_perpendicular2(line0, line1) < thresholds['line_line_perpendicular2']:
-                    c['perpendicular'].add( pair )
+    free_set = set( free_lines_indices )
+    others = lambda i, candidates: [ j for j in candidates if j != i and j in free_set ]
+    ordered = lambda i, j: (i, j) if i < j else (j, i)
 
-                ## check the length between
-                # line0_length = point_point_distance(line0[0], line0[1])
-                # line1_length = point_point_distance(line1[0], line1[1])
+    for i in updated_edges_indices:
+        for j in close_lines( index, i, others( i, index.parallel_candidates( index.directions[i] ) ), 'parallel' ):
+            c['parallel'].add( ordered( i, j ) )
 
-                # if length_length_ratio2( line0_length, line1_length ) < thresholds['line_length_ratio2']:
-                #     c['equal_length'].add( pair ) 
+        for j in close_lines( index, i, others( i, index.perpendicular_candidates( index.directions[i] ) ), 'perpendicular' ):
+            c['perpendicular'].add( ordered( i, j ) )
 
     # check whether there are equal length between the updated lines
+    # both length_i / length_j and length_j / length_i are tested
+    updated_set = set( updated_edges_indices )
     for i in updated_edges_indices:
-        line0 = moved_lines[i]
-        for j in updated_edges_indices:
-            line1 = moved_lines[j]
-            if i != j:
-                pair = (i, j) if i < j else (j, i)   
-                line0_length = point_point_distance(line0[0], line0[1])
-                line1_length = point_point_distance(line1[0], line1[1])
-                if length_length_ratio2(line0_length, line1_length) < thresholds['line_length_ratio2']:
-                    c['equal_length'].add( pair )   
+        candidates = [ j for j in index.equal_length_candidates( index.lengths[i] ) if j != i and j in updated_set ]
+        for j in close_lines( index, i, candidates, 'equal_length' ):
+            c['equal_length'].add( ordered( i, j ) )
 
     # the changed_edges_indices are the edges being selected and changed
     # and we compare this with all the free_lines
     for i in changed_edges_indices:
-        line0 = moved_lines[i]
-        for j in free_lines_indices:
-            line1 = moved_lines[j]
-            if i != j:
-                pair = (i, j) if i < j else (j, i)
-                line0_length = point_point_distance(line0[0], line0[1])
-                line1_length = point_point_distance(line1[0], line1[1])
-                if length_length_ratio2(line0_length, line1_length) < thresholds['line_length_ratio2']:
-                    c['equal_length'].add( pair )   
+        for j in close_lines( index, i, others( i, index.equal_length_candidates( index.lengths[i] ) ), 'equal_length' ):
+            c['equal_length'].add( ordered( i, j ) )
 
 
     # print('new_constraints in opt c3', c)
@@ -357,7 +382,11 @@ def unpack( points, live_vertex_indices, X ):
     return points
 
 
-def optimize_line(points, linesData, live_vertex_indices, constraints, weights):
+def optimize_line(points, linesData, live_vertex_indices, constraints, weights, method = 'BFGS'):
+    '''
+    method: 'BFGS', or a Hessian based method ( 'trust-ncg', 'trust-krylov', 'Newton-CG' )
+            which gets the Hessian-vector product of the energy
+    '''
 
     # print('points')
     # print(points)
@@ -365,135 +394,96 @@ def optimize_line(points, linesData, live_vertex_indices, constraints, weights):
     X0 = pack( points, live_vertex_indices )   
 
     # print('X0', X0)
-    
-    def E( X ):
-
-        e = 0
-
-        new_points = unpack(points, live_vertex_indices, X)
-        # print('new_points')
-        # print(new_points)
-        lines = all_lines_positions(linesData, new_points)
-        # print('lines', lines)
-
-
-        for constraint_type, constraint_values in constraints.items():
-            if constraint_type == 'equal_length':
-                for constraint_value in constraint_values:
-                    i, j = constraint_value
-                    p0, p1 = lines[i]
-                    q0, q1 = lines[j]
-                    # print(i, j)
-                    # print(p0, p1)
-                    # print(q0, q1)
-                    length0 = point_point_distance( p0, p1 )
-                    length1 = point_point_distance( q0, q1)
-                    length_energy = length_length_ratio2( length0, length1 )
-                    e += weights[constraint_type][constraint_value] * length_energy
-                    # print('length energy',length_energy)
-            if constraint_type == 'parallel': 
-                for constraint_value in constraint_values:
-                    i, j = constraint_value         
-                    line0 = lines[i]
-                    line1 = lines[j]
-                    # print(i, j)
-                    # print(line0)
-                    # print(line1)
-                    parallel_energy = line_line_parallel2(line0, line1)
-                    e += weights[constraint_type][constraint_value] * parallel_energy
-                    # print('parallel_energy', parallel_energy)
-            if constraint_type == 'perpendicular':
-                for constraint_value in constraint_values:
-                    i, j = constraint_value
-                    line0 = lines[i]
-                    line1 = lines[j]
-                    # print(i, j)
-                    # print(line0)
-                    # print(line1)
-                    perpendicular_energy = line_line_perpendicular2( line0, line1)
-                    e += weights[constraint_type][constraint_value] * perpendicular_energy
-                    # print('perpendicular energy', perpendicular_energy)
-        return e
-       
-    result = scipy.optimize.minimize( E,
-                                      X0,  
-                                      method = 'BFGS', 
-                                      tol = 0.000001, 
-                                      options = { 'disp': False, 'gtol': 0.000001, 'maxiter': 1000 } 
-                                    )
+
+    # all constraint pairs are evaluated at once, see constraint_energy.py
+    E = constraint_energy.ConstraintEnergy( points, linesData, live_vertex_indices, constraints, weights )
+
+    if method in constraint_energy.HESSP_METHODS:
+        result = scipy.optimize.minimize( E.value_and_gradient,
+                                          X0,
+                                          method = method,
+                                          jac = True,
+                                          hessp = E.hessp,
+                                          tol = 0.000001,
+                                          options = constraint_energy.minimize_options( method )
+                                        )
+    else:
+        result = scipy.optimize.minimize( E.value_and_gradient,
+                                          X0,  
+                                          method = method, 
+                                          jac = True,
+                                          tol = 0.000001, 
+                                          options = constraint_energy.minimize_options( method )
+                                        )
 
     # print(unpack(points, live_vertex_indices, result.x))
     # return unpack(points, live_vertex_indices, result.x)
     return result
 
-def IRLS( constraints, lines, points, linesData, live_vertex_indices, epsilon = 1e-6 ):
+def IRLS( constraints, lines, points, linesData, live_vertex_indices, epsilon = 1e-6, method = 'BFGS', max_iterations = 100 ):
     '''
     lines : moved lines
     points: moved points
-    '''
-    weights = {}
-    weights['parallel'] = {}
-    weights['perpendicular'] = {}
-    weights['equal_length'] = {}
-
-
-    for key,val in constraints.items():
-        for pair in val:
-            weights[key][pair] = 1
 
-    x_previous_iteration = pack(  points, live_vertex_indices )
-
-
-    while True:
-
-        points = unpack(points, live_vertex_indices, x_previous_iteration)
-        lines = all_lines_positions( linesData,  points)
-
-        weights_sum = 0
-
-        for key,val in weights.items():
-            if key == 'parallel':
-                for pair in val:
-                    i, j = pair
-                    func_val = line_line_parallel2( lines[i], lines[j] )
-                    weights[key][pair] = 1 / ( epsilon + func_val )
-                    weights_sum += 1 / ( epsilon +  func_val ) 
-            elif key == 'perpendicular':
-                for pair in val:
-                    i, j = pair
-                    func_val = line_line_perpendicular2( lines[i], lines[j] ) 
-                    weights[key][pair] = 1 / ( epsilon +  func_val )
-                    weights_sum += 1 / ( epsilon +  func_val )
-            elif key == 'equal_length':
-                for pair in val:
-                    i, j = pair
-                    length1 = point_point_distance(lines[i][0], lines[i][1])
-                    length2 = point_point_distance( lines[j][0], lines[j][1]) 
-                    func_val = length_length_ratio2(length1 , length2 )
-                    weights[key][pair] = 1 / ( epsilon +  func_val )
-                    weights_sum += 1 / ( epsilon + func_val)
-
-    
-        for key,val in weights.items():
-            for pair in val:
-                weights[key][pair] /= weights_sum
-
-        # print('weights', weights)
+    a cold solve, use an irls_solver.IRLSSolver to warm start consecutive moves
+    '''
+    solver = irls_solver.IRLSSolver( max_iterations = max_iterations, epsilon = epsilon, warm_start = False, method = method )
 
-        result = optimize_line(points, linesData, live_vertex_indices, constraints, weights)
+    return solver.solve( constraints, points, linesData, live_vertex_indices )
 
 
-        if np.abs(result.x - x_previous_iteration).sum() < epsilon:   
-            break
+def live_point_rows( pointsData, positions, live_vertex_indices, tick_indices ):
+    '''
+    Given:
+        pointsData: state['points']
+        positions: ( n_points, 3 ) point positions
+        live_vertex_indices: indices of the moved points
+        tick_indices: the moved points which are ticks, they get the t of their projected position
+    Return:
+        dictionary index -> the new state['points'] row
+    '''
+    rows = {}
+    for i in live_vertex_indices:
+        if i in tick_indices:
+            t = project_point_on_line( pointsData, positions, i, positions[i] )
+            rows[i] = [ float( t ) ] + list( pointsData[i][1:] )
         else:
-            x_previous_iteration = result.x
-
-
-    # print('optimized points', unpack(points, live_vertex_indices, result.x))
-    return unpack(points, live_vertex_indices, result.x)
+            rows[i] = np.asarray( positions[i], dtype = float ).tolist() + list( pointsData[i][3:] )
+    return rows
 
+def move_line_preview( input_data, state ):
+    '''
+    Given:
+        input_data, state: as for move_line, state is not changed
+    Return:
+        the moved rows of state['points'] before the optimization, as live_point_rows:
+        the vertices at their new positions, the ticks at the t of their new position projected on their line.
+        Only the moved points and the ends of the lines of the ticks are looked at, not the whole state,
+        so it is cheap enough to run on the event loop before the solve.
+    '''
+    pointsData = state['points']
+    linesData = state['lines']
 
-def move_line( input_data, state ):
+    vertices = {}
+    ticks = {}
+    for item in input_data['Items']:
+        start_point_index, end_point_index = linesData[ item['index'] ][:2]
+        for index, end in ( ( start_point_index, item['start'] ), ( end_point_index, item['end'] ) ):
+            position = [ end['x'], end['y'], end['z'] ]
+            if node_is_tick( pointsData, index ):
+                ticks[ index ] = position
+            else:
+                vertices[ index ] = position
+
+    position = lambda index: vertices[ index ] if index in vertices else node_i_position( index, pointsData )
+
+    rows = { index: np.asarray( p, dtype = float ).tolist() + list( pointsData[index][3:] ) for index, p in vertices.items() }
+    for index, p in ticks.items():
+        t = project_point_on_line_as_t( p, [ position( pointsData[index][1] ), position( pointsData[index][2] ) ] )
+        rows[ index ] = [ float( t ) ] + list( pointsData[index][1:] )
+    return rows
+
+def move_line( input_data, state, solver = None, progress = None ):
     '''
     ## the passed line has to be either free or half-constrained lines
     ## after optimization
@@ -507,6 +497,11 @@ def move_line( input_data, state ):
                     ...
                 ]
         state : 
+        solver : an irls_solver.IRLSSolver, which keeps the previous solve for warm starts.
+                 When it is cancelled this raises irls_solver.Cancelled and state is left half updated.
+        progress : progress( 'iterate', rows ) is called with the moved rows of state['points'] ( see live_point_rows )
+                   after every IRLS outer iteration ( needs a solver ). The curves are only optimized for the final state.
+                   The rows before the optimization are move_line_preview's.
     Return:
     '''
 
@@ -572,7 +567,8 @@ def move_line( input_data, state ):
     free_lines_indices =  find_free_lines_indices(linesData)
 
 
-    moved_points = all_points_positions(pointsData)
+    # only the moved vertices and the ticks depending on them change
+    moved_points = point_graph.point_graph( pointsData ).resolve( pointsData, points, dirty = live_vertex_indices )
     
     # also update the tick points positions 
     for key, value in changed_tick_point_positions.items():
@@ -581,27 +577,49 @@ def move_line( input_data, state ):
     print('moved_points : ',moved_points)
 
 
+
     moved_lines = all_lines_positions(linesData, moved_points)
 
     print('moved_lines : ', moved_lines)
-    all_previous_constraints = calculate_constraints( lines , free_lines_indices )
-    constraints_remove_broken_ones = remove_broken_constraints( all_previous_constraints, moved_lines )
-    updated_edges_indices = find_updated_edges_indices( moved_lines, lines, free_lines_indices)
+    with tracing.span( 'move_line.constraints' ):
+        index = constraint_index.ConstraintIndex( lines, free_lines_indices, thresholds )
+        all_previous_constraints = calculate_constraints( lines , free_lines_indices, index )
+        constraints_remove_broken_ones = remove_broken_constraints( all_previous_constraints, moved_lines )
+        updated_edges_indices = find_updated_edges_indices( moved_lines, lines, free_lines_indices)
+
+        # only re-index the lines which moved
+        index.update( moved_lines, [ i for i in free_lines_indices if not np.array_equal( moved_lines[i], lines[i] ) ] )
 
-    # print('find_updated_edges_indices in c3', updated_edges_indices)
-    constraints_in_moved_state = find_new_constraints(moved_lines, updated_edges_indices, changed_edges_indices, free_lines_indices)
-    c_all = add_two_constraints(constraints_remove_broken_ones, constraints_in_moved_state)
+        # print('find_updated_edges_indices in c3', updated_edges_indices)
+        constraints_in_moved_state = find_new_constraints(moved_lines, updated_edges_indices, changed_edges_indices, free_lines_indices, index)
+        c_all = add_two_constraints(constraints_remove_broken_ones, constraints_in_moved_state)
 
+    for constraint_type, pairs in c_all.items():
+        tracing.observe( 'move_line.constraints.' + constraint_type, len( pairs ) )
 
  
 
-    optimized_points = IRLS( c_all, moved_lines, moved_points, linesData, live_vertex_indices )
+    with tracing.span( 'move_line.irls' ):
+        if solver is None:
+            optimized_points = IRLS( c_all, moved_lines, moved_points, linesData, live_vertex_indices )
+        else:
+            callback = None
+            if progress is not None:
+                callback = lambda positions: progress( 'iterate', live_point_rows( pointsData, positions, live_vertex_indices, changed_tick_point_positions ) )
+            optimized_points = solver.solve( c_all, moved_points, linesData, live_vertex_indices, callback )
+            print('IRLS stats : ', solver.stats)
+            tracing.count( 'irls.outer_iterations', solver.stats['outer_iterations'] )
+            tracing.count( 'irls.bfgs_iterations', solver.stats['inner_iterations'] )
+            tracing.count( 'irls.function_evaluations', solver.stats['function_evaluations'] )
+            tracing.count( 'irls.stop_' + solver.stats['stop_reason'] )
+            # the curves are the slow part, skip them too when the move was superseded
+            solver.check_cancelled()
     print('optimized_points : ', optimized_points)
 
     # update all the free line optimized endpoints
     for live_vertex_index in live_vertex_indices:
         if live_vertex_index not in changed_tick_point_positions.keys():
-            state['points'][live_vertex_index][:3] = optimized_points[ live_vertex_index ]
+            state['points'][live_vertex_index][:3] = np.asarray( optimized_points[ live_vertex_index ] ).tolist()
 
     print('state after updating vertex points',  state)
 
@@ -629,7 +647,8 @@ def move_line( input_data, state ):
             points_positions_changed.append( i )
 
 
-    optimize_curves( state, points_positions_changed )
+    with tracing.span( 'move_line.curves' ):
+        optimize_curves( state, points_positions_changed )
 
     return state
 
@@ -688,7 +707,8 @@ def move_detail( input_data, state ):
 
     state['input_data'] = input_data['Items']
 
-    optimize_curves(state, points_positions_changed)
+    with tracing.span( 'move_detail.curves' ):
+        optimize_curves(state, points_positions_changed)
 
     return state
 
@@ -696,9 +716,14 @@ def move_detail( input_data, state ):
 
 
 
-def optimize_curves( state, points_positions_changed ):
+def curves_to_optimize( state, points_positions_changed ):
     '''
-    state: already updated
+    Given:
+        state: already updated
+        points_positions_changed: indices of the moved points
+    Return:
+        the indices of the curves which have a moved key point ( straight lines excluded ),
+        and their ( key points, unit tangents ), as reoptimize_curve.MVC_magnitudes takes them
     '''
 
 
@@ -726,6 +751,10 @@ def optimize_curves( state, points_positions_changed ):
     # print('optimized_points',optimized_points)
     # print('points_positions_changed', points_positions_changed)
 
+    # the curves to reoptimize, all optimized together by reoptimize_curve.MVC_magnitudes_batch
+    # unless the same curve shape was optimized before ( reoptimize_curve.magnitude_cache )
+    update_curve_indices = []
+    update_curves = []
 
     for curve_index in range(len(curvesData)):
         curve_info = curvesData[curve_index]
@@ -763,9 +792,23 @@ def optimize_curves( state, points_positions_changed ):
 
                 # print('key_points, key_tangents, key_magnitudes', key_points, key_tangents)
 
-                optimized_magnitudes = reoptimize_curve.MVC_magnitudes(key_points, key_tangents)
-                # curvesData[i]['magnitudes'] = optimized_magnitudes.tolist()
-                curvesData[curve_index]['magnitudes'] = optimized_magnitudes
+                update_curve_indices.append( curve_index )
+                update_curves.append( ( key_points, key_tangents ) )
+
+    return update_curve_indices, update_curves
+
+def optimize_curves( state, points_positions_changed ):
+    '''
+    state: already updated
+    '''
+    curvesData = state['curves']
+    update_curve_indices, update_curves = curves_to_optimize( state, points_positions_changed )
+
+    max_samples = reoptimize_curve.adaptive_max_samples if adaptive_curve_sampling else None
+    optimized_magnitudes = reoptimize_curve.MVC_magnitudes_cached( update_curves, max_samples )
+    for curve_index, magnitudes in zip( update_curve_indices, optimized_magnitudes ):
+        # curvesData[i]['magnitudes'] = optimized_magnitudes.tolist()
+        curvesData[curve_index]['magnitudes'] = magnitudes
 
 
 
@@ -0,0 +1,187 @@
+# delta replies for the websocket
+#
+# instead of json.dumps of the whole state after every interaction,
+# a client in delta mode gets only the points, curve magnitudes and strokes
+# which changed since the last version it acknowledged.
+#
+# A delta is a dictionary:
+#     'points': [ [index, point], ... ]          changed entries of state['points']
+#     'n_points': int                            len( state['points'] )
+#     'curves': [ [index, magnitudes], ... ]     changed curve magnitudes
+#     'strokes_kept': int                        strokes ( and stroke_points ) kept from the base version
+#     'strokes': [ stroke, ... ]                 strokes appended after those
+#     'stroke_points': [ points, ... ]           stroke_points appended after those
+#     'replace': { key: value }                  any other top level entry which changed, as a whole
+
+import history
+
+
+def _same( a, b ):
+    if a is b:
+        return True
+    # history snapshots keep point and line rows as tuples
+    if isinstance( a, tuple ) != isinstance( b, tuple ) and isinstance( a, ( list, tuple ) ) and isinstance( b, ( list, tuple ) ):
+        return list( a ) == list( b )
+    return a == b
+
+
+def _kept_prefix( old_list, new_list ):
+    '''
+    length of the common prefix of two lists
+    '''
+    n = min( len( old_list ), len( new_list ) )
+    for i in range( n ):
+        if not _same( old_list[i], new_list[i] ):
+            return i
+    return n
+
+
+def diff_states( old, new ):
+    '''
+    Given:
+        old: the base state
+        new: the current state
+    Return:
+        delta such that apply_delta( old, delta ) == new
+    '''
+    delta = {}
+
+    old_points = old.get( 'points', [] )
+    new_points = new.get( 'points', [] )
+    delta['n_points'] = len( new_points )
+    delta['points'] = [ [ i, point ] for i, point in enumerate( new_points )
+                        if i >= len( old_points ) or not _same( old_points[i], point ) ]
+
+    replace = {}
+
+    old_curves = old.get( 'curves', [] )
+    new_curves = new.get( 'curves', [] )
+    delta['curves'] = []
+    if len( old_curves ) == len( new_curves ):
+        for i, ( old_curve, new_curve ) in enumerate( zip( old_curves, new_curves ) ):
+            if _same( old_curve, new_curve ):
+                continue
+            if { k: v for k, v in old_curve.items() if k != 'magnitudes' } == { k: v for k, v in new_curve.items() if k != 'magnitudes' }:
+                delta['curves'].append( [ i, new_curve['magnitudes'] ] )
+            else:
+                replace['curves'] = new_curves
+                break
+    else:
+        replace['curves'] = new_curves
+    if 'curves' in replace:
+        delta['curves'] = []
+
+    old_strokes = old.get( 'strokes', [] )
+    new_strokes = new.get( 'strokes', [] )
+    old_stroke_points = old.get( 'stroke_points', [] )
+    new_stroke_points = new.get( 'stroke_points', [] )
+    kept = min( _kept_prefix( old_strokes, new_strokes ), _kept_prefix( old_stroke_points, new_stroke_points ) )
+    delta['strokes_kept'] = kept
+    delta['strokes'] = new_strokes[kept:]
+    delta['stroke_points'] = new_stroke_points[kept:]
+
+    handled = ( 'points', 'curves', 'strokes', 'stroke_points' )
+    for key, value in new.items():
+        if key not in handled and ( key not in old or not _same( old[key], value ) ):
+            replace[key] = value
+    delta['replace'] = replace
+
+    removed = [ key for key in old if key not in new and key not in handled ]
+    if removed:
+        delta['removed'] = removed
+
+    return delta
+
+
+def apply_delta( state, delta ):
+    '''
+    Given:
+        state: the base state, not modified
+        delta: from diff_states
+    Return:
+        the new state
+    '''
+    new = dict( state )
+
+    points = list( state.get( 'points', [] ) )[ :delta['n_points'] ]
+    for i, point in delta['points']:
+        if i < len( points ):
+            points[i] = point
+        else:
+            points.append( point )
+    new['points'] = points
+
+    if delta['curves']:
+        curves = [ dict( curve ) for curve in state['curves'] ]
+        for i, magnitudes in delta['curves']:
+            curves[i]['magnitudes'] = magnitudes
+        new['curves'] = curves
+
+    kept = delta['strokes_kept']
+    new['strokes'] = list( state.get( 'strokes', [] ) )[:kept] + list( delta['strokes'] )
+    new['stroke_points'] = list( state.get( 'stroke_points', [] ) )[:kept] + list( delta['stroke_points'] )
+
+    new.update( delta['replace'] )
+    for key in delta.get( 'removed', [] ):
+        new.pop( key, None )
+
+    return new
+
+
+class DeltaTracker:
+    '''
+    Versions of the state sent to one client.
+
+    Every reply gets a new version. A delta is relative to the last version the client
+    acknowledged ( `ack` ), which starts at the version of the last full state.
+    '''
+
+    def __init__( self, max_versions = 64 ):
+        '''
+        max_versions: how many unacknowledged versions to keep,
+                      when the acknowledged one is dropped the next reply is a full state
+        '''
+        self.max_versions = max_versions
+        self.version = 0
+        self.acked = None
+        self.snapshots = {}
+
+    def _register( self, state ):
+        previous = self.snapshots.get( self.version )
+        self.version += 1
+        self.snapshots[ self.version ] = history.snapshot( state, previous )
+        while len( self.snapshots ) > self.max_versions:
+            del self.snapshots[ min( self.snapshots ) ]
+        return self.version
+
+    def full( self, state ):
+        '''
+        the reply with the whole state, which the client is assumed to apply
+        '''
+        version = self._register( state )
+        self.ack( version )
+        return { 'version': version, 'state': state }
+
+    def delta( self, state ):
+        '''
+        the reply with the changes since the acknowledged version,
+        or the whole state when that version is not kept anymore
+        '''
+        if self.acked not in self.snapshots:
+            return self.full( state )
+
+        base = self.acked
+        delta = diff_states( self.snapshots[ base ], state )
+        version = self._register( state )
+        return { 'version': version, 'base_version': base, 'delta': delta }
+
+    def ack( self, version ):
+        '''
+        the client has applied `version`, older snapshots are not needed anymore
+        '''
+        if version not in self.snapshots:
+            return False
+        self.acked = version
+        for v in [ v for v in self.snapshots if v < version ]:
+            del self.snapshots[v]
+        return True
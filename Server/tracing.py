@@ -0,0 +1,252 @@
+# latency tracing and counters
+#
+# A span times a stage of the server:
+#     with tracing.span( 'move_line.irls' ):
+#         ...
+# and every span name keeps a rolling histogram of its durations: the samples of the last
+# `window` seconds ( at most `max_samples` ) for percentiles, and the counts in `latency_buckets`
+# since the server started, for Prometheus.
+# `observe` adds a value which is not a duration ( e.g. the constraints of a move ) to a rolling
+# histogram of its own, `count` adds to a counter ( e.g. optimizer iterations ).
+#
+# Spans and counters are recorded from the event loop and the solver thread, under one lock.
+# edit_server answers `stats` with `stats()` as json, and serves `prometheus_text()` at
+# http://127.0.0.1:metrics_port/metrics when edit_server.metrics_port is set, see start_http_server.
+#
+# Span names are the stage, prefixed by what runs it:
+#     command.<command>               a websocket message, from its receipt to its reply
+#     solver.wait                     waiting for the solver of the other connections
+#     reply.serialize, reply.send     of the state in a reply
+#     export                          the session log written as json when a connection closes
+#     move_line.constraints / irls / curves
+#     move_detail.curves
+#     stroke.resample / fit / weights, stroke_stream.refit / finish
+
+import asyncio
+import collections
+import contextlib
+import re
+import threading
+import time
+
+import numpy as np
+
+
+enabled = True
+
+# seconds of samples for the percentiles
+window = 300.
+max_samples = 4096
+
+# upper bounds in seconds of the Prometheus histogram buckets
+latency_buckets = ( 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10. )
+
+percentiles = ( 50, 90, 99 )
+
+metric_prefix = 'movescaffold'
+
+
+class RollingHistogram:
+    '''
+    The samples of the last `window` seconds, and the bucket counts, sum and count since it was made.
+    '''
+
+    def __init__( self, buckets = None ):
+        '''
+        buckets: increasing upper bounds, or None for no bucket counts
+        '''
+        self.samples = collections.deque( maxlen = max_samples )
+        self.buckets = buckets
+        self.bucket_counts = [ 0 ] * len( buckets ) if buckets else None
+        self.total = 0
+        self.sum = 0.
+
+    def add( self, value, now ):
+        self.samples.append( ( now, value ) )
+        self.total += 1
+        self.sum += value
+        if self.buckets:
+            for i, bound in enumerate( self.buckets ):
+                if value <= bound:
+                    self.bucket_counts[i] += 1
+                    break
+
+    def recent( self, now ):
+        while self.samples and self.samples[0][0] < now - window:
+            self.samples.popleft()
+        return np.array( [ value for t, value in self.samples ], dtype = float )
+
+    def summary( self, now, scale = 1. ):
+        '''
+        count, mean, percentiles and max of the window, times scale, and the count and sum since the start
+        '''
+        values = scale * self.recent( now )
+        s = { 'count': len( values ), 'total_count': self.total, 'total_sum': scale * self.sum }
+        if len( values ):
+            s['mean'] = float( values.mean() )
+            s['max'] = float( values.max() )
+            for p in percentiles:
+                s[ 'p%d' % p ] = float( np.percentile( values, p ) )
+        return s
+
+
+_lock = threading.Lock()
+_spans = {}
+_values = {}
+_counters = collections.Counter()
+
+
+def record( name, seconds ):
+    '''
+    adds a duration to the histogram of span name
+    '''
+    if not enabled:
+        return
+    with _lock:
+        histogram = _spans.get( name )
+        if histogram is None:
+            histogram = _spans[ name ] = RollingHistogram( latency_buckets )
+        histogram.add( seconds, time.time() )
+
+
+@contextlib.contextmanager
+def span( name ):
+    '''
+    times the body of a with statement as span name, also when it raises
+    '''
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record( name, time.perf_counter() - start )
+
+
+def observe( name, value ):
+    '''
+    adds a value to the histogram name, e.g. the constraints of one move
+    '''
+    if not enabled:
+        return
+    with _lock:
+        histogram = _values.get( name )
+        if histogram is None:
+            histogram = _values[ name ] = RollingHistogram()
+        histogram.add( value, time.time() )
+
+
+def count( name, value = 1 ):
+    '''
+    adds value to the counter name
+    '''
+    if not enabled:
+        return
+    with _lock:
+        _counters[ name ] += value
+
+
+def reset():
+    with _lock:
+        _spans.clear()
+        _values.clear()
+        _counters.clear()
+
+
+def stats():
+    '''
+    Return:
+        json serializable dictionary of
+            spans: name -> summary of the durations in milliseconds, see RollingHistogram.summary
+            values: name -> summary of the values
+            counters: name -> total
+            window: seconds of the summaries
+    '''
+    now = time.time()
+    with _lock:
+        return { 'window': window,
+                 'spans': { name: histogram.summary( now, 1000. ) for name, histogram in sorted( _spans.items() ) },
+                 'values': { name: histogram.summary( now ) for name, histogram in sorted( _values.items() ) },
+                 'counters': dict( sorted( _counters.items() ) ) }
+
+
+def _metric_name( name ):
+    return re.sub( r'[^a-zA-Z0-9_]', '_', name )
+
+
+def _label( value ):
+    return value.replace( '\\', '\\\\' ).replace( '"', '\\"' )
+
+
+def prometheus_text():
+    '''
+    Return:
+        the spans, values and counters in the Prometheus text format:
+            <prefix>_span_seconds            histogram of every span since the start
+            <prefix>_span_recent_seconds     summary of every span over the window
+            <prefix>_value                   summary of every value over the window
+            <prefix>_<counter>_total         counter
+    '''
+    now = time.time()
+    lines = []
+    with _lock:
+        histogram_name = metric_prefix + '_span_seconds'
+        lines.append( '# HELP %s duration of a server stage' % histogram_name )
+        lines.append( '# TYPE %s histogram' % histogram_name )
+        for name, histogram in sorted( _spans.items() ):
+            label = 'span="%s"' % _label( name )
+            cumulative = 0
+            for bound, bucket_count in zip( histogram.buckets, histogram.bucket_counts ):
+                cumulative += bucket_count
+                lines.append( '%s_bucket{%s,le="%g"} %d' % ( histogram_name, label, bound, cumulative ) )
+            lines.append( '%s_bucket{%s,le="+Inf"} %d' % ( histogram_name, label, histogram.total ) )
+            lines.append( '%s_sum{%s} %.9g' % ( histogram_name, label, histogram.sum ) )
+            lines.append( '%s_count{%s} %d' % ( histogram_name, label, histogram.total ) )
+
+        for summary_name, histograms, key in ( ( metric_prefix + '_span_recent_seconds', _spans, 'span' ),
+                                               ( metric_prefix + '_value', _values, 'name' ) ):
+            lines.append( '# HELP %s over the last %g seconds' % ( summary_name, window ) )
+            lines.append( '# TYPE %s summary' % summary_name )
+            for name, histogram in sorted( histograms.items() ):
+                label = '%s="%s"' % ( key, _label( name ) )
+                values = histogram.recent( now )
+                if len( values ):
+                    for p in percentiles:
+                        lines.append( '%s{%s,quantile="%g"} %.9g' % ( summary_name, label, p / 100., np.percentile( values, p ) ) )
+                lines.append( '%s_sum{%s} %.9g' % ( summary_name, label, values.sum() ) )
+                lines.append( '%s_count{%s} %d' % ( summary_name, label, len( values ) ) )
+
+        for name, total in sorted( _counters.items() ):
+            counter_name = '%s_%s_total' % ( metric_prefix, _metric_name( name ) )
+            lines.append( '# TYPE %s counter' % counter_name )
+            lines.append( '%s %.9g' % ( counter_name, total ) )
+
+    return '\n'.join( lines ) + '\n'
+
+
+async def _serve_metrics( reader, writer ):
+    try:
+        request_line = await reader.readline()
+        # the headers are not needed
+        while ( await reader.readline() ) not in ( b'\r\n', b'\n', b'' ):
+            pass
+        parts = request_line.decode( 'latin-1' ).split()
+        if len( parts ) >= 2 and parts[0] == 'GET' and parts[1].split( '?' )[0] in ( '/metrics', '/' ):
+            status, content_type, body = '200 OK', 'text/plain; version=0.0.4', prometheus_text().encode( 'utf-8' )
+        else:
+            status, content_type, body = '404 Not Found', 'text/plain', b'not found\n'
+        writer.write( ( 'HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n'
+                        % ( status, content_type, len( body ) ) ).encode( 'latin-1' ) + body )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_http_server( port, host = '127.0.0.1' ):
+    '''
+    Serves prometheus_text at http://host:port/metrics on the running event loop.
+    Return:
+        the asyncio server
+    '''
+    return await asyncio.start_server( _serve_metrics, host, port )
@@ -0,0 +1,302 @@
+# binary websocket frames
+#
+# a frame is a typed header, a small json metadata block and packed arrays:
+#
+#     magic            4 bytes   b'MSB1'
+#     command length   uint16
+#     array count      uint16
+#     metadata length  uint32
+#     command          utf-8
+#     metadata         utf-8 json
+#     for every array:
+#         name length  uint16
+#         name         utf-8
+#         dtype code   uint8      see DTYPES
+#         ndim         uint8
+#         shape        ndim * uint32
+#         padding      zeros up to a multiple of 8 bytes from the frame start
+#         data         little-endian, C order
+#
+# decoding is zero-copy, every array is an np.frombuffer view into the received frame.
+# A client negotiates binary replies with `init {"binary": true}` and can send
+# detail-stroke, stroke-append, stroke-end and move-line as binary frames at any time.
+
+import glob
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+
+
+MAGIC = b'MSB1'
+
+DTYPES = {
+    0: np.dtype( '<f4' ),
+    1: np.dtype( '<f8' ),
+    2: np.dtype( '<i4' ),
+    3: np.dtype( '<u1' ),
+}
+DTYPE_CODES = { dtype: code for code, dtype in DTYPES.items() }
+
+_header = struct.Struct( '<4sHHI' )
+
+POINT_TYPES = ( 'vertex', 'tick' )
+# both spellings of half constrained appear in the Data files
+LINE_TYPES = ( 'free', 'half_constrained', 'constrained', 'half-constrained' )
+
+
+def _padding( offset ):
+    return ( -offset ) % 8
+
+
+def encode_message( command, arrays = None, metadata = None ):
+    '''
+    Given:
+        command: e.g. 'move_line'
+        arrays: dictionary name -> numpy array ( float32, float64, int32 or uint8 )
+        metadata: json serializable dictionary
+    Return:
+        bytes of the frame
+    '''
+    arrays = arrays or {}
+    command = command.encode( 'utf-8' )
+    metadata = json.dumps( metadata or {} ).encode( 'utf-8' )
+
+    parts = [ _header.pack( MAGIC, len( command ), len( arrays ), len( metadata ) ), command, metadata ]
+    offset = sum( len( part ) for part in parts )
+
+    for name, array in arrays.items():
+        array = np.asarray( array )
+        dtype = array.dtype.newbyteorder( '<' )
+        if dtype not in DTYPE_CODES:
+            raise ValueError( 'unsupported dtype %s for %s' % ( array.dtype, name ) )
+        array = np.ascontiguousarray( array, dtype = dtype )
+
+        name = name.encode( 'utf-8' )
+        head = struct.pack( '<H', len( name ) ) + name + struct.pack( '<BB', DTYPE_CODES[dtype], array.ndim ) \
+            + struct.pack( '<%dI' % array.ndim, *array.shape )
+        offset += len( head )
+        pad = b'\0' * _padding( offset )
+        offset += len( pad ) + array.nbytes
+        parts.extend( [ head, pad, array.tobytes() ] )
+
+    return b''.join( parts )
+
+
+def decode_message( frame ):
+    '''
+    Given:
+        frame: bytes from encode_message
+    Return:
+        command, arrays, metadata
+        the arrays are read-only views into frame
+    '''
+    buffer = memoryview( frame )
+    magic, command_length, n_arrays, metadata_length = _header.unpack_from( buffer, 0 )
+    if magic != MAGIC:
+        raise ValueError( 'not a binary frame' )
+
+    offset = _header.size
+    command = bytes( buffer[ offset : offset + command_length ] ).decode( 'utf-8' )
+    offset += command_length
+    metadata = json.loads( bytes( buffer[ offset : offset + metadata_length ] ).decode( 'utf-8' ) )
+    offset += metadata_length
+
+    arrays = {}
+    for _ in range( n_arrays ):
+        name_length, = struct.unpack_from( '<H', buffer, offset )
+        offset += 2
+        name = bytes( buffer[ offset : offset + name_length ] ).decode( 'utf-8' )
+        offset += name_length
+        code, ndim = struct.unpack_from( '<BB', buffer, offset )
+        offset += 2
+        shape = struct.unpack_from( '<%dI' % ndim, buffer, offset )
+        offset += 4 * ndim
+        offset += _padding( offset )
+
+        dtype = DTYPES[code]
+        count = int( np.prod( shape, dtype = np.int64 ) )
+        arrays[name] = np.frombuffer( buffer, dtype = dtype, count = count, offset = offset ).reshape( shape )
+        offset += count * dtype.itemsize
+
+    return command, arrays, metadata
+
+
+def is_binary( message ):
+    return isinstance( message, ( bytes, bytearray, memoryview ) )
+
+
+def _ragged( lists, dim = None, dtype = np.float64 ):
+    '''
+    a list of lists as one flat array and offsets, offsets[i]:offsets[i+1] is list i
+    '''
+    lengths = [ len( l ) for l in lists ]
+    offsets = np.zeros( len( lists ) + 1, dtype = np.int32 )
+    np.cumsum( lengths, out = offsets[1:] )
+    shape = ( -1, ) if dim is None else ( -1, dim )
+    if offsets[-1] == 0:
+        return np.zeros( ( 0, ) if dim is None else ( 0, dim ), dtype = dtype ), offsets
+    return np.concatenate( [ np.asarray( l, dtype = dtype ).reshape( shape ) for l in lists if len( l ) ] ), offsets
+
+
+def _unragged( flat, offsets ):
+    return [ flat[ offsets[i] : offsets[i+1] ] for i in range( len( offsets ) - 1 ) ]
+
+
+def _type_codes( names, known ):
+    '''
+    codes of names in known, a name which is not in known gets the next code after it
+    Return:
+        codes as uint8, the table of the codes ( known and the unknown names )
+    '''
+    table = list( known )
+    codes = np.empty( len( names ), dtype = np.uint8 )
+    for i, name in enumerate( names ):
+        if name not in table:
+            table.append( name )
+        codes[i] = table.index( name )
+    return codes, table
+
+
+def encode_state( state ):
+    '''
+    Given:
+        state
+    Return:
+        arrays, metadata for encode_message
+
+    points, lines, curve magnitudes, stroke points, stroke knots and stroke weights are arrays,
+    the curve structure and anything else is in the metadata.
+    Point and line types are codes into POINT_TYPES and LINE_TYPES. A type which is not in them
+    gets a code after them, and the metadata has the extended table as 'point_types' / 'line_types'.
+    '''
+    arrays = {}
+    metadata = {}
+
+    points = state['points']
+    arrays['points'] = np.asarray( [ point[:3] for point in points ], dtype = np.float64 ).reshape( -1, 3 )
+    arrays['point_types'], point_types = _type_codes( [ point[-1] for point in points ], POINT_TYPES )
+    if len( point_types ) > len( POINT_TYPES ):
+        metadata['point_types'] = point_types
+
+    lines = state['lines']
+    arrays['lines'] = np.asarray( [ line[:2] for line in lines ], dtype = np.int32 ).reshape( -1, 2 )
+    arrays['line_types'], line_types = _type_codes( [ line[-1] for line in lines ], LINE_TYPES )
+    if len( line_types ) > len( LINE_TYPES ):
+        metadata['line_types'] = line_types
+
+    curves = state.get( 'curves', [] )
+    arrays['curve_magnitudes'], arrays['curve_magnitude_offsets'] = _ragged( [ curve['magnitudes'] for curve in curves ] )
+
+    stroke_points = state.get( 'stroke_points', [] )
+    arrays['stroke_points'], arrays['stroke_point_offsets'] = _ragged( stroke_points, dim = 3 )
+
+    strokes = state.get( 'strokes', [] )
+    arrays['stroke_knots'], arrays['stroke_knot_offsets'] = _ragged( [ stroke['knots'] for stroke in strokes ] )
+    # weights of stroke i: an ( n_control_points, n_vertices ) matrix
+    arrays['stroke_weights'], arrays['stroke_weight_offsets'] = _ragged( [ np.ravel( stroke['weights'] ) for stroke in strokes ] )
+    arrays['stroke_weight_shapes'] = np.asarray( [ np.shape( stroke['weights'] ) if len( stroke['weights'] ) else ( 0, 0 )
+                                                   for stroke in strokes ], dtype = np.int32 ).reshape( -1, 2 )
+    arrays['stroke_degrees'] = np.asarray( [ stroke['degree'] for stroke in strokes ], dtype = np.int32 )
+    arrays['stroke_ns'] = np.asarray( [ stroke['n'] for stroke in strokes ], dtype = np.int32 )
+
+    metadata['curves'] = [ { key: value for key, value in curve.items() if key != 'magnitudes' } for curve in curves ]
+    for key, value in state.items():
+        if key not in ( 'points', 'lines', 'curves', 'strokes', 'stroke_points' ):
+            metadata[key] = value
+
+    return arrays, metadata
+
+
+def decode_state( arrays, metadata ):
+    '''
+    the inverse of encode_state
+    '''
+    state = {}
+    point_types = metadata.get( 'point_types', POINT_TYPES )
+    line_types = metadata.get( 'line_types', LINE_TYPES )
+
+    state['points'] = []
+    for xyz, point_type in zip( arrays['points'].tolist(), arrays['point_types'].tolist() ):
+        if point_types[ point_type ] == 'tick':
+            xyz[1], xyz[2] = int( xyz[1] ), int( xyz[2] )
+        state['points'].append( xyz + [ point_types[ point_type ] ] )
+
+    state['lines'] = [ ends + [ line_types[ line_type ] ]
+                       for ends, line_type in zip( arrays['lines'].tolist(), arrays['line_types'].tolist() ) ]
+
+    state['curves'] = []
+    magnitudes = _unragged( arrays['curve_magnitudes'], arrays['curve_magnitude_offsets'] )
+    for curve, curve_magnitudes in zip( metadata['curves'], magnitudes ):
+        curve = dict( curve )
+        curve['magnitudes'] = curve_magnitudes.tolist()
+        state['curves'].append( curve )
+
+    state['stroke_points'] = [ points.tolist() for points in _unragged( arrays['stroke_points'], arrays['stroke_point_offsets'] ) ]
+
+    knots = _unragged( arrays['stroke_knots'], arrays['stroke_knot_offsets'] )
+    weights = _unragged( arrays['stroke_weights'], arrays['stroke_weight_offsets'] )
+    state['strokes'] = []
+    for i in range( len( knots ) ):
+        stroke = {}
+        stroke['knots'] = knots[i].tolist()
+        stroke['weights'] = weights[i].reshape( arrays['stroke_weight_shapes'][i] ).tolist()
+        stroke['degree'] = int( arrays['stroke_degrees'][i] )
+        stroke['n'] = int( arrays['stroke_ns'][i] )
+        state['strokes'].append( stroke )
+
+    for key, value in metadata.items():
+        # the sequence of a progressive move_line reply is not part of the state
+        if key not in ( 'curves', 'sequence', 'point_types', 'line_types' ):
+            state[key] = value
+
+    return state
+
+
+def decode_input( command, arrays, metadata ):
+    '''
+    the input_data of a binary command, in the same form as its json message
+        detail-stroke: arrays 'points' ( n, 3 ), metadata 'scale'
+                       input_data['points'] stays an array, see fit_detail_stroke.extract_resampled_points
+        stroke-append, stroke-end: arrays 'points' ( n, 3 ), likewise ( optional for stroke-end )
+        move-line: arrays 'index' ( k, ), 'start' ( k, 3 ), 'end' ( k, 3 )
+        move-detail: arrays 'index' ( k, ), 't' ( k, )
+    '''
+    input_data = dict( metadata )
+
+    if command in ( 'detail-stroke', 'stroke-append', 'stroke-end' ):
+        if 'points' in arrays:
+            input_data['points'] = arrays['points'].reshape( -1, 3 )
+    elif command == 'move-line':
+        xyz = lambda p: { 'x': p[0], 'y': p[1], 'z': p[2] }
+        input_data['Items'] = [ { 'index': index, 'start': xyz( start ), 'end': xyz( end ) }
+                                for index, start, end in zip( arrays['index'].tolist(), arrays['start'].tolist(), arrays['end'].tolist() ) ]
+    elif command == 'move-detail':
+        input_data['Items'] = [ { 'index': index, 't': t } for index, t in zip( arrays['index'].tolist(), arrays['t'].tolist() ) ]
+
+    return input_data
+
+
+if __name__ == '__main__':
+    ## round trip of every model: python wire_format.py [Data/*.json ...]
+    paths = sys.argv[1:] or sorted( glob.glob( os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), 'Data', '*.json' ) ) )
+    failed = 0
+    for path in paths:
+        with open( path ) as f:
+            state = json.load( f )
+        # decode_state always has the stroke lists
+        state.setdefault( 'strokes', [] )
+        state.setdefault( 'stroke_points', [] )
+
+        arrays, metadata = encode_state( state )
+        command, arrays, metadata = decode_message( encode_message( 'init', arrays, metadata ) )
+        decoded = decode_state( arrays, metadata )
+
+        # through json, which has no difference between 1 and 1.0
+        same = json.loads( json.dumps( decoded ) ) == json.loads( json.dumps( state ) )
+        failed += not same
+        print( '%-40s %s' % ( os.path.basename( path ), 'ok' if same else 'differs' ) )
+    print( '%d of %d models round trip' % ( len( paths ) - failed, len( paths ) ) )
+    sys.exit( 1 if failed else 0 )